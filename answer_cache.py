@@ -0,0 +1,142 @@
+"""
+answer_cache.py
+Benzer sorular için LLM cevaplarını tekrar kullanan semantik cevap önbelleği.
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class AnswerCache:
+    """
+    Daha önce cevaplanan sorguları embedding benzerliğiyle eşleştirir.
+
+    Bir cevap sadece sorgu benzerliği eşiğin üzerindeyse VE bulunan chunk
+    seti aynıysa tekrar kullanılır. Kayıtlar TTL ve boyut (LRU) ile
+    düşürülür; indeks versiyonu değişince önbellek tamamen temizlenir.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 86400, max_size: int = 256,
+                 persist_path: str = None, index_version: str = ""):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.index_version = index_version
+        self.entries = OrderedDict()  # sıra no -> kayıt
+        self.hits = 0
+        self.misses = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+        if persist_path and os.path.exists(persist_path):
+            self.load()
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self, now: float):
+        expired = [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            del self.entries[key]
+
+    def set_index_version(self, index_version: str):
+        """İndeks yeniden oluşturulduysa önbelleği geçersiz kılar."""
+        with self._lock:
+            if index_version != self.index_version:
+                self.entries.clear()
+                self.index_version = index_version
+
+    def lookup(self, query_vector, chunk_ids: List[str]) -> Optional[str]:
+        """Benzer sorgu ve aynı chunk seti varsa kayıtlı cevabı döndürür."""
+        query_vector = self._unit(query_vector)
+        chunk_set = frozenset(chunk_ids)
+        with self._lock:
+            self._expire(time.time())
+            if not self.entries:
+                self.misses += 1
+                return None
+
+            keys = list(self.entries.keys())
+            matrix = np.stack([self.entries[key]["vector"] for key in keys])
+            similarities = matrix @ query_vector
+
+            for pos in np.argsort(-similarities):
+                if similarities[pos] < self.threshold:
+                    break
+                entry = self.entries[keys[pos]]
+                if entry["chunk_ids"] == chunk_set:
+                    self.entries.move_to_end(keys[pos])
+                    self.hits += 1
+                    return entry["answer"]
+
+            self.misses += 1
+            return None
+
+    def add(self, query: str, query_vector, chunk_ids: List[str], answer: str,
+            created: float = None):
+        """Yeni bir cevap kaydeder; boyut aşılırsa en eski kullanılanı düşürür."""
+        with self._lock:
+            self.entries[self._next_id] = {
+                "query": query,
+                "vector": self._unit(query_vector),
+                "chunk_ids": frozenset(chunk_ids),
+                "answer": answer,
+                "created": created if created is not None else time.time(),
+            }
+            self._next_id += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Önbellek boyutu ve hit/miss sayaçları."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self):
+        """Önbelleği indeks versiyonuyla birlikte JSON olarak kaydeder."""
+        if not self.persist_path:
+            return
+        with self._lock:
+            data = {
+                "index_version": self.index_version,
+                "entries": [
+                    {
+                        "query": entry["query"],
+                        "vector": entry["vector"].tolist(),
+                        "chunk_ids": sorted(entry["chunk_ids"]),
+                        "answer": entry["answer"],
+                        "created": entry["created"],
+                    }
+                    for entry in self.entries.values()
+                ],
+            }
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+        with open(self.persist_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def load(self):
+        """Kayıtlı önbelleği yükler; farklı bir indeks versiyonuna aitse yok sayar."""
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("index_version") != self.index_version:
+            return
+        for entry in data.get("entries", []):
+            self.add(entry["query"], entry["vector"], entry["chunk_ids"], entry["answer"],
+                     created=entry["created"])
+        self._expire(time.time())
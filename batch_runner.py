@@ -0,0 +1,219 @@
+"""
+batch_runner.py
+JSONL dosyasındaki soruları (ör. denetim anketleri) offline cevaplar.
+
+Her satır bir soru: {"id": "Q-001", "question": "..."} ("query" alanı da
+kabul edilir, id yoksa satır numarası kullanılır). Sorular sınırlı sayıda
+eşzamanlı işçiyle async RAG motorundan geçer; retrieval'lar micro-batch ile
+yapılır, LLM istekleri isteğe bağlı olarak dakikalık hızla sınırlanır.
+Her cevap bittiği anda çıktı dosyasına bir satır olarak yazılır:
+
+    {"id", "question", "answer", "sources", "cached", "timings", "error"?}
+
+Yarıda kalan bir çalışma tekrar başlatıldığında çıktıda başarıyla cevaplanmış
+id'ler atlanır, hatalı olanlar tekrar denenir.
+
+Çalıştırma:
+    python batch_runner.py questions.jsonl --output answers.jsonl --concurrency 8 --rpm 120
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from typing import Dict, List
+import numpy as np
+from tqdm import tqdm
+from rag_engine import aquery_rag_system
+from server import MicroBatcher, BatchedRetriever, search_batch, serialize_sources
+
+STAGES = ("rate_limit", "contextualize", "retrieval_wait", "generation", "total")
+
+
+class RateLimiter:
+    """Dakikada en fazla rpm istek: istekler eşit aralıklarla başlatılır (rpm=None: sınırsız)."""
+
+    def __init__(self, rpm: float = None):
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        wait = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def read_questions(path: str) -> List[Dict]:
+    """Girdi JSONL'ini okur; her kayıt {"id", "question"} olarak döner."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_no}: invalid JSON ({e})")
+            question = (record.get("question") or record.get("query") or "").strip()
+            if not question:
+                raise ValueError(f"{path}:{line_no}: 'question' is required")
+            items.append({"id": str(record.get("id", line_no)), "question": question})
+    return items
+
+
+def completed_ids(output_path: str) -> set:
+    """
+    Çıktıda başarıyla cevaplanmış id'ler. Hatalı ve id'si olmayan satırlar
+    dosyadan atılır (tekrar denenecekleri için), yarım yazılmış son satır
+    yok sayılır.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    done, kept = set(), []
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # süreç yazarken öldürüldü
+            if not isinstance(record, dict):
+                continue
+            record_id = record.get("id")
+            if record.get("error") or record_id is None or record_id in done:
+                continue
+            done.add(record_id)
+            kept.append(line if line.endswith("\n") else line + "\n")
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(kept)
+    os.replace(tmp_path, output_path)
+    return done
+
+
+async def run_batch(items: List[Dict], output_path: str, vectorstore, llm, top_k: int = 8,
+                    answer_cache=None, token_budget: int = 6000, concurrency: int = 8, rpm: float = None,
+                    batch_window_ms: float = 5, max_batch: int = 32, resume: bool = True,
+                    progress: bool = True) -> Dict:
+    """
+    Soruları concurrency işçiyle cevaplar, sonuçları geldikçe output_path'e ekler.
+
+    Returns:
+        Özet: sayılar, süre, throughput, gecikme yüzdelikleri ve aşama ortalamaları
+    """
+    done = completed_ids(output_path) if resume else set()
+    pending = [item for item in items if item["id"] not in done]
+
+    batcher = MicroBatcher(lambda queries: search_batch(vectorstore, queries, top_k), batch_window_ms, max_batch)
+    retriever = BatchedRetriever(batcher=batcher)
+    limiter = RateLimiter(rpm)
+    queue = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+
+    results = []
+    bar = tqdm(total=len(pending), desc="Answering", unit="q", disable=not progress)
+    began = time.perf_counter()
+
+    try:
+        with open(output_path, "a" if resume else "w", encoding="utf-8") as out:
+            async def worker():
+                while not queue.empty():
+                    item = queue.get_nowait()
+                    queued = time.perf_counter()
+                    await limiter.acquire()
+                    wait = time.perf_counter() - queued
+                    result = await aquery_rag_system(vectorstore, llm, item["question"], top_k, None,
+                                                     answer_cache, token_budget, retriever=retriever)
+                    record = {"id": item["id"], "question": item["question"], "answer": result["answer"],
+                              "sources": serialize_sources(result["docs"]), "cached": result["cached"],
+                              "timings": {"rate_limit": wait, **result["timings"]}}
+                    if result.get("error") or result["answer"] is None:
+                        record["error"] = result.get("error", "no relevant documents found")
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()  # kesinti olursa bitmiş cevaplar kaybolmaz
+                    results.append(record)
+                    bar.update(1)
+
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        batcher.close()
+        bar.close()
+
+    return summarize(results, time.perf_counter() - began, total=len(items), skipped=len(done),
+                     avg_batch=batcher.stats()["avg_batch"])
+
+
+def summarize(results: List[Dict], seconds: float, total: int, skipped: int, avg_batch: float = 0.0) -> Dict:
+    """Çalışmanın throughput, gecikme ve aşama süresi özeti."""
+    answered = [r for r in results if not r.get("error")]
+    latencies = np.asarray([r["timings"].get("total", 0.0) for r in answered])
+    summary = {
+        "total": total,
+        "skipped": skipped,
+        "answered": len(answered),
+        "cached": sum(1 for r in answered if r["cached"]),
+        "failed": len(results) - len(answered),
+        "seconds": seconds,
+        "throughput": len(results) / seconds if seconds else 0.0,
+        "avg_batch": avg_batch,
+    }
+    if len(latencies):
+        summary.update({"p50": float(np.percentile(latencies, 50)), "p95": float(np.percentile(latencies, 95)),
+                        "max": float(latencies.max())})
+        summary["stages"] = {stage: float(np.mean([r["timings"].get(stage, 0.0) for r in answered]))
+                             for stage in STAGES}
+    return summary
+
+
+def print_summary(summary: Dict):
+    print("\n" + "="*60)
+    print("BATCH SUMMARY:")
+    print(f"   Questions:   {summary['total']} ({summary['skipped']} already answered)")
+    print(f"   Answered:    {summary['answered']} ({summary['cached']} from cache), failed: {summary['failed']}")
+    print(f"   Time:        {summary['seconds']:.1f}s, {summary['throughput']:.2f} questions/s "
+          f"(avg retrieval batch {summary['avg_batch']:.1f})")
+    if "p50" in summary:
+        print(f"   Latency:     p50 {summary['p50']:.2f}s, p95 {summary['p95']:.2f}s, max {summary['max']:.2f}s")
+        print("   Stages:      " + ", ".join(f"{stage} {seconds:.2f}s"
+                                             for stage, seconds in summary["stages"].items()))
+    print("="*60)
+
+
+def main(argv: list = None):
+    from config import CONTEXT_TOKEN_BUDGET, BATCH_CONCURRENCY, BATCH_RATE_LIMIT_RPM, BATCH_WINDOW_MS, BATCH_MAX_SIZE
+    from config import RETRIEVAL_MODE, HYBRID_TOP_K, TOP_K
+    from main import BackgroundLoader, save_caches
+
+    parser = argparse.ArgumentParser(description="Answer questions from a JSONL file with the RAG pipeline.")
+    parser.add_argument("input", help="JSONL with one {'id', 'question'} per line")
+    parser.add_argument("--output", help="Output JSONL (default: <input>.answers.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Concurrent LLM requests")
+    parser.add_argument("--rpm", type=float, default=BATCH_RATE_LIMIT_RPM, help="Max LLM requests per minute")
+    parser.add_argument("--restart", action="store_true", help="Ignore existing output and start over")
+    args = parser.parse_args(argv)
+
+    items = read_questions(args.input)
+    output = args.output or os.path.splitext(args.input)[0] + ".answers.jsonl"
+
+    loader = BackgroundLoader()
+    loader.start()
+    runtime = loader.wait()
+
+    summary = asyncio.run(run_batch(
+        items, output, runtime.vectorstore, runtime.llm,
+        HYBRID_TOP_K if RETRIEVAL_MODE == "hybrid" else TOP_K, runtime.answer_cache, CONTEXT_TOKEN_BUDGET,
+        args.concurrency, args.rpm, BATCH_WINDOW_MS, BATCH_MAX_SIZE, resume=not args.restart
+    ))
+    print_summary(summary)
+    print(f"Results: {output}")
+    save_caches(runtime.vectorstore, runtime.answer_cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,916 @@
+"""
+benchmarks.py
+Sentetik veri ve sahte embedding ile offline performans ölçümleri.
+
+Kullanım:
+    python benchmarks.py build --sizes 10000 100000
+    python benchmarks.py ann --size 100000 --queries 1000
+    python benchmarks.py compress --size 50000
+    python benchmarks.py shards --size 200000 --shards 1 2 4 8 16
+    python benchmarks.py filter --size 100000 --sources 50
+    python benchmarks.py hybrid --size 5000
+    python benchmarks.py context --pages 500
+    python benchmarks.py async --llm-delay 0.5 --embed-delay 0.05
+    python benchmarks.py server --concurrency 1 4 16 64
+    python benchmarks.py retrieval --size 20000 --queries 256
+    python benchmarks.py diagram --llm-delay 4 --think 2
+    python benchmarks.py diagram-json --technologies 12 --token-delay 0.01
+"""
+
+import io
+import os
+import json
+import builtins
+import threading
+import http.client
+import zlib
+import asyncio
+import time
+import random
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+EMBEDDING_DIM = 1024  # bge-m3 boyutu
+WORDS = ("huawei cloud security iam waf csms obs gaussdb zero trust identity access "
+         "network encryption key audit compliance privacy tenant region service data "
+         "policy firewall gateway storage backup monitor threat detection").split()
+
+
+def synthetic_chunks(n: int, chunk_chars: int = 1000, seed: int = 42) -> list:
+    """embed_builder çıktısına benzeyen n adet sentetik chunk üretir."""
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        words = []
+        while sum(len(w) + 1 for w in words) < chunk_chars:
+            words.append(rng.choice(WORDS))
+        chunks.append(Document(
+            page_content=f"chunk {i} " + " ".join(words),
+            metadata={"source": f"./docs/synthetic_{i // 500}.pdf", "page": (i // 5) % 100,
+                      "start_index": (i % 5) * 800},
+        ))
+    return chunks
+
+
+def fake_embeddings() -> DeterministicFakeEmbedding:
+    """bge-m3 boyutunda deterministik sahte embedding modeli."""
+    return DeterministicFakeEmbedding(size=EMBEDDING_DIM)
+
+
+def peak_rss_mb() -> float:
+    """Bu sürecin tepe bellek kullanımı (MB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def quiet():
+    """Ölçülen fonksiyonların print/tqdm çıktısını bastırır."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def run_isolated(func, *args):
+    """Fonksiyonu ayrı bir süreçte çalıştırır; tepe RSS ölçümleri birbirini etkilemez."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(func, *args).result()
+
+
+# ===============================
+# INDEX BUILD
+# ===============================
+def _legacy_build(chunks: list, embedding_model, batch_size: int) -> FAISS:
+    """Eski yol: her batch için FAISS.from_documents + merge_from."""
+    vectorstore = None
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i:i + batch_size]
+        if vectorstore is None:
+            vectorstore = FAISS.from_documents(batch, embedding_model)
+        else:
+            vectorstore.merge_from(FAISS.from_documents(batch, embedding_model))
+    return vectorstore
+
+
+def _build_case(mode: str, n: int, batch_size: int) -> dict:
+    """Tek bir build ölçümü (ayrı süreçte çalışır)."""
+    import embed_builder
+
+    chunks = synthetic_chunks(n)
+    embedding_model = fake_embeddings()
+    base_rss = peak_rss_mb()
+
+    with tempfile.TemporaryDirectory() as tmp, quiet():
+        index_path = os.path.join(tmp, "faiss_index")
+        start = time.perf_counter()
+        if mode == "legacy":
+            vectorstore = _legacy_build(chunks, embedding_model, batch_size)
+            vectorstore.save_local(index_path)
+        else:
+            vectorstore = embed_builder.build_vector_store_with_progress(
+                chunks, index_path=index_path, batch_size=batch_size,
+                embedding_model=embedding_model
+            )
+        elapsed = time.perf_counter() - start
+
+    return {"mode": mode, "chunks": n, "seconds": elapsed,
+            "peak_rss_mb": peak_rss_mb(), "base_rss_mb": base_rss,
+            "vectors": vectorstore.index.ntotal}
+
+
+def bench_build(args):
+    """Eski merge_from yolu ile tek geçişli builder'ı karşılaştırır."""
+    print(f"{'mode':<10}{'chunks':>10}{'seconds':>12}{'peak RSS MB':>14}{'base RSS MB':>14}")
+    for n in args.sizes:
+        for mode in ("legacy", "single-pass"):
+            r = run_isolated(_build_case, mode, n, args.batch_size)
+            print(f"{r['mode']:<10}{r['chunks']:>10}{r['seconds']:>12.2f}"
+                  f"{r['peak_rss_mb']:>14.1f}{r['base_rss_mb']:>14.1f}")
+
+
+# ===============================
+# ANN INDEX TYPES
+# ===============================
+def clustered_vectors(n: int, dim: int = EMBEDDING_DIM, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    """Konu kümelerine benzeyen normalize sentetik vektörler (rastgele vektörlerden gerçekçi)."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Her sorgu için tam aramanın top-k'sından bulunanların ortalama oranı."""
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+
+
+def _timed_search(index, queries: np.ndarray, k: int):
+    start = time.perf_counter()
+    _, ids = index.search(queries, k)
+    return ids, time.perf_counter() - start
+
+
+def bench_ann(args):
+    """Flat, HNSW, IVF-Flat ve IVF-PQ için build süresi, recall@k, QPS ve indeks boyutu."""
+    import faiss
+    import embed_builder
+    from vectorstore import apply_search_params
+
+    vectors = clustered_vectors(args.size + args.queries)
+    data, queries = vectors[:args.size], vectors[args.size:]
+    k = args.k
+
+    print(f"{args.size} vectors, {args.queries} queries, recall@{k} vs flat\n")
+    print(f"{'index':<10}{'param':>14}{'build s':>10}{'size MB':>10}{'recall':>9}{'QPS':>10}")
+
+    truth = None
+    for index_type in ("flat", "hnsw", "ivf_flat", "ivf_pq"):
+        start = time.perf_counter()
+        with quiet():
+            index = embed_builder.build_index([(0, data)], len(data), index_type)
+        build_seconds = time.perf_counter() - start
+        size_mb = faiss.serialize_index(index).nbytes / 1e6
+
+        if index_type == "hnsw":
+            params = [("efSearch", value, {"ef_search": value}) for value in args.ef_search]
+        elif index_type.startswith("ivf"):
+            params = [("nprobe", value, {"nprobe": value}) for value in args.nprobe]
+        else:
+            params = [("-", "", {})]
+
+        for name, value, kwargs in params:
+            apply_search_params(index, **kwargs)
+            ids, seconds = _timed_search(index, queries, k)
+            if truth is None:
+                truth = ids
+            label = f"{name}={value}" if value != "" else name
+            print(f"{index_type:<10}{label:>14}{build_seconds:>10.2f}{size_mb:>10.1f}"
+                  f"{recall_at_k(ids, truth):>9.3f}{len(queries) / seconds:>10.0f}")
+
+
+# ===============================
+# COMPRESSED VECTORS + RERANK
+# ===============================
+def bench_compress(args):
+    """float32 / fp16 / int8 SQ / PQ: bellekteki indeks boyutu (1M vektör başına) ve recall@k."""
+    import faiss
+    import embed_builder
+    import compressed_index
+
+    vectors = clustered_vectors(args.size + args.queries)
+    data, queries = vectors[:args.size], vectors[args.size:]
+    k = args.k
+
+    print(f"{args.size} vectors, {args.queries} queries, recall@{k} vs float32 flat")
+    print(f"(rerank reads full vectors from a memory-mapped file: "
+          f"{EMBEDDING_DIM * 4 * 1e6 / 2**30:.2f} GiB on disk per 1M vectors)\n")
+    print(f"{'mode':<10}{'rerank':>8}{'RAM MB / 1M':>14}{'recall':>9}{'QPS':>10}")
+
+    truth = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in (None, "fp16", "sq8", "pq"):
+            vectors_file = os.path.join(tmp, compressed_index.VECTORS_FILE) if compression else None
+            with quiet():
+                index = embed_builder.build_index([(0, data)], len(data), "flat", compression, vectors_file)
+            # Kodlar vektör başına, kod kitabı (PQ/SQ eğitimi) sabit boyutta
+            code_bytes = index.sa_code_size()
+            fixed_bytes = faiss.serialize_index(index).nbytes - code_bytes * len(data)
+            ram_per_million = (code_bytes * 1e6 + fixed_bytes) / 2**20
+
+            cases = [(index, "-")]
+            if compression:
+                cases += [(compressed_index.wrap(index, tmp, factor), f"x{factor}") for factor in args.factors]
+            for searched, label in cases:
+                ids, seconds = _timed_search(searched, queries, k)
+                if truth is None:
+                    truth = ids
+                print(f"{compression or 'float32':<10}{label:>8}{ram_per_million:>14.0f}"
+                      f"{recall_at_k(ids, truth):>9.3f}{len(queries) / seconds:>10.0f}")
+
+
+# ===============================
+# SHARDED INDEX
+# ===============================
+def bench_shards(args):
+    """Aynı vektörler tek indekste ve S shard'da: tek sorgu gecikmesi ve batch QPS (seri / paralel fan-out)."""
+    import faiss
+    from sharded_index import ShardedIndex
+
+    vectors = clustered_vectors(args.size + args.queries)
+    data, queries = vectors[:args.size], vectors[args.size:]
+    k = args.k
+    single = faiss.IndexFlatL2(data.shape[1])
+    single.add(data)
+    truth = single.search(queries, k)[1]
+
+    def measure(index):
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query[None, :], k)
+        latency_ms = (time.perf_counter() - start) / len(queries) * 1000
+        ids, seconds = _timed_search(index, queries, k)
+        return latency_ms, len(queries) / seconds, recall_at_k(ids, truth)
+
+    print(f"{args.size} vectors (flat), {args.queries} queries, top-{k}, {os.cpu_count()} CPU(s), "
+          f"{faiss.omp_get_max_threads()} OpenMP thread(s)\n")
+    print(f"{'index':<12}{'workers':>8}{'query ms':>10}{'batch QPS':>11}{'recall':>8}")
+    latency_ms, qps, recall = measure(single)
+    print(f"{'single':<12}{'-':>8}{latency_ms:>10.2f}{qps:>11.0f}{recall:>8.3f}")
+    for count in args.shards:
+        shards = []
+        for part in np.array_split(data, count):
+            shard = faiss.IndexFlatL2(data.shape[1])
+            shard.add(part)
+            shards.append(shard)
+        for workers in sorted({1, count}):
+            latency_ms, qps, recall = measure(ShardedIndex(shards, workers))
+            print(f"{f'{count} shards':<12}{workers:>8}{latency_ms:>10.2f}{qps:>11.0f}{recall:>8.3f}")
+
+
+# ===============================
+# METADATA FILTER
+# ===============================
+def bench_filter(args):
+    """Global top-k + sonradan filtreleme ile IDSelector'lı filtreli arama: dönen sonuç, recall ve QPS."""
+    import faiss
+    import embed_builder
+    from metadata_filter import MetadataIndex, parse_filter, search_rows
+
+    vectors = clustered_vectors(args.size + args.queries)
+    data, queries = vectors[:args.size], vectors[args.size:]
+    k = args.k
+    # Kaynaklar ardışık satır blokları (build sırası), her kaynakta sayfa başına 4 chunk
+    per_source = args.size // args.sources
+    source = np.minimum(np.arange(args.size) // per_source, args.sources - 1).astype(np.int32)
+    page = ((np.arange(args.size) - source * per_source) // 4).astype(np.int32)
+    metadata = MetadataIndex([f"./docs/guide-{i}.pdf" for i in range(args.sources)], source, page)
+    exact = faiss.IndexFlatL2(data.shape[1])
+    exact.add(data)
+    filters = {"one source": "source:guide-7.pdf", "page range": "source:guide-7.pdf page:20-60",
+               "every 5th source": {"source": [f"guide-{i}.pdf" for i in range(0, args.sources, 5)]}}
+
+    print(f"{args.size} vectors, {args.sources} sources, {args.queries} queries, top-{k}; "
+          f"results = avg hits per query (of {k})\n")
+    print(f"{'index':<10}{'filter':<18}{'rows':>7}{'method':>14}{'results':>9}{'recall':>8}{'QPS':>9}")
+    for index_type in ("flat", "hnsw", "ivf_flat"):
+        with quiet():
+            index = embed_builder.build_index([(0, data)], len(data), index_type)
+        if index_type == "ivf_flat":
+            faiss.extract_index_ivf(index).nprobe = 16
+        for label, spec in filters.items():
+            rows = metadata.select(parse_filter(spec))
+            allowed = np.zeros(args.size, dtype=bool)
+            allowed[rows] = True
+            truth = search_rows(exact, queries, k, rows)[1]
+
+            cases = [(f"post x{factor}", lambda factor=factor: index.search(queries, k * factor)[1])
+                     for factor in (1, 10)]
+            cases.append(("selector", lambda: search_rows(index, queries, k, rows)[1]))
+            for method, run in cases:
+                start = time.perf_counter()
+                found = run()
+                seconds = time.perf_counter() - start
+                kept = [[row for row in hits if row >= 0 and allowed[row]][:k] for hits in found]
+                results = np.mean([len(hits) for hits in kept])
+                recall = np.mean([len(set(hits) & set(t)) / k for hits, t in zip(kept, truth)])
+                print(f"{index_type:<10}{label:<18}{len(rows):>7}{method:>14}{results:>9.1f}"
+                      f"{recall:>8.3f}{len(queries) / seconds:>9.0f}")
+
+
+# ===============================
+# HYBRID (BM25 + DENSE) RETRIEVAL
+# ===============================
+class HashedBagOfWordsEmbedding(Embeddings):
+    """
+    Kelime başına sabit rastgele vektörlerin toplamı. Ortak konu kelimeleri
+    benzerliği belirler, metinde bir kez geçen ürün kodu sinyali zayıftır;
+    gerçek dense modellerin kısaltma / ürün adı zaafını taklit eder.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.words = {}
+
+    def _word(self, word: str) -> np.ndarray:
+        if word not in self.words:
+            rng = np.random.default_rng(zlib.crc32(word.encode("utf-8")))
+            self.words[word] = rng.standard_normal(self.dim).astype(np.float32)
+        return self.words[word]
+
+    def embed_query(self, text: str) -> list:
+        vector = np.sum([self._word(w) for w in text.casefold().split()], axis=0)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self.embed_query(text) for text in texts]
+
+
+def product_corpus(n: int, topics: int = 25, products_per_topic: int = 10, seed: int = 7):
+    """
+    Konulara ayrılmış sentetik chunk'lar; her chunk bir ürün kodunu bir kez anar.
+    Sorgular konu kelimeleri + ürün kodundan oluşur, ilgili chunk'lar o kodu içerenlerdir.
+    """
+    rng = random.Random(seed)
+    vocab = [f"{a}{b}" for a in WORDS for b in ("", "s", "ing", "ed")]
+    topic_words = [rng.sample(vocab, 8) for _ in range(topics)]
+    codes = [f"{rng.choice('ABCDEFGHKMPRSTW')}{rng.choice('ABCDEFGHKMPRSTW')}{i:03d}"
+             for i in range(topics * products_per_topic)]
+
+    chunks = []
+    for i in range(n):
+        product = rng.randrange(len(codes))
+        topic = product // products_per_topic
+        words = [rng.choice(topic_words[topic]) if rng.random() < 0.6 else rng.choice(vocab)
+                 for _ in range(150)]
+        words.insert(rng.randrange(len(words)), codes[product])
+        chunks.append(Document(page_content=" ".join(words),
+                               metadata={"source": f"./docs/topic_{topic}.pdf", "page": i, "start_index": 0,
+                                         "product": codes[product]}))
+
+    queries = []
+    for _ in range(200):
+        product = rng.randrange(len(codes))
+        words = rng.sample(topic_words[product // products_per_topic], 5)
+        queries.append((" ".join(words + [codes[product]]), codes[product]))
+    return chunks, queries
+
+
+def bench_hybrid(args):
+    """Dense top-20 ile hybrid top-6/8: ilgili chunk bulma oranı, prompt token'ı ve arama süresi."""
+    import embed_builder
+    import bm25_index
+    from vectorstore import get_retriever
+    from llm_utils import create_rag_prompt, count_tokens
+
+    chunks, queries = product_corpus(args.size)
+    embedding_model = HashedBagOfWordsEmbedding()
+
+    with tempfile.TemporaryDirectory() as tmp, quiet():
+        index_path = os.path.join(tmp, "faiss_index")
+        vectorstore = embed_builder.build_vector_store_with_progress(
+            chunks, index_path=index_path, batch_size=256, embedding_model=embedding_model,
+            index_type="flat", compression=None, docstore_format="pickle"
+        )
+        bm25 = bm25_index.BM25Index.load(index_path)
+
+    print(f"{args.size} chunks, {len(queries)} queries (topic words + product code)\n")
+    print(f"{'retriever':<10}{'k':>4}{'hit@k':>8}{'precision':>11}{'prompt tok':>12}{'ms/query':>10}")
+
+    for mode, k in [("dense", 20), ("dense", 8), ("hybrid", 8), ("hybrid", 6)]:
+        vectorstore.bm25_index = bm25 if mode == "hybrid" else None
+        retriever = get_retriever(vectorstore, k)
+        hits, precision, tokens, seconds = 0, 0.0, 0, 0.0
+        for query, product in queries:
+            start = time.perf_counter()
+            docs = retriever.invoke(query)
+            seconds += time.perf_counter() - start
+            relevant = sum(doc.metadata["product"] == product for doc in docs)
+            hits += relevant > 0
+            precision += relevant / k
+            context = "\n\n---\n\n".join(f"[Document {i+1}]\n{doc.page_content}" for i, doc in enumerate(docs))
+            tokens += count_tokens(create_rag_prompt(context, query))
+        n = len(queries)
+        print(f"{mode:<10}{k:>4}{hits / n:>8.3f}{precision / n:>11.3f}{tokens / n:>12.0f}{seconds / n * 1000:>10.2f}")
+
+
+# ===============================
+# CONTEXT PACKING
+# ===============================
+def overlapping_chunks(pages: int, seed: int = 11) -> list:
+    """
+    Sentetik PDF sayfaları embed_builder.create_chunks ile bölünür (CHUNK_OVERLAP
+    tekrarları gerçek splitter'dan gelir). Sayfaların ~%10'u başka bir PDF'te
+    aynen tekrar eder (kopyalanmış SSS cevapları gibi).
+    """
+    import embed_builder
+
+    rng = random.Random(seed)
+    docs = []
+    for i in range(pages):
+        if docs and rng.random() < 0.1:
+            original = rng.choice(docs)
+            docs.append(Document(page_content=original.page_content,
+                                 metadata={"source": f"./docs/copy_{i}.pdf", "page": 0}))
+            continue
+        topic = rng.sample(WORDS, 8)
+        sentences = [" ".join(rng.choice(topic) for _ in range(12)).capitalize() + "." for _ in range(45)]
+        docs.append(Document(page_content=" ".join(sentences),
+                             metadata={"source": f"./docs/manual_{i // 50}.pdf", "page": i % 50}))
+    with quiet():
+        return embed_builder.create_chunks(docs)
+
+
+def bench_context(args):
+    """Retriever çıktısını düz birleştirme ile context_packer'ı token ve süre olarak karşılaştırır."""
+    import embed_builder
+    from context_packer import pack_context, SEPARATOR, format_block
+    from llm_utils import count_tokens
+
+    chunks = overlapping_chunks(args.pages)
+    embedding_model = HashedBagOfWordsEmbedding()
+    with tempfile.TemporaryDirectory() as tmp, quiet():
+        vectorstore = embed_builder.build_vector_store_with_progress(
+            chunks, index_path=os.path.join(tmp, "faiss_index"), batch_size=256,
+            embedding_model=embedding_model, index_type="flat", compression=None,
+            docstore_format="pickle"
+        )
+
+    rng = random.Random(3)
+    queries = [" ".join(rng.sample(WORDS, 6)) for _ in range(args.queries)]
+    retriever = vectorstore.as_retriever(search_kwargs={"k": args.k})
+    results = [retriever.invoke(query) for query in queries]
+
+    print(f"{len(chunks)} chunks from {args.pages} pages, {len(queries)} queries, top-{args.k}\n")
+    print(f"{'context':<16}{'tokens':>8}{'passages':>10}{'merged':>8}{'dups':>6}{'ms':>8}")
+
+    naive = [count_tokens(SEPARATOR.join(format_block(i + 1, d) for i, d in enumerate(docs)))
+             for docs in results]
+    print(f"{'verbatim':<16}{np.mean(naive):>8.0f}{args.k:>10}{0:>8}{0:>6}{0:>8.2f}")
+
+    for budget in args.budgets:
+        stats, seconds = [], 0.0
+        for docs in results:
+            start = time.perf_counter()
+            stats.append(pack_context(docs, budget)[2])
+            seconds += time.perf_counter() - start
+        label = f"packed/{budget or 'inf'}"
+        print(f"{label:<16}{np.mean([s['tokens'] for s in stats]):>8.0f}"
+              f"{np.mean([s['spans'] for s in stats]):>10.1f}{np.mean([s['merged'] for s in stats]):>8.1f}"
+              f"{np.mean([s['duplicates'] for s in stats]):>6.1f}{seconds / len(results) * 1000:>8.2f}")
+
+
+# ===============================
+# ASYNC RAG ENGINE
+# ===============================
+class DelayedStubLLM(BaseChatModel):
+    """
+    Sabit gecikmeli sahte LLM. Bağlam kontrolü prompt'una rewrite boşsa
+    UNRELATED, değilse RELATED + rewrite döndürür; diğer prompt'lara sabit cevap.
+    """
+
+    delay: float = 0.5
+    rewrite: str = ""
+
+    @property
+    def _llm_type(self) -> str:
+        return "delayed-stub"
+
+    def _reply(self, messages) -> ChatResult:
+        if "STANDALONE_QUERY" in messages[-1].content:
+            text = (f"STATUS: RELATED\nSTANDALONE_QUERY: {self.rewrite}" if self.rewrite
+                    else "STATUS: UNRELATED\nSTANDALONE_QUERY:")
+        else:
+            text = "stub answer"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.delay)
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.delay)
+        return self._reply(messages)
+
+
+class DelayedEmbedding(Embeddings):
+    """Sorgu embedding'ine CPU'da çalışan model süresi kadar gecikme ekler."""
+
+    def __init__(self, embeddings: Embeddings, delay: float):
+        self.embeddings = embeddings
+        self.delay = delay
+
+    def embed_query(self, text: str) -> list:
+        time.sleep(self.delay)
+        return self.embeddings.embed_query(text)
+
+    def embed_documents(self, texts: list) -> list:
+        return self.embeddings.embed_documents(texts)
+
+
+def bench_async(args):
+    """Sync query_rag_system ile aquery_rag_system: takip sorusu gecikmesi ve eşzamanlı oturumlar."""
+    from chat_history import ChatHistory
+    from rag_engine import query_rag_system, aquery_rag_system
+
+    chunks = synthetic_chunks(2000)
+    vectorstore = FAISS.from_documents(chunks, fake_embeddings())
+    vectorstore.embedding_function = DelayedEmbedding(fake_embeddings(), args.embed_delay)
+
+    def session(llm):
+        history = ChatHistory(llm)
+        history.add_exchange("What is IAM?", "IAM manages identities.")
+        return history
+
+    def run_sync(llm, queries):
+        start = time.perf_counter()
+        with quiet():
+            for query in queries:
+                query_rag_system(vectorstore, llm, query, 8, session(llm))
+        return time.perf_counter() - start
+
+    def run_async(llm, queries):
+        async def run():
+            await asyncio.gather(*(aquery_rag_system(vectorstore, llm, query, 8, session(llm))
+                                   for query in queries))
+        start = time.perf_counter()
+        asyncio.run(run())
+        return time.perf_counter() - start
+
+    print(f"LLM delay {args.llm_delay:.2f}s, query embedding delay {args.embed_delay:.2f}s\n")
+    print(f"{'scenario':<34}{'sync s':>9}{'async s':>9}{'saved':>8}")
+    scenarios = [
+        ("follow-up, unrelated (1 query)", "", 1),
+        ("follow-up, rewritten (1 query)", "How do IAM user groups work?", 1),
+        (f"{args.sessions} concurrent sessions", "", args.sessions),
+    ]
+    for label, rewrite, sessions in scenarios:
+        llm = DelayedStubLLM(delay=args.llm_delay, rewrite=rewrite)
+        queries = [f"What about user groups {i}?" for i in range(sessions)]
+        sync_seconds = run_sync(llm, queries)
+        async_seconds = run_async(llm, queries)
+        print(f"{label:<34}{sync_seconds:>9.2f}{async_seconds:>9.2f}{1 - async_seconds / sync_seconds:>8.0%}")
+
+
+# ===============================
+# HTTP SERVER / MICRO-BATCHING
+# ===============================
+class BatchCostEmbedding(Embeddings):
+    """
+    CPU'daki embedding modelinin maliyet modeli: her çağrıda sabit bir
+    forward-pass gecikmesi + metin başına küçük bir ek süre.
+    """
+
+    def __init__(self, embeddings: Embeddings, call_delay: float, item_delay: float):
+        self.embeddings = embeddings
+        self.call_delay = call_delay
+        self.item_delay = item_delay
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts: list) -> list:
+        time.sleep(self.call_delay + self.item_delay * len(texts))
+        return self.embeddings.embed_documents(texts)
+
+
+def _post(conn, path: str, payload: dict) -> dict:
+    conn.request("POST", path, json.dumps(payload), {"Content-Type": "application/json"})
+    return json.loads(conn.getresponse().read())
+
+
+def _load_test(port: int, path: str, clients: int, per_client: int) -> tuple:
+    """clients adet eşzamanlı istemci; toplam süre ve istek gecikmeleri."""
+    latencies = []
+    lock = threading.Lock()
+
+    def client(c):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        for i in range(per_client):
+            began = time.perf_counter()
+            _post(conn, path, {"session": f"s{c}", "query": f"{WORDS[(c + i) % len(WORDS)]} policy question {c}-{i}"})
+            with lock:
+                latencies.append(time.perf_counter() - began)
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, np.asarray(latencies)
+
+
+def bench_server(args):
+    """HTTP sunucusu: eşzamanlılık seviyelerine göre throughput, batch'li ve batch'siz."""
+    from server import RAGService, create_server
+
+    chunks = synthetic_chunks(args.chunks)
+    vectorstore = FAISS.from_documents(chunks, fake_embeddings())
+    vectorstore.embedding_function = BatchCostEmbedding(fake_embeddings(), args.embed_call, args.embed_item)
+    llm = DelayedStubLLM(delay=args.llm_delay)
+
+    print(f"Embedding: {args.embed_call * 1000:.0f} ms/call + {args.embed_item * 1000:.1f} ms/query, "
+          f"LLM delay {args.llm_delay:.2f}s, batch window {args.window_ms:g} ms\n")
+    print(f"{'endpoint':<11}{'clients':>8}{'batching':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'avg batch':>11}")
+    for path in ("/retrieve", "/query"):
+        for clients in args.concurrency:
+            for label, max_batch in (("off", 1), ("on", args.max_batch)):
+                service = RAGService(vectorstore, llm, top_k=8, batch_window_ms=args.window_ms, max_batch=max_batch)
+                server = create_server(service, port=0)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                per_client = max(1, args.requests // clients)
+                seconds, latencies = _load_test(server.server_address[1], path, clients, per_client)
+                server.shutdown()
+                server.server_close()
+                service.close()
+                print(f"{path:<11}{clients:>8}{label:>10}{len(latencies) / seconds:>9.1f}"
+                      f"{np.percentile(latencies, 50) * 1000:>9.0f}{np.percentile(latencies, 95) * 1000:>9.0f}"
+                      f"{service.batcher.stats()['avg_batch']:>11.1f}")
+
+
+def bench_retrieval(args):
+    """retrieve_batch ile sorgu başına get_retriever(...).invoke döngüsü (dense ve hybrid)."""
+    from bm25_index import BM25Index
+    from rag_engine import retrieve_batch
+    from vectorstore import get_retriever
+
+    chunks = synthetic_chunks(args.size)
+    with quiet():
+        vectorstore = FAISS.from_documents(chunks, fake_embeddings())
+    bm25 = BM25Index.from_vectorstore(vectorstore)
+    rng = random.Random(5)
+    queries = [" ".join(rng.sample(WORDS, 6)) for _ in range(args.queries)]
+    models = [("no model cost", fake_embeddings()),
+              (f"{args.embed_call * 1000:.0f}+{args.embed_item * 1000:.0f}ms model",
+               BatchCostEmbedding(fake_embeddings(), args.embed_call, args.embed_item))]
+
+    print(f"{args.size} chunks, {args.queries} queries, top-{args.k}\n")
+    print(f"{'mode':<8}{'embedding':<18}{'loop q/s':>10}{'batch q/s':>11}{'speedup':>9}")
+    for mode in ("dense", "hybrid"):
+        vectorstore.bm25_index = bm25 if mode == "hybrid" else None
+        for label, model in models:
+            vectorstore.embedding_function = model
+            start = time.perf_counter()
+            looped = [get_retriever(vectorstore, args.k).invoke(query) for query in queries]
+            loop_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            batched = [hits for i in range(0, len(queries), args.batch_size)
+                       for hits in retrieve_batch(vectorstore, queries[i:i + args.batch_size], args.k)]
+            batch_seconds = time.perf_counter() - start
+
+            assert [[d.page_content for d in docs] for docs in looped] == \
+                   [[d.page_content for d, _ in hits] for hits in batched]
+            print(f"{mode:<8}{label:<18}{len(queries) / loop_seconds:>10.0f}"
+                  f"{len(queries) / batch_seconds:>11.0f}{loop_seconds / batch_seconds:>8.1f}x")
+
+
+# ===============================
+# @DIAGRAM SPECULATION
+# ===============================
+class CountingStubLLM(DelayedStubLLM):
+    """Çağrı sayısını tutan DelayedStubLLM (tahmini çağrılar dahil)."""
+
+    calls: int = 0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+
+def bench_diagram(args):
+    """@diagram diyaloğunda son cevaptan sonraki bekleme: tahmin kapalı / açık."""
+    from diagram_handler import handle_diagram_query
+
+    chunks = synthetic_chunks(args.chunks)
+    with quiet():
+        vectorstore = FAISS.from_documents(chunks, fake_embeddings())
+    vectorstore.embedding_function = DelayedEmbedding(fake_embeddings(), args.embed_delay)
+
+    scenarios = [
+        ("all defaults", [""] * 6),
+        ("first answer changed", ["iot-platform"] + [""] * 5),
+        ("last answer changed", [""] * 5 + ["mission-critical"]),
+        ("every answer changed", ["iot-platform", "real-time-stream", "large-100k", "data-privacy-gdpr",
+                                  "high-performance", "high-availability"]),
+    ]
+    print(f"LLM delay {args.llm_delay:.1f}s, embedding delay {args.embed_delay:.2f}s, "
+          f"user think time {args.think:.1f}s per question\n")
+    print(f"{'scenario':<22}{'speculation':>12}{'wait s':>9}{'LLM calls':>11}")
+    original_input = builtins.input
+    try:
+        for label, answers in scenarios:
+            for speculative in (False, True):
+                script = iter(answers)
+                answered = {}
+
+                def scripted_input(prompt=""):
+                    time.sleep(args.think)
+                    answered["at"] = time.perf_counter()
+                    return next(script)
+
+                builtins.input = scripted_input
+                llm = CountingStubLLM(delay=args.llm_delay)
+                with quiet():
+                    handle_diagram_query("@diagram mobile app deployment", vectorstore, llm, args.k,
+                                         speculative, args.generations)
+                wait = time.perf_counter() - answered["at"]
+                print(f"{label:<22}{'on' if speculative else 'off':>12}{wait:>9.2f}{llm.calls:>11}")
+    finally:
+        builtins.input = original_input
+
+
+class ScriptedStreamLLM(BaseChatModel):
+    """Sırayla verilen cevapları token (4 karakter) başına sabit gecikmeyle üreten sahte LLM."""
+
+    outputs: list
+    token_delay: float = 0.01
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-stream"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self.outputs.pop(0)
+        time.sleep(self.token_delay * len(text) / 4)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.outputs.pop(0)
+        for i in range(0, len(text), 4):
+            time.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + 4]))
+
+
+def diagram_json(technologies: int, broken: str = None) -> str:
+    """Sentetik diyagram JSON'u; broken ile ilk technology / son relationship bozulur ya da başa metin eklenir."""
+    techs = [{"name": f"Service {i}", "category": "Compute", "description": "Runs the mobile backend " * 3,
+              "node_id": i, "node_label": f"Service {i}"} for i in range(1, technologies + 1)]
+    rels = [{"from": f"Service {i}", "to": f"Service {i + 1}", "type": "HTTPS"} for i in range(1, technologies)]
+    if broken == "first_technology":
+        del techs[0]["category"]
+    elif broken == "last_relationship":
+        rels[-1] = {"source": rels[-1]["from"], "to": rels[-1]["to"], "type": "HTTPS"}
+    text = json.dumps({"technologies": techs, "relationships": rels, "explanation": "Generated."}, indent=2)
+    return "Here is the architecture diagram:\n" + text if broken == "preamble" else text
+
+
+def bench_diagram_json(args):
+    """Şemadan sapan diyagram çıktısı: tam cevap + strict parse ile akış halinde doğrulama + erken kesme."""
+    from diagram_chat import invoke_llm_json, parse_json_strict, validate_payload, stream_llm_json
+
+    valid = diagram_json(args.technologies)
+    print(f"{args.technologies} technologies, {len(valid) // 4} tokens per diagram, "
+          f"{args.token_delay * 1000:.0f} ms per token\n")
+    print(f"{'first output':<20}{'mode':<10}{'failure s':>11}{'valid s':>9}{'attempts':>10}")
+    for broken in ("valid", "preamble", "first_technology", "last_relationship"):
+        first = diagram_json(args.technologies, None if broken == "valid" else broken)
+
+        llm = ScriptedStreamLLM(outputs=[first], token_delay=args.token_delay)
+        start = time.perf_counter()
+        raw = invoke_llm_json(llm, "PROMPT")
+        seconds = time.perf_counter() - start
+        try:
+            ok = validate_payload(parse_json_strict(raw))[0]
+        except ValueError:
+            ok = False
+        failure, valid_seconds = ("-", f"{seconds:.2f}") if ok else (f"{seconds:.2f}", "-")
+        print(f"{broken:<20}{'full':<10}{failure:>11}{valid_seconds:>9}{1:>10}")
+
+        llm = ScriptedStreamLLM(outputs=[first, valid], token_delay=args.token_delay)
+        start = time.perf_counter()
+        raw, info = stream_llm_json(llm, "PROMPT", max_attempts=3)
+        seconds = time.perf_counter() - start
+        # kesilen denemenin süresi: üretilen token sayısı x token gecikmesi
+        failure = f"{info['aborted_chars'] / 4 * args.token_delay:.2f}" if info["aborted"] else "-"
+        print(f"{broken:<20}{'streaming':<10}{failure:>11}{seconds:>9.2f}{info['attempts']:>10}")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Offline RAG performance benchmarks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="Index build time and peak RSS (legacy vs single-pass)")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    p.add_argument("--batch-size", type=int, default=16)
+    p.set_defaults(func=bench_build)
+
+    p = sub.add_parser("ann", help="Recall@k and QPS of ANN index types vs flat")
+    p.add_argument("--size", type=int, default=100000)
+    p.add_argument("--queries", type=int, default=1000)
+    p.add_argument("--k", type=int, default=20, help="Top-k (config.TOP_K)")
+    p.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128, 256])
+    p.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    p.set_defaults(func=bench_ann)
+
+    p = sub.add_parser("compress", help="Memory per 1M vectors and recall@k of compressed modes")
+    p.add_argument("--size", type=int, default=50000)
+    p.add_argument("--queries", type=int, default=500)
+    p.add_argument("--k", type=int, default=20, help="Top-k (config.TOP_K)")
+    p.add_argument("--factors", type=int, nargs="+", default=[2, 4, 8], help="Rerank candidate multipliers")
+    p.set_defaults(func=bench_compress)
+
+    p = sub.add_parser("shards", help="Query latency of one index vs N shards with parallel fan-out")
+    p.add_argument("--size", type=int, default=200000)
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=20, help="Top-k (config.TOP_K)")
+    p.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("filter", help="source/page filters: post-filtering global top-k vs FAISS ID selectors")
+    p.add_argument("--size", type=int, default=100000)
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--sources", type=int, default=50)
+    p.add_argument("--k", type=int, default=20, help="Top-k (config.TOP_K)")
+    p.set_defaults(func=bench_filter)
+
+    p = sub.add_parser("hybrid", help="Dense top-20 vs hybrid BM25+dense at k=6/8")
+    p.add_argument("--size", type=int, default=5000)
+    p.set_defaults(func=bench_hybrid)
+
+    p = sub.add_parser("context", help="Prompt tokens: verbatim chunks vs merged/deduplicated/budgeted context")
+    p.add_argument("--pages", type=int, default=500)
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--k", type=int, default=20)
+    p.add_argument("--budgets", type=int, nargs="+", default=[0, 6000, 3000], help="0: no budget")
+    p.set_defaults(func=bench_context)
+
+    p = sub.add_parser("async", help="Sync vs async RAG engine latency with a delayed stub LLM")
+    p.add_argument("--llm-delay", type=float, default=0.5)
+    p.add_argument("--embed-delay", type=float, default=0.05)
+    p.add_argument("--sessions", type=int, default=16)
+    p.set_defaults(func=bench_async)
+
+    p = sub.add_parser("server", help="HTTP server throughput vs concurrency, with and without micro-batching")
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    p.add_argument("--requests", type=int, default=256, help="Requests per run")
+    p.add_argument("--chunks", type=int, default=2000)
+    p.add_argument("--embed-call", type=float, default=0.03, help="Embedding seconds per model call")
+    p.add_argument("--embed-item", type=float, default=0.002, help="Embedding seconds per query")
+    p.add_argument("--llm-delay", type=float, default=0.2)
+    p.add_argument("--window-ms", type=float, default=5)
+    p.add_argument("--max-batch", type=int, default=32)
+    p.set_defaults(func=bench_server)
+
+    p = sub.add_parser("retrieval", help="Batch retrieval API vs looping retriever.invoke")
+    p.add_argument("--size", type=int, default=20000)
+    p.add_argument("--queries", type=int, default=256)
+    p.add_argument("--k", type=int, default=20)
+    p.add_argument("--batch-size", type=int, default=64)
+    p.add_argument("--embed-call", type=float, default=0.03, help="Embedding seconds per model call")
+    p.add_argument("--embed-item", type=float, default=0.002, help="Embedding seconds per query")
+    p.set_defaults(func=bench_retrieval)
+
+    p = sub.add_parser("diagram", help="Wait after the last @diagram answer, with and without speculation")
+    p.add_argument("--llm-delay", type=float, default=4.0, help="Diagram LLM call seconds")
+    p.add_argument("--embed-delay", type=float, default=0.05)
+    p.add_argument("--think", type=float, default=2.0, help="User seconds per clarification question")
+    p.add_argument("--chunks", type=int, default=2000)
+    p.add_argument("--k", type=int, default=20)
+    p.add_argument("--generations", type=int, default=2, help="Speculative LLM calls per dialog")
+    p.set_defaults(func=bench_diagram)
+
+    p = sub.add_parser("diagram-json", help="Off-schema diagram output: full completion vs streaming validation")
+    p.add_argument("--technologies", type=int, default=12)
+    p.add_argument("--token-delay", type=float, default=0.01, help="Seconds per generated token")
+    p.set_defaults(func=bench_diagram_json)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+bm25_index.py
+FAISS indeksinin yanında tutulan BM25 ters indeksi (kelime eşleşmesi ile arama).
+
+Dense arama "CSMS", "IAM", "WAF" gibi ürün adlarını ve kısaltmaları her zaman
+üst sıralara taşıyamaz; BM25 bu tam eşleşmeleri yakalar. Satır numaraları
+FAISS satırlarıyla aynıdır, böylece iki sonuç listesi doğrudan birleştirilebilir.
+
+Dosyalar (indeks klasöründe):
+    bm25.json         - kelime listesi ve parametreler
+    bm25.offsets.npy  - her kelimenin posting listesi başlangıcı (CSR, int64)
+    bm25.rows.npy     - posting satırları (int32)
+    bm25.tf.npy       - kelimenin satırdaki tekrar sayısı (uint16)
+    bm25.doclen.npy   - satır başına kelime sayısı (int32)
+"""
+
+import os
+import re
+import json
+import numpy as np
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+PREFIX = "bm25"
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Küçük harfe çevirip harf/rakam dizilerine böler."""
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+def _path(folder: str, suffix: str) -> str:
+    return os.path.join(folder, f"{PREFIX}.{suffix}")
+
+
+def exists(folder: str) -> bool:
+    """Klasörde BM25 indeksi var mı?"""
+    return os.path.exists(_path(folder, "json"))
+
+
+def remove(folder: str):
+    """Klasördeki BM25 indeksi dosyalarını siler."""
+    for name in os.listdir(folder):
+        if name.startswith(PREFIX + "."):
+            os.remove(os.path.join(folder, name))
+
+
+class BM25Index:
+    """
+    CSR formatında BM25 ters indeksi (Okapi BM25, k1 / b parametreleri).
+
+    Kayıtlı indeks mmap ile açılır; arama sadece sorgudaki kelimelerin
+    posting listelerini okur.
+    """
+
+    def __init__(self, vocab: List[str], offsets: np.ndarray, rows: np.ndarray, tf: np.ndarray,
+                 doclen: np.ndarray, k1: float = 1.5, b: float = 0.75):
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab)}
+        self.offsets = offsets
+        self.rows = rows
+        self.tf = tf
+        self.doclen = doclen
+        self.k1 = k1
+        self.b = b
+        self.count = len(doclen)
+        self.avgdl = float(doclen.mean()) if self.count else 0.0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """Metinleri (FAISS satır sırasıyla) tokenize edip ters indeksi kurar."""
+        term_ids = {}
+        post_terms, post_rows, post_tf, doclen = [], [], [], []
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doclen.append(sum(counts.values()))
+            for term, tf in counts.items():
+                post_terms.append(term_ids.setdefault(term, len(term_ids)))
+                post_rows.append(row)
+                post_tf.append(min(tf, np.iinfo(np.uint16).max))
+
+        post_terms = np.asarray(post_terms, dtype=np.int64)
+        order = np.argsort(post_terms, kind="stable")  # kelimeye göre grupla, satır sırası korunur
+        offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(post_terms, minlength=len(term_ids)), out=offsets[1:])
+
+        vocab = [None] * len(term_ids)
+        for term, i in term_ids.items():
+            vocab[i] = term
+        return cls(vocab, offsets,
+                   np.asarray(post_rows, dtype=np.int32)[order],
+                   np.asarray(post_tf, dtype=np.uint16)[order],
+                   np.asarray(doclen, dtype=np.int32), k1, b)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore, **kwargs) -> "BM25Index":
+        """Vektör deposundaki chunk'lardan FAISS satır sırasıyla indeks kurar."""
+        mapping = vectorstore.index_to_docstore_id
+        texts = (vectorstore.docstore.search(mapping[row]).page_content for row in range(len(mapping)))
+        return cls.from_texts(texts, **kwargs)
+
+    @classmethod
+    def merge(cls, indexes: List["BM25Index"]) -> "BM25Index":
+        """
+        Shard indekslerini satırları art arda gelecek şekilde birleştirir;
+        idf ve ortalama uzunluk tüm shard'lar üzerinden hesaplanır.
+        """
+        term_ids = {}
+        post_terms, post_rows, post_tf = [], [], []
+        offset = 0
+        for index in indexes:
+            global_ids = np.asarray([term_ids.setdefault(term, len(term_ids)) for term in index.vocab],
+                                    dtype=np.int64)
+            post_terms.append(np.repeat(global_ids, np.diff(np.asarray(index.offsets))))
+            post_rows.append(np.asarray(index.rows, dtype=np.int64) + offset)
+            post_tf.append(np.asarray(index.tf))
+            offset += index.count
+
+        post_terms = np.concatenate(post_terms)
+        order = np.argsort(post_terms, kind="stable")  # kelime içinde shard ve satır sırası korunur
+        offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(post_terms, minlength=len(term_ids)), out=offsets[1:])
+        return cls(list(term_ids), offsets,
+                   np.concatenate(post_rows)[order].astype(np.int32),
+                   np.concatenate(post_tf)[order].astype(np.uint16),
+                   np.concatenate([np.asarray(index.doclen) for index in indexes]).astype(np.int32),
+                   indexes[0].k1, indexes[0].b)
+
+    def save(self, folder: str):
+        """İndeksi .npy dosyaları ve küçük bir JSON olarak yazar."""
+        os.makedirs(folder, exist_ok=True)
+        np.save(_path(folder, "offsets.npy"), self.offsets)
+        np.save(_path(folder, "rows.npy"), self.rows)
+        np.save(_path(folder, "tf.npy"), self.tf)
+        np.save(_path(folder, "doclen.npy"), self.doclen)
+        with open(_path(folder, "json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocab": self.vocab}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, folder: str) -> "BM25Index":
+        """Kayıtlı indeksi açar; posting dizileri memory-mapped okunur."""
+        with open(_path(folder, "json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+
+        def load(suffix):
+            return np.load(_path(folder, suffix), mmap_mode="r")
+
+        return cls(info["vocab"], load("offsets.npy"), load("rows.npy"), load("tf.npy"),
+                   load("doclen.npy"), info["k1"], info["b"])
+
+    def scores(self, query: str) -> np.ndarray:
+        """Sorgu için tüm satırların BM25 skorları."""
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            rows = np.asarray(self.rows[lo:hi])
+            tf = np.asarray(self.tf[lo:hi], dtype=np.float32)
+            df = hi - lo
+            idf = np.log(1 + (self.count - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doclen[rows] / self.avgdl)
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, k: int, rows: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        En yüksek skorlu k satırı (skoru 0 olanlar hariç) ve skorlarını döndürür.
+        rows (sıralı satırlar) verilirse sadece bu satırlar arasından seçer.
+        """
+        scores = self.scores(query)
+        if rows is not None:
+            candidates, scores = np.asarray(rows, dtype=np.int64), scores[rows]
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] > 0]
+        return (candidates[top] if rows is not None else top), scores[top]
@@ -3,17 +3,48 @@ chat_history.py
 Chat history management and context analysis.
 """
 
+import re
+import asyncio
+import numpy as np
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
 from langchain_openai import ChatOpenAI
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
+import telemetry
+
+# Önceki soruya gönderme yapan kısa takip soruları ("what about its pricing?")
+# embedding benzerliği düşük olsa bile LLM'e sorulur
+REFERENCE_PATTERN = re.compile(
+    r"\b(it|its|they|them|their|this|that|these|those|there|same|above|previous|"
+    r"bu|şu|bunu|bunun|şunu|onu|onun|bunlar|onlar|aynı|önceki)\b",
+    re.IGNORECASE
+)
 
 
 class ChatHistory:
-    """Chat geçmişini yönetir ve ilişkili sorguları tespit eder."""
+    """
+    Chat geçmişini yönetir ve ilişkili sorguları tespit eder.
+    
+    embeddings verilirse ilişki kontrolü önce yerelde yapılır: sorgu
+    embedding'inin önceki soru ve cevapla benzerliği gate_low altındaysa
+    ilişkisiz, gate_high üstündeyse zaten bağımsız bir soru sayılır. LLM
+    sadece aradaki belirsiz bantta (veya zamir içeren kısa takip
+    sorularında) çağrılır; sonuçlar (önceki, şimdiki) soru çiftine göre
+    önbelleklenir.
+    """
     
-    def __init__(self, llm: ChatOpenAI, max_history: int = 5):
+    def __init__(self, llm: ChatOpenAI, max_history: int = 5, embeddings: Embeddings = None,
+                 gate_low: float = 0.45, gate_high: float = 0.85, rewrite_cache_size: int = 256):
         self.llm = llm
         self.history: List[Dict[str, str]] = []
         self.max_history = max_history
+        self.embeddings = embeddings
+        self.gate_low = gate_low
+        self.gate_high = gate_high
+        self.rewrite_cache = OrderedDict()  # (önceki soru, şimdiki soru) -> (related, standalone)
+        self.rewrite_cache_size = rewrite_cache_size
+        self.gate_counts = {"llm_calls": 0, "skipped_unrelated": 0, "skipped_standalone": 0, "cache_hits": 0}
+        self._answer_vector = (None, None)  # son cevabın (metni, vektörü)
     
     def add_exchange(self, query: str, answer: str):
         """Soru-cevap çiftini history'ye ekler."""
@@ -30,13 +61,9 @@ class ChatHistory:
             for i, h in enumerate(self.history, 1)
         )
 
-    def is_related_to_previous(self, current_query: str) -> tuple[bool, Optional[str]]:
-        """Sorgunun önceki sorguyla ilişkili olup olmadığını kontrol eder."""
-        if not self.history:
-            return False, None
-        
+    def _relatedness_prompt(self, current_query: str) -> str:
         last_query = self.history[-1]["query"] 
-        prompt = f"""
+        return f"""
 You are analyzing if two queries are related.
 
 PREVIOUS QUERY: {last_query}
@@ -46,12 +73,118 @@ Answer ONLY:
 STATUS: [RELATED/UNRELATED]
 STANDALONE_QUERY: [Rewritten query if RELATED, else empty]
 """
-        # yapay zekanın önceki sorguyla yeni sorguyu ilişkili mi diye kontrol eder.
+
+    @staticmethod
+    def _parse_relatedness(content: str) -> tuple[bool, Optional[str]]:
+        res = content.strip().splitlines()
+        status = next((l.split(":")[1].strip() for l in res if l.startswith("STATUS:")), "")
+        standalone = next((l.split(":")[1].strip() for l in res if l.startswith("STANDALONE_QUERY:")), "")
+        return (status == "RELATED", standalone or None)
+
+    @staticmethod
+    def _cosine(a, b) -> float:
+        a = np.asarray(a, dtype=np.float32)
+        b = np.asarray(b, dtype=np.float32)
+        return float(a @ b / ((np.linalg.norm(a) * np.linalg.norm(b)) or 1.0))
+
+    def similarity_to_previous(self, current_query: str) -> float:
+        """Sorgunun önceki soru ve cevapla en yüksek cosine benzerliği."""
+        last = self.history[-1]
+        query_vector = self.embeddings.embed_query(current_query)
+        previous_vector = self.embeddings.embed_query(last["query"])  # sorgu önbelleğinde hazır
+        if self._answer_vector[0] != last["answer"]:
+            self._answer_vector = (last["answer"], self.embeddings.embed_documents([last["answer"]])[0])
+        return max(self._cosine(query_vector, previous_vector),
+                   self._cosine(query_vector, self._answer_vector[1]))
+
+    def _gate(self, current_query: str, similarity: float) -> Optional[Tuple[bool, Optional[str]]]:
+        """LLM'e gerek yoksa kararı döndürür, belirsiz bantta None."""
+        if len(current_query.split()) <= 3 or REFERENCE_PATTERN.search(current_query):
+            return None  # zamirli / çok kısa takip sorusu: LLM karar versin
+        if similarity < self.gate_low:
+            self.gate_counts["skipped_unrelated"] += 1
+            return False, None
+        if similarity >= self.gate_high:
+            self.gate_counts["skipped_standalone"] += 1
+            return True, None  # konu aynı ama soru kendi başına yeterli
+        return None
+
+    def _cached_rewrite(self, key: tuple) -> Optional[Tuple[bool, Optional[str]]]:
+        if key in self.rewrite_cache:
+            self.rewrite_cache.move_to_end(key)
+            self.gate_counts["cache_hits"] += 1
+            return self.rewrite_cache[key]
+        return None
+
+    def _store_rewrite(self, key: tuple, result: Tuple[bool, Optional[str]]):
+        self.rewrite_cache[key] = result
+        while len(self.rewrite_cache) > self.rewrite_cache_size:
+            self.rewrite_cache.popitem(last=False)
+
+    def gate_stats(self) -> dict:
+        """Yerel kontrol sayesinde yapılmayan LLM çağrısı sayaçları."""
+        avoided = (self.gate_counts["skipped_unrelated"] + self.gate_counts["skipped_standalone"]
+                   + self.gate_counts["cache_hits"])
+        return {**self.gate_counts, "llm_calls_avoided": avoided}
+
+    def is_related_to_previous(self, current_query: str) -> tuple[bool, Optional[str]]:
+        """Sorgunun önceki sorguyla ilişkili olup olmadığını kontrol eder."""
+        with telemetry.span("relatedness") as span:
+            if not self.history:
+                span.set(decision="no_history")
+                return False, None
+            
+            key = (self.history[-1]["query"], current_query)
+            cached = self._cached_rewrite(key)
+            if cached is not None:
+                span.set(decision="cache")
+                return cached
+            
+            # yapay zekanın önceki sorguyla yeni sorguyu ilişkili mi diye kontrol eder.
+            try:
+                if self.embeddings is not None:
+                    with telemetry.span("relatedness.embedding") as gate_span:
+                        similarity = self.similarity_to_previous(current_query)
+                        gate_span.set(similarity=similarity)
+                    decided = self._gate(current_query, similarity)
+                    if decided is not None:
+                        span.set(decision="gate_standalone" if decided[0] else "gate_unrelated")
+                        return decided
+                self.gate_counts["llm_calls"] += 1
+                prompt = self._relatedness_prompt(current_query)
+                with telemetry.span("relatedness.llm") as llm_span:
+                    response = self.llm.invoke(prompt)
+                    if llm_span.recording:
+                        llm_span.set(**telemetry.llm_tokens(prompt, response))
+                result = self._parse_relatedness(response.content)
+                self._store_rewrite(key, result)
+                span.set(decision="llm", related=result[0])
+                return result
+            except Exception as e:
+                span.set(error=str(e))
+                return False, None
+
+    async def ais_related_to_previous(self, current_query: str) -> tuple[bool, Optional[str]]:
+        """is_related_to_previous'un async versiyonu (LLM çağrısı event loop'u bloklamaz)."""
+        if not self.history:
+            return False, None
+        
+        key = (self.history[-1]["query"], current_query)
+        cached = self._cached_rewrite(key)
+        if cached is not None:
+            return cached
+        
         try:
-            res = self.llm.invoke(prompt).content.strip().splitlines()
-            status = next((l.split(":")[1].strip() for l in res if l.startswith("STATUS:")), "")
-            standalone = next((l.split(":")[1].strip() for l in res if l.startswith("STANDALONE_QUERY:")), "")
-            return (status == "RELATED", standalone or None)
+            if self.embeddings is not None:
+                similarity = await asyncio.to_thread(self.similarity_to_previous, current_query)
+                decided = self._gate(current_query, similarity)
+                if decided is not None:
+                    return decided
+            self.gate_counts["llm_calls"] += 1
+            response = await self.llm.ainvoke(self._relatedness_prompt(current_query))
+            result = self._parse_relatedness(response.content)
+            self._store_rewrite(key, result)
+            return result
         except Exception:
             return False, None
     
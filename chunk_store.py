@@ -0,0 +1,223 @@
+"""
+chunk_store.py
+Pickle kullanmayan, memory-mapped chunk deposu (index.pkl alternatifi).
+
+Dosyalar (indeks klasöründe):
+    chunks.txt          - tüm chunk metinleri art arda (UTF-8)
+    chunks.offsets.npy  - her chunk'ın bayt başlangıcı (n + 1 adet, int64)
+    chunks.source.npy   - kaynak numarası (int32)
+    chunks.page.npy     - sayfa numarası (int32, yoksa -1)
+    chunks.start.npy    - start_index (int64, yoksa -1)
+    chunks.label.npy    - page_label (unicode, yoksa "")
+    chunks.ids.npy      - FAISS sırasıyla docstore id'leri
+    chunks.ids_sorted.npy / chunks.ids_rows.npy - id -> satır ikili arama tablosu
+    chunks.json         - kaynak listesi, kaynağın tüm chunk'larında ortak metadata
+                          ve bundan farklı olan satırların ek metadata'sı
+
+Metadata kayıpsızdır: ChunkStore.metadata(row) yazılan Document'ın
+metadata'sını birebir geri verir.
+"""
+
+import os
+import json
+import numpy as np
+from collections.abc import Mapping
+from typing import Dict, List, Union
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+
+PREFIX = "chunks"
+ROW_FIELDS = ("page", "start_index", "page_label")  # satır bazında (kolon olarak) tutulan alanlar
+
+
+def _column_value(key: str, value):
+    """Alan kolona yazılabiliyorsa kolondaki değeri, yazılamıyorsa None döndürür."""
+    if key == "page_label":
+        return value if isinstance(value, str) and value else None
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    return None
+
+
+def _path(folder: str, suffix: str) -> str:
+    return os.path.join(folder, f"{PREFIX}.{suffix}")
+
+
+def exists(folder: str) -> bool:
+    """Klasörde chunk deposu var mı?"""
+    return os.path.exists(_path(folder, "json"))
+
+
+def remove(folder: str):
+    """Klasördeki chunk deposu dosyalarını siler."""
+    for name in os.listdir(folder):
+        if name.startswith(PREFIX + "."):
+            os.remove(os.path.join(folder, name))
+
+
+def write_chunk_store(folder: str, docs: List[Document], ids: List[str]):
+    """Dokümanları FAISS satır sırasıyla chunk deposu olarak yazar."""
+    os.makedirs(folder, exist_ok=True)
+
+    sources: List[Dict] = []
+    source_ids: Dict[str, int] = {}
+    source_col = np.empty(len(docs), dtype=np.int32)
+    page_col = np.empty(len(docs), dtype=np.int32)
+    start_col = np.empty(len(docs), dtype=np.int64)
+    labels = [""] * len(docs)
+    offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+
+    # Kaynak düzeyindeki metadata (yazar, başlık vb.): kaynağın tüm chunk'larında aynı olan alanlar
+    for doc in docs:
+        source = doc.metadata.get("source", "Unknown")
+        shared = {k: v for k, v in doc.metadata.items() if k not in ROW_FIELDS and k != "source"}
+        if source not in source_ids:
+            source_ids[source] = len(sources)
+            sources.append({"source": source, "metadata": shared})
+        else:
+            common = sources[source_ids[source]]["metadata"]
+            for key in [k for k in common if k not in shared or shared[k] != common[k]]:
+                del common[key]
+
+    rows: Dict[str, Dict] = {}  # kolonlara ve kaynak metadata'sına sığmayan satır alanları
+    unsourced: List[int] = []  # source alanı olmayan satırlar ("Unknown" kaynağına yazılır)
+    with open(_path(folder, "txt"), "wb") as f:
+        for row, doc in enumerate(docs):
+            meta = doc.metadata
+            source = meta.get("source", "Unknown")
+            common = sources[source_ids[source]]["metadata"]
+            columns = {key: _column_value(key, meta.get(key)) for key in ROW_FIELDS}
+            extra = {k: v for k, v in meta.items()
+                     if k != "source" and (columns[k] is None if k in ROW_FIELDS else k not in common)}
+            if extra:
+                rows[str(row)] = extra
+            if "source" not in meta:
+                unsourced.append(row)
+            source_col[row] = source_ids[source]
+            page_col[row] = -1 if columns["page"] is None else columns["page"]
+            start_col[row] = -1 if columns["start_index"] is None else columns["start_index"]
+            labels[row] = columns["page_label"] or ""
+
+            data = doc.page_content.encode("utf-8")
+            f.write(data)
+            offsets[row + 1] = offsets[row] + len(data)
+
+    id_array = np.asarray(ids, dtype="S")
+    order = np.argsort(id_array, kind="stable")
+
+    np.save(_path(folder, "offsets.npy"), offsets)
+    np.save(_path(folder, "source.npy"), source_col)
+    np.save(_path(folder, "page.npy"), page_col)
+    np.save(_path(folder, "start.npy"), start_col)
+    np.save(_path(folder, "label.npy"), np.asarray(labels, dtype=str))
+    np.save(_path(folder, "ids.npy"), id_array)
+    np.save(_path(folder, "ids_sorted.npy"), id_array[order])
+    np.save(_path(folder, "ids_rows.npy"), order.astype(np.int64))
+
+    with open(_path(folder, "json"), "w", encoding="utf-8") as f:
+        json.dump({"count": len(docs), "sources": sources, "rows": rows, "unsourced": unsourced}, f,
+                  ensure_ascii=False)
+
+
+def save_from_vectorstore(vectorstore, folder: str):
+    """Bellekteki FAISS deposunun docstore'unu chunk deposu olarak yazar."""
+    ids = [doc_id for _, doc_id in sorted(vectorstore.index_to_docstore_id.items())]
+    docs = [vectorstore.docstore.search(doc_id) for doc_id in ids]
+    write_chunk_store(folder, docs, ids)
+
+
+class RowIdMapping(Mapping):
+    """FAISS satırı -> docstore id eşlemesi; id'ler ihtiyaç oldukça dosyadan okunur."""
+
+    def __init__(self, ids: np.ndarray):
+        self.ids = ids
+
+    def __getitem__(self, row) -> str:
+        if not 0 <= row < len(self.ids):
+            raise KeyError(row)
+        return self.ids[row].decode("utf-8")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(range(len(self.ids)))
+
+
+class ChunkStore(Docstore):
+    """
+    Memory-mapped chunk deposu. Açılışta sadece küçük JSON okunur;
+    metinler ve kolonlar mmap ile, Document nesneleri sadece bulunan
+    sonuçlar için oluşturulur.
+    """
+
+    def __init__(self, folder: str):
+        with open(_path(folder, "json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        self.count = info["count"]
+        self.sources = info["sources"]
+        self.rows = info.get("rows", {})
+        self.unsourced = set(info.get("unsourced", []))
+
+        def load(suffix):
+            return np.load(_path(folder, suffix), mmap_mode="r")
+
+        self.offsets = load("offsets.npy")
+        self.source = load("source.npy")
+        self.page = load("page.npy")
+        self.start = load("start.npy")
+        # Eski depolarda page_label kolonu yoktur
+        self.label = load("label.npy") if os.path.exists(_path(folder, "label.npy")) else None
+        self.ids = load("ids.npy")
+        self.ids_sorted = load("ids_sorted.npy")
+        self.ids_rows = load("ids_rows.npy")
+        self.text = (np.memmap(_path(folder, "txt"), dtype=np.uint8, mode="r")
+                     if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def index_to_docstore_id(self) -> RowIdMapping:
+        return RowIdMapping(self.ids)
+
+    def row_of(self, doc_id: str) -> int:
+        """Docstore id'sinin satırını ikili aramayla bulur (-1: yok)."""
+        key = doc_id.encode("utf-8")
+        pos = int(np.searchsorted(self.ids_sorted, key))
+        if pos < len(self.ids_sorted) and self.ids_sorted[pos] == key:
+            return int(self.ids_rows[pos])
+        return -1
+
+    def metadata(self, row: int) -> Dict:
+        """Satırın metadata'sını kaynak metadata'sı, kolonlar ve satırın ek alanlarından oluşturur."""
+        source = self.sources[self.source[row]]
+        meta = {"source": source["source"], **source["metadata"]}
+        if row in self.unsourced:
+            del meta["source"]
+        if self.page[row] >= 0:
+            meta["page"] = int(self.page[row])
+        if self.start[row] >= 0:
+            meta["start_index"] = int(self.start[row])
+        if self.label is not None and self.label[row]:
+            meta["page_label"] = str(self.label[row])
+        meta.update(self.rows.get(str(row), {}))
+        return meta
+
+    def document(self, row: int) -> Document:
+        """Satırdaki chunk'ı Document olarak oluşturur."""
+        content = bytes(self.text[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+        return Document(page_content=content, metadata=self.metadata(row),
+                        id=self.ids[row].decode("utf-8"))
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self.row_of(search)
+        if row < 0:
+            return f"ID {search} not found."
+        return self.document(row)
+
+    def to_in_memory(self):
+        """Tüm chunk'ları değiştirilebilir InMemoryDocstore'a açar (incremental güncelleme için)."""
+        ids = [doc_id.decode("utf-8") for doc_id in self.ids]
+        docstore = InMemoryDocstore({doc_id: self.document(row) for row, doc_id in enumerate(ids)})
+        return docstore, dict(enumerate(ids))
@@ -0,0 +1,128 @@
+"""
+compressed_index.py
+Sıkıştırılmış FAISS indeksi üzerinde arama + tam hassasiyetli vektörlerle yeniden sıralama.
+
+İlk aşamada bellekteki sıkıştırılmış kodlar (float16, int8 SQ veya PQ) üzerinde
+k * factor aday bulunur; adaylar indeks klasöründeki memory-mapped float32
+vektör dosyasıyla (vectors.npy) tam L2 mesafesine göre yeniden sıralanır.
+Tam vektörler RAM'de tutulmaz, sadece adayların sayfaları diskten okunur.
+"""
+
+import os
+import numpy as np
+from metadata_filter import search_rows
+
+VECTORS_FILE = "vectors.npy"
+COMPRESSIONS = ("fp16", "sq8", "pq")
+
+
+def codec(compression: str, pq_m: int, pq_nbits: int) -> str:
+    """Sıkıştırma adını FAISS index_factory kod tanımına çevirir."""
+    if compression == "fp16":
+        return "SQfp16"
+    if compression == "sq8":
+        return "SQ8"
+    if compression == "pq":
+        return f"PQ{pq_m}x{pq_nbits}"
+    raise ValueError(f"Bilinmeyen sıkıştırma: {compression}")
+
+
+def vectors_path(folder: str) -> str:
+    return os.path.join(folder, VECTORS_FILE)
+
+
+def open_vectors(folder: str):
+    """Klasördeki tam hassasiyetli vektörleri memory-map ile açar (yoksa None)."""
+    path = vectors_path(folder)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+def create_vectors_file(path: str, n_vectors: int, dim: int) -> np.memmap:
+    """Build sırasında doldurulacak boş .npy vektör dosyası oluşturur."""
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n_vectors, dim))
+
+
+def commit_vectors(folder: str, tmp_path: str = None):
+    """Geçici vektör dosyasını yerine taşır; tmp_path yoksa eski dosyayı siler."""
+    if tmp_path:
+        os.replace(tmp_path, vectors_path(folder))
+    elif os.path.exists(vectors_path(folder)):
+        os.remove(vectors_path(folder))  # sıkıştırmasız indeksle eski vektörler karışmasın
+
+
+def rewrite_vectors(folder: str, kept_rows: list, new_vectors: np.ndarray, block: int = 65536):
+    """Incremental güncelleme: silinmeyen satırları ve yeni vektörleri yeni dosyaya yazar."""
+    old = open_vectors(folder)
+    kept_rows = np.asarray(kept_rows, dtype=np.int64)
+    tmp_path = vectors_path(folder) + ".tmp"
+    out = create_vectors_file(tmp_path, len(kept_rows) + len(new_vectors), old.shape[1])
+    for start in range(0, len(kept_rows), block):
+        rows = kept_rows[start:start + block]
+        out[start:start + len(rows)] = old[rows]
+    out[len(kept_rows):] = new_vectors
+    out.flush()
+    del out, old
+    commit_vectors(folder, tmp_path)
+
+
+class RerankIndex:
+    """
+    Sıkıştırılmış indeksi saran, FAISS arama arayüzüyle uyumlu sınıf.
+
+    LangChain FAISS sadece search / ntotal / d kullandığı için vectorstore.index
+    yerine doğrudan konabilir. Diğer öznitelikler alttaki indekse iletilir.
+    """
+
+    def __init__(self, index, vectors: np.ndarray, factor: int = 4):
+        if vectors.shape[0] != index.ntotal:
+            raise ValueError(f"Vektör dosyası indeksle uyuşmuyor: {vectors.shape[0]} != {index.ntotal}")
+        self.index = index
+        self.vectors = vectors
+        self.factor = factor
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def d(self) -> int:
+        return self.index.d
+
+    def reconstruct(self, row: int) -> np.ndarray:
+        return np.array(self.vectors[row])
+
+    def search(self, queries: np.ndarray, k: int, rows: np.ndarray = None):
+        """
+        k * factor aday arar, adayları tam vektörlerle yeniden sıralar.
+        rows verilirse adaylar sadece bu satırlardan seçilir (metadata filtresi).
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if rows is not None:
+            _, candidates = search_rows(self.index, queries, k * self.factor, rows)
+        else:
+            _, candidates = self.index.search(queries, k * self.factor)
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, rows in enumerate(candidates):
+            rows = np.sort(rows[rows >= 0])  # sıralı okuma: memmap sayfalarına ardışık erişim
+            if not len(rows):
+                continue
+            exact = ((self.vectors[rows] - queries[q]) ** 2).sum(axis=1)
+            top = np.argsort(exact, kind="stable")[:k]
+            distances[q, :len(top)] = exact[top]
+            labels[q, :len(top)] = rows[top]
+        return distances, labels
+
+
+def wrap(index, folder: str, factor: int = 4):
+    """Klasörde tam vektör dosyası varsa indeksi RerankIndex ile sarar."""
+    vectors = open_vectors(folder)
+    if vectors is None or factor <= 0:
+        return index
+    return RerankIndex(index, vectors, factor)
@@ -18,9 +18,73 @@ MODEL_NAME = os.getenv("QWEN_MODEL")
 EMBEDDING_MODEL = "BAAI/bge-m3"
 INDEX_PATH = "embeddings/faiss_index"
 
+# ANN Index (embed_builder.py ile oluşturulur)
+INDEX_TYPE = "flat"  # "flat" (tam arama), "hnsw", "ivf_flat", "ivf_pq"
+HNSW_M = 32  # graf komşu sayısı
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128  # arama sırasında; büyüdükçe recall artar, hız düşer
+IVF_NLIST = None  # küme sayısı; None: ~4 * sqrt(vektör sayısı)
+IVF_NPROBE = 16  # arama sırasında taranan küme sayısı
+PQ_M = 64  # IVF-PQ alt vektör sayısı (1024 boyut için 16 boyutluk parçalar)
+PQ_NBITS = 8
+
+# Sıkıştırılmış vektörler + yeniden sıralama
+VECTOR_COMPRESSION = None  # None (float32), "fp16", "sq8" (int8), "pq"
+RERANK_FACTOR = 4  # sıkıştırılmış aramada k * RERANK_FACTOR aday tam vektörlerle yeniden sıralanır
+
+# Shard'lı indeks (embed_builder.py --shards ile docs/<isim> klasörlerinden oluşturulur)
+SHARDS_PATH = "embeddings/shards"
+INDEX_SHARDS = None  # None: tek indeks (INDEX_PATH), "all": SHARDS_PATH altındaki tüm shard'lar, ["csms", ...]: seçilenler
+SHARD_SEARCH_WORKERS = None  # paralel shard araması için thread sayısı (None: CPU sayısı)
+
+# Query Embedding Cache (LRU)
+QUERY_CACHE_SIZE = 1024  # 0: kapalı
+QUERY_CACHE_PATH = "embeddings/query_cache.npz"  # None: sadece bellekte
+
+# Semantic Answer Cache
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_THRESHOLD = 0.95  # sorgu embedding'leri arasındaki minimum cosine benzerliği
+ANSWER_CACHE_TTL = 24 * 3600  # saniye
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_PATH = "embeddings/answer_cache.json"  # None: sadece bellekte
+
 # Retrieval Parameters
-TOP_K = 20
+TOP_K = 20  # dense modda
+RETRIEVAL_MODE = "hybrid"  # "dense": sadece FAISS, "hybrid": BM25 + FAISS (RRF)
+HYBRID_TOP_K = 8  # hybrid modda prompt'a giren chunk sayısı
+CONTEXT_TOKEN_BUDGET = 6000  # prompt'taki doküman bağlamının en fazla token sayısı
 TEMPERATURE = 0
+STREAM_ANSWERS = True  # cevabı token token göster (TTFT ve token/sn ölçülür)
 
 # Chat History
 MAX_HISTORY = 5
+RELATEDNESS_GATE_LOW = 0.45  # önceki soru/cevapla benzerlik bunun altındaysa ilişkisiz (LLM çağrılmaz)
+RELATEDNESS_GATE_HIGH = 0.85  # bunun üstündeyse soru kendi başına yeterli (LLM çağrılmaz)
+
+# HTTP Server (server.py)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+BATCH_WINDOW_MS = 5  # ilk sorgudan sonra aynı batch'e katılacak sorgular için bekleme süresi
+BATCH_MAX_SIZE = 32  # tek embedding + FAISS çağrısındaki en fazla sorgu (1: batch yok)
+MAX_SESSIONS = 1000  # bellekte tutulan oturum sayısı (en eski kullanılan atılır)
+
+# @diagram Speculation
+DIAGRAM_SPECULATION = True  # sorular cevaplanırken diyagramı varsayılanlarla arka planda hazırla
+DIAGRAM_SPECULATIVE_GENERATIONS = 2  # diyalog başına en fazla tahmini LLM çağrısı (0: sadece retrieval)
+
+# Diagram JSON streaming (diagram_chat.py)
+DIAGRAM_JSON_ATTEMPTS = 3  # şemadan sapan çıktı akış sırasında kesilip yeniden istenir; son deneme kesilmez (1: kapalı)
+
+# Diagram Cache (diagram_cache.py)
+DIAGRAM_CACHE_ENABLED = True
+DIAGRAM_CACHE_SIZE = 512  # (istek, cevaplar) kombinasyonu; en eski kullanılan atılır
+DIAGRAM_CACHE_PATH = "embeddings/diagram_cache.json"  # None: sadece bellekte
+
+# Batch Runner (batch_runner.py)
+BATCH_CONCURRENCY = 8  # aynı anda cevaplanan soru (LLM isteği) sayısı
+BATCH_RATE_LIMIT_RPM = None  # dakikada en fazla LLM isteği (None: sınırsız)
+
+# Telemetry (telemetry.py)
+TELEMETRY_ENABLED = False  # aşama süreleri, token ve chunk sayıları (kapalıyken ek maliyet yok)
+TRACE_PATH = "logs/trace.jsonl"  # her sorgu için bir satır (span ağacı)
+METRICS_PATH = "logs/metrics.prom"  # aşama toplamları, Prometheus text formatında
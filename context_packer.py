@@ -0,0 +1,177 @@
+"""
+context_packer.py
+Bulunan chunk'lardan token bütçesine sığan LLM bağlamı oluşturur.
+
+1. Aynı kaynak ve sayfadaki bitişik / örtüşen chunk'lar start_index ile
+   birleştirilir (CHUNK_OVERLAP kaynaklı tekrar eden metin bir kez kalır).
+2. Birebir veya neredeyse aynı metin parçaları (farklı PDF'lerde tekrar eden
+   SSS cevapları gibi) atılır.
+3. Kalan parçalar sıralama skoruna göre token bütçesi dolana kadar eklenir.
+"""
+
+import hashlib
+from typing import Callable, Dict, List, Tuple
+from langchain_core.documents import Document
+from llm_utils import count_tokens
+
+SEPARATOR = "\n\n---\n\n"
+SHINGLE_SIZE = 5  # yakın tekrar kontrolü için kelime n-gram boyu
+MIN_OVERLAP = 20  # offset tutmadığında kabul edilen en kısa ortak metin
+OVERLAP_SLACK = 8  # offset'ten hesaplanan örtüşmeden en fazla sapma (karakter)
+
+
+def _span_end(doc: Document) -> int:
+    return doc.metadata.get("start_index", 0) + len(doc.page_content)
+
+
+def _overlap(left: str, right: str, expected: int) -> int:
+    """
+    left'in sonu ile right'ın başı arasındaki ortak metin uzunluğu.
+
+    expected offset'lerden hesaplanan örtüşmedir; <= 0 ise chunk'lar sadece
+    bitişiktir ve metin kırpılmaz. Splitter boşlukları kırptıysa offset birkaç
+    karakter kayabilir; bu durumda sadece expected'a yakın ve en az
+    MIN_OVERLAP uzunluğundaki eşleşmeler kabul edilir (kısa tesadüfi
+    eşleşmeler metinden kelime düşürürdü).
+    """
+    if expected <= 0:
+        return 0
+    if expected <= min(len(left), len(right)) and left.endswith(right[:expected]):
+        return expected
+    for size in range(min(len(left), len(right), expected + OVERLAP_SLACK),
+                      max(MIN_OVERLAP, expected - OVERLAP_SLACK) - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def merge_adjacent(docs: List[Document], ranks: List[int]) -> Tuple[List[Document], List[int]]:
+    """
+    Aynı kaynak/sayfadaki bitişik veya örtüşen chunk'ları tek parçada birleştirir.
+
+    Birleşen parçanın sırası üyelerinin en iyi sırasıdır. start_index
+    olmayan chunk'lar olduğu gibi bırakılır.
+    """
+    groups: Dict[tuple, List[Tuple[Document, int]]] = {}
+    spans, span_ranks = [], []
+    for doc, rank in zip(docs, ranks):
+        meta = doc.metadata
+        if "start_index" not in meta:
+            spans.append(doc)
+            span_ranks.append(rank)
+            continue
+        groups.setdefault((meta.get("source"), meta.get("page")), []).append((doc, rank))
+
+    for members in groups.values():
+        members.sort(key=lambda item: item[0].metadata["start_index"])
+        current, rank = members[0]
+        text, end, merged = current.page_content, _span_end(current), 1
+
+        for doc, doc_rank in members[1:]:
+            start = doc.metadata["start_index"]
+            if _span_end(doc) <= end and doc.page_content in text:
+                rank = min(rank, doc_rank)  # tamamen içeride: tekrar
+                continue
+            if start <= end + 1:
+                size = _overlap(text, doc.page_content, end - start)
+                text += (" " if size == 0 else "") + doc.page_content[size:]
+                end = max(end, _span_end(doc))
+                rank = min(rank, doc_rank)
+                merged += 1
+                continue
+            spans.append(Document(page_content=text, metadata={**current.metadata, "merged_chunks": merged}))
+            span_ranks.append(rank)
+            current, rank = doc, doc_rank
+            text, end, merged = doc.page_content, _span_end(doc), 1
+
+        spans.append(Document(page_content=text, metadata={**current.metadata, "merged_chunks": merged}))
+        span_ranks.append(rank)
+
+    order = sorted(range(len(spans)), key=lambda i: span_ranks[i])
+    return [spans[i] for i in order], [span_ranks[i] for i in order]
+
+
+def _shingles(text: str) -> set:
+    words = text.casefold().split()
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def drop_duplicates(spans: List[Document], threshold: float = 0.9) -> Tuple[List[Document], int]:
+    """
+    Birebir ve yakın tekrarları atar (kelime 5-gram Jaccard benzerliği >= threshold).
+
+    Listeler sıralamaya göre geldiği için her tekrar grubundan en iyi sıradaki kalır.
+    """
+    kept, kept_shingles, seen = [], [], set()
+    dropped = 0
+    for span in spans:
+        digest = hashlib.sha1(" ".join(span.page_content.split()).encode("utf-8")).digest()
+        shingles = _shingles(span.page_content)
+        duplicate = digest in seen or any(
+            len(shingles & other) / max(1, len(shingles | other)) >= threshold
+            or shingles <= other  # daha uzun bir parçanın içinde kalıyor
+            for other in kept_shingles
+        )
+        if duplicate:
+            dropped += 1
+            continue
+        seen.add(digest)
+        kept.append(span)
+        kept_shingles.append(shingles)
+    return kept, dropped
+
+
+def format_block(i: int, doc: Document) -> str:
+    return f"[Document {i}]\n{doc.page_content}"
+
+
+def pack_context(docs: List[Document], token_budget: int = 6000, dedup_threshold: float = 0.9,
+                 counter: Callable[[str], int] = count_tokens) -> Tuple[str, List[Document], Dict]:
+    """
+    Chunk'ları (sıralama sırasıyla) birleştirip bütçeye sığan bağlam metnini üretir.
+
+    Args:
+        docs: Retriever çıktısı, en alakalı ilk sırada
+        token_budget: Bağlamın en fazla token sayısı (None veya 0: sınırsız)
+        dedup_threshold: Yakın tekrar eşiği (Jaccard)
+        counter: Token sayacı (varsayılan: tiktoken)
+
+    Returns:
+        (bağlam metni, bağlama giren parçalar, istatistikler)
+    """
+    spans, _ = merge_adjacent(docs, list(range(len(docs))))
+    merged = len(docs) - len(spans)
+    spans, dropped = drop_duplicates(spans, dedup_threshold)
+
+    blocks, packed = [], []
+    used = 0
+    skipped = 0
+    separator_tokens = counter(SEPARATOR)
+    for span in spans:
+        block = format_block(len(blocks) + 1, span)
+        tokens = counter(block) + (separator_tokens if blocks else 0)
+        if token_budget and used + tokens > token_budget:
+            skipped += 1
+            continue  # sonraki daha kısa parça sığabilir
+        blocks.append(block)
+        packed.append(span)
+        used += tokens
+
+    if not blocks and spans:
+        # En iyi parça tek başına bütçeyi aşıyor: sığana kadar bütçe oranında kısalt
+        span = spans[0]
+        while span.page_content:
+            ratio = token_budget / counter(format_block(1, span))
+            if ratio >= 1:
+                break
+            span = Document(page_content=span.page_content[:int(len(span.page_content) * ratio * 0.95)],
+                            metadata=span.metadata)
+        blocks, packed = [format_block(1, span)], [span]
+        used = counter(blocks[0])
+        skipped -= 1
+
+    stats = {"chunks": len(docs), "merged": merged, "duplicates": dropped,
+             "skipped": skipped, "spans": len(packed), "tokens": used}
+    return SEPARATOR.join(blocks), packed, stats
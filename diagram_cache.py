@@ -0,0 +1,299 @@
+"""
+diagram_cache.py
+@diagram çıktıları için kalıcı önbellek.
+
+Netleştirme soruları küçük ve sabit seçenek listelerinden cevaplandığı için
+aynı temel istek + aynı cevap kombinasyonu sık tekrar eder. Doğrulanmış ve
+normalize edilmiş diyagramlar (normalize sorgu, kanonik cevap tuple'ı, indeks
+versiyonu) anahtarıyla LRU olarak saklanır. İndeks yeniden oluşturulunca
+diyagramlar geçersiz olur, ama hangi kombinasyonların kaç kez istendiği
+korunur; warm-up komutu en sık istenenleri (ve varsayılanlara yakın
+kombinasyonları) yeni indeksle önceden üretir.
+
+Warm-up:
+    python diagram_cache.py --top 50 --queries "mobile app deployment" "ai chatbot"
+"""
+
+import os
+import re
+import copy
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from tqdm import tqdm
+from diagram_chat import (CLARIFICATION_CONFIG, strip_diagram_intent, get_clarification_questions,
+                          enhance_query_with_answers, build_diagram)
+
+
+def normalize_query(query: str) -> str:
+    """@diagram önekini atar; küçük harf, noktalama ve boşluk farklarını yok sayar."""
+    text = strip_diagram_intent(query).lower()
+    return " ".join(re.sub(r"[^\w\s+-]", " ", text).split())
+
+
+def canonical_value(value: str) -> str:
+    """Tek cevabın yazım farklarını (büyük harf, boşluk, alt çizgi) yok sayan biçimi."""
+    return "-".join(value.lower().replace("_", " ").split())
+
+
+def canonical_answers(answers: Dict[str, str]) -> Tuple[str, ...]:
+    """Cevaplar soru sırasıyla; boş cevap varsayılan, yazım farkları (büyük harf, boşluk) yok sayılır."""
+    canonical = []
+    for index in range(CLARIFICATION_CONFIG["collection_strategy"]["max_questions"]):
+        value = (answers.get(f"question_{index}") or "").strip()
+        if not value:
+            value = get_clarification_questions("", index)["default"]
+        canonical.append(canonical_value(value))
+    return tuple(canonical)
+
+
+def answers_dict(canonical: Tuple[str, ...]) -> Dict[str, str]:
+    return {f"question_{index}": value for index, value in enumerate(canonical)}
+
+
+def option_answers(canonical: Tuple[str, ...]) -> Dict[str, str]:
+    """
+    Kanonik cevapları sorunun seçeneklerindeki yazımla geri çevirir
+    ("enterprise-1m+" -> "enterprise-1M+"). Warm-up, canlı istekle aynı
+    prompt'u üretsin diye kullanılır; seçeneklerde olmayan cevaplar aynen kalır.
+    """
+    answers = {}
+    for index, value in enumerate(canonical):
+        options = get_clarification_questions("", index).get("options", [])
+        spelled = {canonical_value(option): option for option in options}
+        answers[f"question_{index}"] = spelled.get(value, value)
+    return answers
+
+
+class DiagramCache:
+    """
+    Doğrulanmış diyagram payload'ları için LRU önbellek (thread-safe).
+
+    Sadece şema hatası olmayan diyagramlar eklenir; lookup kopya döndürür.
+    Her lookup, kombinasyonun istenme sayısını (popularity) artırır; bellekte
+    ve dosyada en sık istenen max_size * POPULARITY_FACTOR kombinasyon tutulur.
+    """
+
+    POPULARITY_FACTOR = 4
+
+    def __init__(self, max_size: int = 512, persist_path: str = None, index_version: str = ""):
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.index_version = index_version
+        self.entries = OrderedDict()  # anahtar -> kayıt
+        self.popularity = {}  # (sorgu, cevaplar) -> istenme sayısı (indeksten bağımsız)
+        self.spellings = {}  # normalize sorgu -> ilk görülen yazımı (warm-up prompt'u için)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if persist_path and os.path.exists(persist_path):
+            self.load()
+
+    def key(self, query: str, answers: Dict[str, str]) -> Tuple:
+        return normalize_query(query), canonical_answers(answers), self.index_version
+
+    def set_index_version(self, index_version: str):
+        """İndeks yeniden oluşturulduysa diyagramları geçersiz kılar (popularity korunur)."""
+        with self._lock:
+            if index_version != self.index_version:
+                self.entries.clear()
+                self.index_version = index_version
+
+    def contains(self, query: str, answers: Dict[str, str]) -> bool:
+        """Sayaçları değiştirmeden kayıt var mı bakar (tahmin ve warm-up için)."""
+        key = self.key(query, answers)
+        with self._lock:
+            return key in self.entries
+
+    def lookup(self, query: str, answers: Dict[str, str]) -> Optional[Dict]:
+        """Kayıtlı diyagramın kopyası veya None."""
+        key = self.key(query, answers)
+        with self._lock:
+            self.popularity[key[:2]] = self.popularity.get(key[:2], 0) + 1
+            self.spellings.setdefault(key[0], strip_diagram_intent(query))
+            if len(self.popularity) > 2 * self.max_size * self.POPULARITY_FACTOR:
+                self._trim_popularity()  # her lookup'ta sıralamamak için limitin iki katında budanır
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry["payload"])
+
+    def add(self, query: str, answers: Dict[str, str], payload: Dict, created: float = None):
+        """Diyagramı kaydeder; boyut aşılırsa en eski kullanılanı düşürür."""
+        key = self.key(query, answers)
+        with self._lock:
+            self.entries[key] = {"payload": copy.deepcopy(payload),
+                                 "created": created if created is not None else time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _trim_popularity(self):
+        """Sadece en sık istenen max_size * POPULARITY_FACTOR kombinasyonu bırakır (kilit tutulurken çağrılır)."""
+        ranked = sorted(self.popularity.items(), key=lambda item: -item[1])
+        self.popularity = dict(ranked[:self.max_size * self.POPULARITY_FACTOR])
+        kept = {query for query, _ in self.popularity}
+        self.spellings = {query: text for query, text in self.spellings.items() if query in kept}
+
+    def spelling(self, query: str) -> str:
+        """Normalize sorgunun ilk istendiği yazım (bilinmiyorsa sorgunun kendisi)."""
+        with self._lock:
+            return self.spellings.get(query, query)
+
+    def most_common(self, n: int = None) -> List[Tuple[str, Tuple[str, ...], int]]:
+        """En sık istenen (sorgu, cevaplar, sayı) kombinasyonları."""
+        with self._lock:
+            ranked = sorted(self.popularity.items(), key=lambda item: -item[1])
+        return [(query, answers, count) for (query, answers), count in ranked[:n]]
+
+    def stats(self) -> dict:
+        """Önbellek boyutu ve hit/miss sayaçları."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self):
+        """Önbelleği indeks versiyonu ve popularity ile birlikte JSON olarak kaydeder."""
+        if not self.persist_path:
+            return
+        with self._lock:
+            self._trim_popularity()
+            data = {
+                "index_version": self.index_version,
+                "entries": [
+                    {"query": query, "answers": list(answers), "payload": entry["payload"],
+                     "created": entry["created"]}
+                    for (query, answers, _), entry in self.entries.items()
+                ],
+                "popularity": [
+                    {"query": query, "answers": list(answers), "count": count,
+                     "text": self.spellings.get(query, query)}
+                    for (query, answers), count in self.popularity.items()
+                ],
+            }
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.persist_path)
+
+    def load(self):
+        """Kayıtlı önbelleği yükler; diyagramlar farklı bir indeks versiyonuna aitse sadece popularity alınır."""
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for item in data.get("popularity", []):
+            key = (item["query"], tuple(item["answers"]))
+            self.popularity[key] = self.popularity.get(key, 0) + item["count"]
+            self.spellings.setdefault(item["query"], item.get("text", item["query"]))
+        self._trim_popularity()
+        if data.get("index_version") != self.index_version:
+            return
+        for entry in data.get("entries", []):
+            self.add(entry["query"], answers_dict(tuple(entry["answers"])), entry["payload"],
+                     created=entry["created"])
+
+
+# ===============================
+# WARM-UP
+# ===============================
+def warm_up_candidates(cache: DiagramCache, queries: List[str] = (), top: int = 50) -> List[Tuple[str, Dict]]:
+    """
+    Önceden üretilecek (sorgu, cevaplar) listesi: önce en sık istenenler,
+    sonra verilen her sorgu için tüm varsayılanlar ve tek bir cevabı
+    varsayılandan farklı olan kombinasyonlar. İstek ilk görüldüğü yazımıyla
+    (queries aynen), cevaplar seçeneklerdeki yazımıyla döner (bkz.
+    option_answers): warm-up canlı istekle aynı prompt'u kurar, önbellek
+    anahtarı yine normalize edilir.
+    """
+    ranked = [(cache.spelling(query), answers) for query, answers, _ in cache.most_common()]
+    defaults = canonical_answers({})
+    for query in queries:
+        query = strip_diagram_intent(query)
+        ranked.append((query, defaults))
+        for index in range(len(defaults)):
+            for option in get_clarification_questions("", index)["options"]:
+                option = canonical_value(option)
+                if option != defaults[index]:
+                    ranked.append((query, defaults[:index] + (option,) + defaults[index + 1:]))
+
+    candidates, seen = [], set()
+    for query, answers in ranked:
+        key = (normalize_query(query), answers)
+        if key in seen:
+            continue
+        seen.add(key)
+        candidates.append((query, option_answers(answers)))
+        if len(candidates) >= top:
+            break
+    return candidates
+
+
+def warm_up(cache: DiagramCache, retriever, llm, candidates: List[Tuple[str, Dict]], top_k: int = 20,
+            concurrency: int = 4, progress: bool = True) -> Dict:
+    """Önbellekte olmayan adaylar için diyagram üretir; geçerli olanlar önbelleğe eklenir."""
+    pending = [(query, answers) for query, answers in candidates if not cache.contains(query, answers)]
+    outcomes = {"cached": len(candidates) - len(pending)}
+    bar = tqdm(total=len(pending), desc="Warming diagrams", unit="diagram", disable=not progress)
+
+    def generate(item):
+        query, answers = item
+        enhanced_query = enhance_query_with_answers(strip_diagram_intent(query), answers)
+        payload, outcome = build_diagram(enhanced_query, retriever, llm, top_k)
+        if outcome == "ok":
+            cache.add(query, answers, payload)
+        bar.update(1)
+        return outcome
+
+    with ThreadPoolExecutor(max(1, concurrency)) as pool:
+        for outcome in pool.map(generate, pending):
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    bar.close()
+    return outcomes
+
+
+def main(argv: list = None):
+    from config import RETRIEVAL_MODE, HYBRID_TOP_K, TOP_K, DIAGRAM_CACHE_SIZE, DIAGRAM_CACHE_PATH
+    from main import BackgroundLoader, save_caches
+    from vectorstore import get_retriever
+
+    parser = argparse.ArgumentParser(description="Precompute @diagram results for common clarification answers.")
+    parser.add_argument("--top", type=int, default=50, help="Number of answer combinations to warm")
+    parser.add_argument("--queries", nargs="*", default=[],
+                        help="Base requests to warm with default and near-default answers")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent LLM requests")
+    args = parser.parse_args(argv)
+
+    loader = BackgroundLoader()
+    loader.start()
+    runtime = loader.wait()
+    cache = runtime.diagram_cache or DiagramCache(DIAGRAM_CACHE_SIZE, DIAGRAM_CACHE_PATH,
+                                                  runtime.vectorstore.index_version)
+
+    candidates = warm_up_candidates(cache, args.queries, args.top)
+    if not candidates:
+        print("Nothing to warm: no recorded @diagram requests, pass --queries.")
+        return
+    top_k = HYBRID_TOP_K if RETRIEVAL_MODE == "hybrid" else TOP_K
+    outcomes = warm_up(cache, get_retriever(runtime.vectorstore, top_k), runtime.llm, candidates, top_k,
+                       args.concurrency)
+    print(f"Diagrams: {len(candidates)} candidates, " + ", ".join(f"{outcome} {count}"
+                                                               for outcome, count in outcomes.items()))
+    save_caches(runtime.vectorstore, diagram_cache=cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,42 @@ Diagram generation and clarification handling.
 
 from langchain_community.vectorstores import FAISS
 from langchain_openai import ChatOpenAI
-from diagram_chat import generate_diagram_flow, get_clarification_questions, enhance_query_with_answers
+from vectorstore import get_retriever
+from diagram_chat import generate_diagram_flow, get_clarification_questions, enhance_query_with_answers, DiagramSpeculator
+import telemetry
 
 
-def handle_diagram_query(query: str, vectorstore: FAISS, llm: ChatOpenAI, top_k: int = 20):
-    """Handle @diagram queries with clarification flow."""
-    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": top_k})
-    
+def handle_diagram_query(query: str, vectorstore: FAISS, llm: ChatOpenAI, top_k: int = 20,
+                         speculative: bool = True, max_generations: int = 2, cache=None, filters=None):
+    """
+    Handle @diagram queries with clarification flow.
+
+    speculative=True iken kullanıcı soruları cevaplarken diyagram arka planda
+    (verilen cevaplar + varsayılanlarla) hazırlanır; en fazla max_generations
+    tahmini LLM çağrısı yapılır (0: sadece retrieval önceden yapılır).
+    cache (DiagramCache) verilirse aynı istek + cevaplar için kayıtlı diyagram kullanılır.
+    filters (source / page) verilirse retrieval sadece eşleşen chunk'larda yapılır;
+    filtreli diyagramlar önbelleğe alınmaz.
+    """
+    retriever = get_retriever(vectorstore, top_k, filters)
+    if filters is not None:
+        cache = None
+    speculator = DiagramSpeculator(query, retriever, llm, top_k, max_generations, cache) if speculative else None
+    try:
+        with telemetry.span("diagram", speculative=speculative) as trace:
+            result = _run_diagram_dialog(query, retriever, llm, top_k, speculator, cache)
+            trace.set(completed=result is not None)
+            if speculator is not None:
+                trace.set(**{f"speculation_{key}": value for key, value in speculator.stats.items()})
+            return result
+    finally:
+        if speculator is not None:
+            speculator.close()
+
+
+def _run_diagram_dialog(query: str, retriever, llm: ChatOpenAI, top_k: int = 20, speculator: DiagramSpeculator = None,
+                        cache=None):
+
     # Clarification döngüsü - 6 soru için
     clarification_answers = {}
     question_index = 0
@@ -28,7 +57,10 @@ def handle_diagram_query(query: str, vectorstore: FAISS, llm: ChatOpenAI, top_k:
         # Eğer soru döndüyse
         if isinstance(diagram_result, str) and "Options:" in diagram_result:
             print(f"\n{diagram_result}")
-            answer = input("Your answer: ").strip()
+            if speculator is not None:
+                speculator.update(clarification_answers)  # kullanıcı düşünürken arka planda hazırla
+            with telemetry.span("diagram.user_input", question=question_index):  # kullanıcının düşünme süresi
+                answer = input("Your answer: ").strip()
             
             # Default değer işleme
             if not answer:
@@ -57,7 +89,9 @@ def handle_diagram_query(query: str, vectorstore: FAISS, llm: ChatOpenAI, top_k:
             query, retriever, llm, 
             top_k=top_k, 
             clarification_answers=clarification_answers, 
-            question_index=question_index
+            question_index=question_index,
+            speculator=speculator,
+            cache=cache
         )
         print("\n=== DIAGRAM JSON ===")
         print(diagram_result)
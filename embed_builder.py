@@ -5,11 +5,29 @@ PDF dosyalarından FAISS vektör indeksi oluşturur.
 
 import os
 import glob
+import json
+import hashlib
+import time
+import argparse
+import uuid
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import faiss
 from tqdm import tqdm
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from embedding_cache import EmbeddingCache
+import chunk_store
+import compressed_index
+import bm25_index
+from config import INDEX_TYPE, HNSW_M, HNSW_EF_CONSTRUCTION, IVF_NLIST, PQ_M, PQ_NBITS, VECTOR_COMPRESSION
+from config import SHARDS_PATH
 
 # ===============================
 # CONFIGURATION
@@ -26,10 +44,29 @@ SEPARATORS = ["\n\n", "\n", ".", " ", ""]
 # Batch size for embedding (daha küçük yaparsanız daha sık güncelleme görürsünüz)
 BATCH_SIZE = 16  # 32'den 16'ya düşürdüm, daha sık progress görülsün
 
+# Paralel embedding: worker süreç sayısı ve her worker'ın torch thread sayısı
+WORKERS = 1
+THREADS_PER_WORKER = None  # None: çekirdek sayısı / worker sayısı
 
-def load_pdfs(folder_path: str) -> list:
-    """Klasördeki tüm PDF dosyalarını yükler."""
-    pdf_files = glob.glob(os.path.join(folder_path, "*.pdf"))
+# Chunk embedding önbelleği: aynı metin tekrar embed edilmez
+EMBED_CACHE_DIR = "embeddings/embed_cache"
+
+# Docstore formatı: "pickle" (index.pkl), "chunks" (pickle'sız mmap chunk deposu) veya "both"
+DOCSTORE_FORMAT = "both"
+
+# Incremental güncelleme: dosya hash'leri indeksin yanında tutulur
+MANIFEST_NAME = "manifest.json"
+
+
+def list_pdfs(folder_path: str) -> list:
+    """Klasördeki PDF dosyalarının yollarını döndürür."""
+    return sorted(glob.glob(os.path.join(folder_path, "*.pdf")))
+
+
+def load_pdfs(folder_path: str, pdf_files: list = None) -> list:
+    """Klasördeki tüm PDF dosyalarını (veya verilen listeyi) yükler."""
+    if pdf_files is None:
+        pdf_files = list_pdfs(folder_path)
     
     if not pdf_files:
         raise FileNotFoundError(f"'{folder_path}' klasöründe PDF dosyası bulunamadı!")
@@ -92,66 +129,457 @@ def create_chunks(documents: list, chunk_size: int = CHUNK_SIZE,
     return chunks
 
 
+def create_embedding_model(model_name: str = EMBEDDING_MODEL,
+                           batch_size: int = BATCH_SIZE) -> HuggingFaceEmbeddings:
+    """CPU üzerinde normalize edilmiş embedding modeli oluşturur."""
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={
+            'normalize_embeddings': True,
+            'batch_size': batch_size,
+        }
+    )
+
+
+def iter_embedding_batches(chunks: list, embedding_model, batch_size: int = BATCH_SIZE):
+    """
+    Chunk'ları batch'ler halinde embed eder - Progress bar ile!
+    
+    Yields:
+        (başlangıç sırası, float32 embedding matrisi) çiftleri, chunk sırasıyla
+    """
+    for i in tqdm(range(0, len(chunks), batch_size), 
+                 desc="🧮 Embedding yapılıyor",
+                 unit="batch",
+                 bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'):
+        
+        batch = chunks[i:i + batch_size]
+        vectors = np.asarray(
+            embedding_model.embed_documents([doc.page_content for doc in batch]),
+            dtype=np.float32
+        )
+        yield i, vectors
+
+
+_worker_model = None
+
+
+def _init_embedding_worker(model_factory, num_threads: int):
+    """Worker süreci başlatıcısı: thread sayısını sabitler ve kendi modelini yükler."""
+    global _worker_model
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    os.environ["MKL_NUM_THREADS"] = str(num_threads)
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+    _worker_model = model_factory()
+
+
+def _embed_batch_in_worker(start: int, texts: list) -> tuple:
+    """Worker içinde tek bir batch'i embed eder."""
+    began = time.perf_counter()
+    vectors = np.asarray(_worker_model.embed_documents(texts), dtype=np.float32)
+    return start, vectors, os.getpid(), time.perf_counter() - began
+
+
+def iter_embedding_batches_parallel(chunks: list, model_factory,
+                                    batch_size: int = BATCH_SIZE,
+                                    workers: int = WORKERS,
+                                    threads_per_worker: int = THREADS_PER_WORKER):
+    """
+    Chunk'ları N worker sürecine dağıtarak embed eder - Progress bar ile!
+    
+    Her worker kendi modelini sabit torch thread sayısıyla tutar. Sonuçlar
+    bitiş sırasından bağımsız olarak chunk sırasıyla döndürülür, böylece
+    indeks deterministik olur. Sonunda worker başına chunk/sn raporlanır.
+    
+    Yields:
+        (başlangıç sırası, float32 embedding matrisi) çiftleri, chunk sırasıyla
+    """
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    starts = list(range(0, len(chunks), batch_size))
+    max_in_flight = workers * 4  # bellekte bekleyen batch sayısını sınırlar
+    
+    stats = {}
+    ready = {}
+    pending = set()
+    submitted = 0
+    next_to_yield = 0
+    began = time.perf_counter()
+    
+    print(f"⚙️  {workers} worker x {threads} thread ile paralel embedding\n")
+    
+    with ProcessPoolExecutor(workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_embedding_worker,
+                             initargs=(model_factory, threads)) as pool, \
+         tqdm(total=len(starts), desc="🧮 Embedding yapılıyor", unit="batch",
+              bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]') as bar:
+        
+        while next_to_yield < len(starts):
+            while submitted < len(starts) and len(pending) + len(ready) < max_in_flight:
+                start = starts[submitted]
+                texts = [doc.page_content for doc in chunks[start:start + batch_size]]
+                pending.add(pool.submit(_embed_batch_in_worker, start, texts))
+                submitted += 1
+            
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, vectors, pid, seconds = future.result()
+                ready[start] = vectors
+                worker_stats = stats.setdefault(pid, [0, 0.0])
+                worker_stats[0] += len(vectors)
+                worker_stats[1] += seconds
+                bar.update(1)
+            
+            # Sırası gelen batch'leri chunk sırasıyla ver
+            while next_to_yield < len(starts) and starts[next_to_yield] in ready:
+                start = starts[next_to_yield]
+                yield start, ready.pop(start)
+                next_to_yield += 1
+    
+    elapsed = time.perf_counter() - began
+    print(f"\n{'='*60}")
+    print(f"⚙️  WORKER İSTATİSTİKLERİ:")
+    for n, (pid, (count, seconds)) in enumerate(sorted(stats.items()), 1):
+        print(f"   • Worker {n} (pid {pid}): {count} chunk, {count / max(seconds, 1e-9):.1f} chunk/sn")
+    print(f"   • Toplam: {len(chunks) / max(elapsed, 1e-9):.1f} chunk/sn")
+    print(f"{'='*60}\n")
+
+
+class LazyEmbeddings(Embeddings):
+    """Modeli ilk kullanımda yükler; paralel modda ana süreç model tutmaz."""
+    
+    def __init__(self, model_factory):
+        self.model_factory = model_factory
+        self._model = None
+    
+    def _get_model(self) -> Embeddings:
+        if self._model is None:
+            self._model = self.model_factory()
+        return self._model
+    
+    def embed_documents(self, texts: list) -> list:
+        return self._get_model().embed_documents(texts)
+    
+    def embed_query(self, text: str) -> list:
+        return self._get_model().embed_query(text)
+
+
+def iter_cached_embedding_batches(chunks: list, cache: EmbeddingCache, embed_fn,
+                                  batch_size: int = BATCH_SIZE):
+    """
+    Önbellekte olan chunk'ları diskten okur, sadece eksikleri embed_fn ile embed eder.
+    
+    Yeni vektörler her batch'ten sonra önbelleğe yazılır. Çıktı yine chunk
+    sırasıyla (başlangıç sırası, matris) çiftleri halindedir.
+    """
+    texts = [doc.page_content for doc in chunks]
+    rows = cache.lookup(texts)
+    missing = [i for i, row in enumerate(rows) if row is None]
+    
+    print(f"💾 Önbellek: {len(chunks) - len(missing)}/{len(chunks)} chunk hazır, "
+          f"{len(missing)} chunk embed edilecek\n")
+    
+    def emit(start: int, end: int):
+        # Çözülmüş aralığı önbellekten batch'ler halinde ver
+        for i in range(start, end, batch_size):
+            j = min(i + batch_size, end)
+            yield i, cache.vectors(rows[i:j])
+    
+    emitted = 0
+    if missing:
+        for start, vectors in embed_fn([chunks[i] for i in missing]):
+            positions = missing[start:start + len(vectors)]
+            for position, row in zip(positions, cache.add([texts[p] for p in positions], vectors)):
+                rows[position] = row
+            # Bir sonraki eksik chunk'a kadar her şey hazır
+            next_missing = start + len(vectors)
+            ready_until = missing[next_missing] if next_missing < len(missing) else len(chunks)
+            yield from emit(emitted, ready_until)
+            emitted = ready_until
+    yield from emit(emitted, len(chunks))
+
+
+def embedding_batches(chunks: list, embedding_model, batch_size: int = BATCH_SIZE,
+                      workers: int = WORKERS, model_factory=None,
+                      cache: EmbeddingCache = None,
+                      threads_per_worker: int = THREADS_PER_WORKER):
+    """Worker sayısına ve önbelleğe göre embedding batch'lerini döndürür."""
+    def embed_fn(todo: list):
+        if workers > 1:
+            return iter_embedding_batches_parallel(todo, model_factory, batch_size, workers,
+                                                   threads_per_worker)
+        return iter_embedding_batches(todo, embedding_model, batch_size)
+    
+    if cache is not None:
+        return iter_cached_embedding_batches(chunks, cache, embed_fn, batch_size)
+    return embed_fn(chunks)
+
+
+def resolve_index_type(index_type: str, n_vectors: int) -> str:
+    """Eğitim için çok az vektör varsa IVF tiplerini flat'e düşürür."""
+    if index_type.startswith("ivf"):
+        if n_vectors < ivf_nlist(n_vectors) * 39 or (index_type == "ivf_pq" and n_vectors < 2 ** PQ_NBITS):
+            print(f"⚠️  {n_vectors} vektör {index_type} eğitimi için yetersiz, flat indeks kullanılıyor.\n")
+            return "flat"
+    return index_type
+
+
+def resolve_compression(compression: str, n_vectors: int) -> str:
+    """PQ kod kitabı için çok az vektör varsa int8 SQ'ya düşer."""
+    if compression == "pq" and n_vectors < 2 ** PQ_NBITS:
+        print(f"⚠️  {n_vectors} vektör PQ eğitimi için yetersiz, sq8 kullanılıyor.\n")
+        return "sq8"
+    return compression
+
+
+def is_lossy(index_type: str, compression: str = None) -> bool:
+    """Arama kodları kayıplı mı? (Tam vektör dosyası ve yeniden sıralama gerekir.)"""
+    return bool(compression) or index_type == "ivf_pq"
+
+
+def ivf_nlist(n_vectors: int) -> int:
+    """IVF küme sayısı: config'de yoksa ~4 * sqrt(N)."""
+    return IVF_NLIST or max(1, int(4 * np.sqrt(n_vectors)))
+
+
+def create_index(dim: int, n_vectors: int, index_type: str = INDEX_TYPE,
+                 compression: str = VECTOR_COMPRESSION):
+    """
+    Config'deki tipe göre boş FAISS indeksi oluşturur (L2, normalize vektörler).
+    
+    flat: tam arama, hnsw: graf tabanlı ANN, ivf_flat / ivf_pq: küme tabanlı
+    ANN (ivf_pq vektörleri sıkıştırır). compression verilirse vektörler
+    indekste fp16 / int8 / PQ kodları olarak saklanır. Eğitim gerektiren
+    indeksler (is_trained=False) eklemeden önce eğitilmelidir.
+    """
+    code = compressed_index.codec(compression, PQ_M, PQ_NBITS) if compression else None
+    if index_type == "flat":
+        return faiss.index_factory(dim, code) if code else faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.index_factory(dim, f"HNSW{HNSW_M}" + (f"_{code}" if code else ""))
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return index
+    if index_type == "ivf_flat":
+        return faiss.index_factory(dim, f"IVF{ivf_nlist(n_vectors)},{code or 'Flat'}")
+    if index_type == "ivf_pq":
+        return faiss.index_factory(dim, f"IVF{ivf_nlist(n_vectors)},PQ{PQ_M}x{PQ_NBITS}")
+    raise ValueError(f"Bilinmeyen indeks tipi: {index_type}")
+
+
+def build_index(batches, n_vectors: int, index_type: str = INDEX_TYPE,
+                compression: str = VECTOR_COMPRESSION, vectors_file: str = None,
+                block: int = 65536):
+    """
+    Embedding batch'lerinden indeksi oluşturur.
+    
+    Eğitim gerektirmeyen indeksler (flat, hnsw, fp16) batch batch doğrudan
+    indekse eklenir. Eğitim gerektirenler için vektörler önce tek bir
+    matriste toplanır, indeks bu matris üzerinde eğitilip doldurulur.
+    vectors_file verilirse tam hassasiyetli vektörler bu .npy dosyasına
+    yazılır (yeniden sıralama için) ve eğitim matrisi olarak da o kullanılır.
+    """
+    index = None
+    matrix = None
+    
+    for start, vectors in batches:
+        if index is None:
+            index = create_index(vectors.shape[1], n_vectors, index_type, compression)
+            if vectors_file:
+                matrix = compressed_index.create_vectors_file(vectors_file, n_vectors, vectors.shape[1])
+            elif not index.is_trained:
+                matrix = np.empty((n_vectors, vectors.shape[1]), dtype=np.float32)
+        if matrix is not None:
+            matrix[start:start + len(vectors)] = vectors
+        if index.is_trained:
+            index.add(vectors)
+    
+    if index is not None and not index.is_trained:
+        print(f"🎯 {type(index).__name__} indeksi eğitiliyor...")
+        index.train(np.ascontiguousarray(matrix))
+        for start in range(0, n_vectors, block):
+            index.add(np.ascontiguousarray(matrix[start:start + block]))
+    
+    if isinstance(matrix, np.memmap):
+        matrix.flush()
+    return index
+
+
+def kept_rows_after_delete(vectorstore: FAISS, ids: list) -> list:
+    """Silme sonrası kalacak FAISS satırları (mevcut sırayla)."""
+    to_delete = set(ids)
+    return [row for row, doc_id in sorted(vectorstore.index_to_docstore_id.items())
+            if doc_id not in to_delete]
+
+
+def delete_from_vector_store(vectorstore: FAISS, ids: list, full_vectors: np.ndarray = None):
+    """
+    Verilen id'leri indeksten ve docstore'dan siler.
+    
+    HNSW silmeyi desteklemez, IVF ise silmeden sonra satır numaralarını
+    kaydırmaz (LangChain'in id eşlemesiyle uyuşmaz). Bu tiplerde kalan
+    vektörler (full_vectors verilmişse oradan, yoksa indeksten) okunup
+    indeks aynı eğitimle yeniden doldurulur; yeniden embedding gerekmez.
+    """
+    index = faiss.downcast_index(vectorstore.index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if not isinstance(index, faiss.IndexHNSW) and ivf is None:
+        vectorstore.delete(ids)
+        return
+    
+    kept_rows = kept_rows_after_delete(vectorstore, ids)
+    if full_vectors is not None:
+        vectors = np.asarray(full_vectors[kept_rows], dtype=np.float32)
+    else:
+        if ivf is not None:
+            ivf.make_direct_map()
+        vectors = index.reconstruct_batch(np.asarray(kept_rows, dtype=np.int64))
+        if ivf is not None:
+            ivf.make_direct_map(False)
+    
+    index.reset()
+    if len(kept_rows):
+        index.add(vectors)
+    vectorstore.docstore.delete(ids)
+    vectorstore.index_to_docstore_id = {
+        new_row: vectorstore.index_to_docstore_id[row] for new_row, row in enumerate(kept_rows)
+    }
+
+
+def assemble_vector_store(chunks: list, index, embedding_model) -> FAISS:
+    """Dolu FAISS indeksi ve chunk'lardan tek seferde vektör deposu kurar."""
+    # Id'ler bir kez atanır; docstore tek bir dict olarak oluşturulur
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    docstore = InMemoryDocstore(dict(zip(ids, chunks)))
+    index_to_docstore_id = dict(enumerate(ids))
+    
+    return FAISS(embedding_model, index, docstore, index_to_docstore_id)
+
+
+def save_vector_store(vectorstore: FAISS, index_path: str = INDEX_PATH,
+                      docstore_format: str = DOCSTORE_FORMAT):
+    """İndeksi ve docstore'u seçilen formatta (pickle / chunks / both) ve BM25 indeksini kaydeder."""
+    os.makedirs(index_path, exist_ok=True)
+    pickle_path = os.path.join(index_path, "index.pkl")
+    
+    if docstore_format in ("pickle", "both"):
+        vectorstore.save_local(index_path)
+    else:
+        faiss.write_index(vectorstore.index, os.path.join(index_path, "index.faiss"))
+        if os.path.exists(pickle_path):
+            os.remove(pickle_path)  # eski pickle yeni indeksle karışmasın
+    
+    if docstore_format in ("chunks", "both"):
+        chunk_store.save_from_vectorstore(vectorstore, index_path)
+    elif chunk_store.exists(index_path):
+        chunk_store.remove(index_path)
+    
+    # Hybrid arama için BM25 ters indeksi (FAISS satır sırasıyla)
+    bm25_index.BM25Index.from_vectorstore(vectorstore).save(index_path)
+
+
+def load_vector_store_for_update(index_path: str, embedding_model) -> FAISS:
+    """Mevcut indeksi değiştirilebilir docstore ile yükler; chunk deposu varsa pickle açılmaz."""
+    if chunk_store.exists(index_path):
+        docstore, index_to_docstore_id = chunk_store.ChunkStore(index_path).to_in_memory()
+        index = faiss.read_index(os.path.join(index_path, "index.faiss"))
+        return FAISS(embedding_model, index, docstore, index_to_docstore_id)
+    
+    return FAISS.load_local(
+        index_path,
+        embedding_model,
+        allow_dangerous_deserialization=True
+    )
+
+
 def build_vector_store_with_progress(chunks: list, model_name: str = EMBEDDING_MODEL, 
                                      index_path: str = INDEX_PATH,
-                                     batch_size: int = BATCH_SIZE) -> FAISS:
+                                     batch_size: int = BATCH_SIZE,
+                                     embedding_model=None,
+                                     workers: int = WORKERS,
+                                     model_factory=None,
+                                     cache: EmbeddingCache = None,
+                                     docstore_format: str = DOCSTORE_FORMAT,
+                                     index_type: str = INDEX_TYPE,
+                                     compression: str = VECTOR_COMPRESSION,
+                                     threads_per_worker: int = THREADS_PER_WORKER) -> FAISS:
     """
     Embedding modeli ile FAISS vektör deposu oluşturur - Progress bar ile!
     
+    Embedding'ler batch batch tek bir (append-only) FAISS indeksine eklenir;
+    ara FAISS nesnesi ve merge_from yoktur. Docstore bir kez oluşturulup
+    indeksle birlikte tek seferde kaydedilir.
+    
     Args:
         chunks: Embedding yapılacak chunk'lar
         model_name: Kullanılacak embedding modeli
         index_path: İndeksin kaydedileceği yol
         batch_size: Her batch'te kaç chunk işlenecek
+        embedding_model: Hazır embedding modeli (verilmezse model_name ile yüklenir);
+            workers > 1 ise aynı modeli üreten model_factory ile birlikte verilmelidir
+        workers: Embedding worker süreç sayısı (1: tek süreç)
+        model_factory: Worker'larda model oluşturan fonksiyon (varsayılan: create_embedding_model)
+        threads_per_worker: Worker başına torch thread sayısı (None: çekirdek sayısı / worker sayısı)
+        cache: Chunk embedding önbelleği (verilirse sadece eksikler embed edilir)
+        docstore_format: Docstore kayıt formatı ("pickle", "chunks", "both")
+        index_type: FAISS indeks tipi ("flat", "hnsw", "ivf_flat", "ivf_pq")
+        compression: Vektör sıkıştırma (None, "fp16", "sq8", "pq"); kayıplı
+            indekslerde tam vektörler yeniden sıralama için vectors.npy'ye yazılır
         
     Returns:
         FAISS: Oluşturulan vektör deposu
     """
+    if workers > 1 and embedding_model is not None and model_factory is None:
+        # Worker'lar model_name'den kendi modellerini yükler; indeks başka bir modelle embed edilirdi
+        raise ValueError("workers > 1 ile embedding_model verildiğinde aynı modeli üreten model_factory de verilmelidir")
+    
     print(f"{'='*60}")
     print(f"🤖 EMBEDDING MODELİ YÜKLENİYOR...")
     print(f"   Model: {model_name}")
     print(f"{'='*60}\n")
     
     try:
-        # Embedding modelini yükle
-        embedding_model = HuggingFaceEmbeddings(
-            model_name=model_name,
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={
-                'normalize_embeddings': True,
-                'batch_size': batch_size,
-            }
-        )
+        # Embedding modelini yükle (paralel modda modeller worker'larda yüklenir)
+        if model_factory is None:
+            model_factory = functools.partial(create_embedding_model, model_name, batch_size)
+        if embedding_model is None:
+            embedding_model = LazyEmbeddings(model_factory) if workers > 1 else model_factory()
         
         print(f"🔄 EMBEDDING İŞLEMİ BAŞLIYOR...")
         print(f"   • Toplam chunk: {len(chunks)}")
         print(f"   • Batch boyutu: {batch_size}")
+        print(f"   • Worker sayısı: {workers}")
+        print(f"   • İndeks tipi: {index_type}" + (f" ({compression})" if compression else ""))
         print(f"   • Tahmini batch sayısı: {(len(chunks) + batch_size - 1) // batch_size}\n")
         
-        # Batch'ler halinde embedding yap
-        vectorstore = None
+        # Batch'ler halinde embedding yap ve indeksi oluştur
+        index_type = resolve_index_type(index_type, len(chunks))
+        compression = resolve_compression(compression, len(chunks))
+        vectors_file = None
+        if is_lossy(index_type, compression):
+            os.makedirs(index_path, exist_ok=True)
+            vectors_file = compressed_index.vectors_path(index_path) + ".tmp"
+        index = build_index(
+            embedding_batches(chunks, embedding_model, batch_size, workers, model_factory, cache,
+                              threads_per_worker),
+            len(chunks),
+            index_type,
+            compression,
+            vectors_file
+        )
         
-        for i in tqdm(range(0, len(chunks), batch_size), 
-                     desc="🧮 Embedding yapılıyor",
-                     unit="batch",
-                     bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'):
-            
-            batch = chunks[i:i + batch_size]
-            
-            if vectorstore is None:
-                # İlk batch - yeni vectorstore oluştur
-                vectorstore = FAISS.from_documents(batch, embedding_model)
-            else:
-                # Sonraki batch'ler - mevcut vectorstore'a ekle
-                batch_vectorstore = FAISS.from_documents(batch, embedding_model)
-                vectorstore.merge_from(batch_vectorstore)
+        vectorstore = assemble_vector_store(chunks, index, embedding_model)
         
         print(f"\n✅ Embedding tamamlandı!\n")
         
         # İndeksi kaydet
         print("💾 İndeks kaydediliyor...")
-        os.makedirs(os.path.dirname(index_path), exist_ok=True)
-        vectorstore.save_local(index_path)
+        save_vector_store(vectorstore, index_path, docstore_format)
+        compressed_index.commit_vectors(index_path, vectors_file)
         
         print(f"\n{'='*60}")
         print(f"✅ BAŞARILI!")
@@ -168,6 +596,190 @@ def build_vector_store_with_progress(chunks: list, model_name: str = EMBEDDING_M
         raise
 
 
+def source_key(path: str) -> str:
+    """Kaynak yolunu platformdan bağımsız bir anahtara çevirir (dosya adı)."""
+    return os.path.basename(path.replace("\\", "/"))
+
+
+def file_sha256(path: str) -> str:
+    """Dosya içeriğinin SHA-256 özetini döndürür."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(index_path: str = INDEX_PATH) -> dict:
+    """İndeksin yanındaki manifest'i yükler; yoksa boş manifest döner."""
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {"files": {}}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, index_path: str = INDEX_PATH):
+    """Manifest'i indeks klasörüne yazar."""
+    os.makedirs(index_path, exist_ok=True)
+    with open(os.path.join(index_path, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def ids_by_source(vectorstore: FAISS) -> dict:
+    """Docstore'u tarayıp her kaynak dosyaya ait docstore id'lerini gruplar."""
+    grouped = {}
+    for _, doc_id in sorted(vectorstore.index_to_docstore_id.items()):
+        doc = vectorstore.docstore.search(doc_id)
+        key = source_key(doc.metadata.get('source', 'Unknown'))
+        grouped.setdefault(key, []).append(doc_id)
+    return grouped
+
+
+def build_manifest(pdf_files: list, vectorstore: FAISS) -> dict:
+    """
+    PDF hash'leri ve chunk id'lerinden manifest oluşturur. İndekste chunk'ı
+    olmayan (yüklenemeyen) dosyalar yazılmaz; sonraki güncellemede yeniden denenir.
+    """
+    grouped = ids_by_source(vectorstore)
+    return {
+        "files": {
+            source_key(pdf): {
+                "sha256": file_sha256(pdf),
+                "ids": grouped[source_key(pdf)],
+            }
+            for pdf in pdf_files
+            if source_key(pdf) in grouped
+        }
+    }
+
+
+def update_vector_store_incremental(pdf_folder: str = PDF_FOLDER,
+                                    model_name: str = EMBEDDING_MODEL,
+                                    index_path: str = INDEX_PATH,
+                                    batch_size: int = BATCH_SIZE,
+                                    workers: int = WORKERS,
+                                    cache: EmbeddingCache = None,
+                                    docstore_format: str = DOCSTORE_FORMAT,
+                                    threads_per_worker: int = THREADS_PER_WORKER,
+                                    index_type: str = INDEX_TYPE,
+                                    compression: str = VECTOR_COMPRESSION) -> FAISS:
+    """
+    Mevcut indeksi yalnızca değişen PDF'ler için günceller.
+    
+    Yeni/değişen dosyaların chunk'ları embed edilir, silinen/değişen
+    dosyaların vektörleri ve docstore kayıtları indeksten çıkarılır.
+    Maliyet sadece değişen dokümanlarla orantılıdır. index_type ve
+    compression sadece indeks henüz yoksa (ilk tam oluşturmada) kullanılır;
+    mevcut indeks kendi tipiyle güncellenir.
+    
+    Returns:
+        FAISS: Güncellenmiş vektör deposu
+    """
+    pdf_files = list_pdfs(pdf_folder)
+    
+    if not os.path.exists(os.path.join(index_path, "index.faiss")):
+        print("ℹ️  Mevcut indeks bulunamadı, tam oluşturma yapılıyor...\n")
+        chunks = create_chunks(load_pdfs(pdf_folder, pdf_files))
+        vectorstore = build_vector_store_with_progress(chunks, model_name, index_path, batch_size,
+                                                       workers=workers, cache=cache,
+                                                       docstore_format=docstore_format,
+                                                       threads_per_worker=threads_per_worker,
+                                                       index_type=index_type, compression=compression)
+        save_manifest(build_manifest(pdf_files, vectorstore), index_path)
+        return vectorstore
+    
+    model_factory = functools.partial(create_embedding_model, model_name, batch_size)
+    embedding_model = LazyEmbeddings(model_factory) if workers > 1 else model_factory()
+    vectorstore = load_vector_store_for_update(index_path, embedding_model)
+    
+    manifest = load_manifest(index_path)
+    known_files = manifest["files"]
+    if not known_files:
+        # Manifest'siz eski indeks: hash bilinmediği için tüm dosyalar değişmiş sayılır
+        print("⚠️  Manifest bulunamadı, tüm dosyalar yeniden embed edilecek.\n")
+        known_files = {key: {"sha256": None, "ids": ids}
+                       for key, ids in ids_by_source(vectorstore).items()}
+    
+    current_hashes = {source_key(pdf): (pdf, file_sha256(pdf)) for pdf in pdf_files}
+    changed_files = [pdf for key, (pdf, sha) in current_hashes.items()
+                     if known_files.get(key, {}).get("sha256") != sha]
+    removed_keys = [key for key in known_files if key not in current_hashes]
+    
+    print(f"{'='*60}")
+    print(f"🔁 INCREMENTAL GÜNCELLEME:")
+    print(f"   • Yeni/değişen dosya: {len(changed_files)}")
+    print(f"   • Silinen dosya: {len(removed_keys)}")
+    print(f"   • Değişmeyen dosya: {len(pdf_files) - len(changed_files)}")
+    print(f"{'='*60}\n")
+    
+    if not changed_files and not removed_keys:
+        print("✅ İndeks güncel, yapılacak işlem yok.\n")
+        return vectorstore
+    
+    # 1. Yeni/değişen dosyaları yükle. Yüklenemeyen dosyanın eski vektörleri ve
+    # manifest kaydı korunur; hash'i yazılmadığı için sonraki güncellemede yeniden denenir.
+    chunks = []
+    if changed_files:
+        documents = load_pdfs(pdf_folder, changed_files)
+        loaded_keys = {source_key(doc.metadata.get('source', 'Unknown')) for doc in documents}
+        failed_files = [pdf for pdf in changed_files if source_key(pdf) not in loaded_keys]
+        if failed_files:
+            print(f"⚠️  {len(failed_files)} dosya yüklenemedi, eski chunk'ları indekste bırakılıyor.\n")
+            changed_files = [pdf for pdf in changed_files if source_key(pdf) in loaded_keys]
+        chunks = create_chunks(documents)
+    stale_keys = removed_keys + [source_key(pdf) for pdf in changed_files if source_key(pdf) in known_files]
+    
+    if not changed_files and not removed_keys:
+        print("✅ Yüklenebilen değişiklik yok, indeks değiştirilmedi.\n")
+        return vectorstore
+    
+    # 2. Eski vektörleri ve docstore kayıtlarını sil
+    full_vectors = compressed_index.open_vectors(index_path)  # kayıplı indekslerde tam vektörler
+    kept_rows = list(range(vectorstore.index.ntotal))
+    new_vectors = []
+    stale_ids = [doc_id for key in stale_keys for doc_id in known_files[key].get("ids", [])]
+    if stale_ids:
+        kept_rows = kept_rows_after_delete(vectorstore, stale_ids)
+        delete_from_vector_store(vectorstore, stale_ids, full_vectors)
+        print(f"🗑️  {len(stale_ids)} eski chunk indeksten silindi.\n")
+    for key in stale_keys:
+        known_files.pop(key, None)
+    
+    # 3. Sadece yeni/değişen dosyaları embed et
+    if changed_files:
+        for i, vectors in embedding_batches(chunks, embedding_model, batch_size,
+                                            workers, model_factory, cache, threads_per_worker):
+            batch = chunks[i:i + len(vectors)]
+            if full_vectors is not None:
+                new_vectors.append(vectors)
+            batch_ids = vectorstore.add_embeddings(
+                zip([doc.page_content for doc in batch], vectors),
+                metadatas=[doc.metadata for doc in batch]
+            )
+            for doc, doc_id in zip(batch, batch_ids):
+                key = source_key(doc.metadata.get('source', 'Unknown'))
+                known_files.setdefault(key, {"sha256": None, "ids": []})["ids"].append(doc_id)
+        for pdf in changed_files:
+            key = source_key(pdf)
+            known_files.setdefault(key, {"sha256": None, "ids": []})["sha256"] = current_hashes[key][1]
+    
+    # 4. İndeksi ve manifest'i kaydet
+    print("💾 İndeks kaydediliyor...")
+    save_vector_store(vectorstore, index_path, docstore_format)
+    if full_vectors is not None:
+        dim = full_vectors.shape[1]
+        del full_vectors  # eski dosyanın yerine yenisi yazılacak
+        compressed_index.rewrite_vectors(
+            index_path, kept_rows,
+            np.vstack(new_vectors) if new_vectors else np.empty((0, dim), dtype=np.float32)
+        )
+    save_manifest({"files": known_files}, index_path)
+    
+    print(f"\n✅ Güncelleme tamamlandı! Toplam vektör: {vectorstore.index.ntotal}\n")
+    return vectorstore
+
+
 def get_folder_size(folder_path: str) -> float:
     """Klasör boyutunu MB cinsinden döndürür"""
     total_size = 0
@@ -181,21 +793,91 @@ def get_folder_size(folder_path: str) -> float:
         return 0.0
 
 
-def main():
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """Komut satırı argümanlarını okur."""
+    parser = argparse.ArgumentParser(description="PDF'lerden FAISS vektör indeksi oluşturur.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Sadece yeni/değişen PDF'leri embed et, silinenleri indeksten çıkar")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Paralel embedding için worker süreç sayısı (varsayılan: 1)")
+    parser.add_argument("--threads-per-worker", type=int, default=THREADS_PER_WORKER,
+                        help="Worker başına torch thread sayısı (varsayılan: çekirdek sayısı / worker sayısı)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Chunk embedding önbelleğini kullanma")
+    parser.add_argument("--docstore", choices=["pickle", "chunks", "both"], default=DOCSTORE_FORMAT,
+                        help="Docstore formatı: index.pkl, pickle'sız chunk deposu veya ikisi")
+    parser.add_argument("--index-type", choices=["flat", "hnsw", "ivf_flat", "ivf_pq"], default=INDEX_TYPE,
+                        help="FAISS indeks tipi (varsayılan: config.INDEX_TYPE)")
+    parser.add_argument("--compression", choices=compressed_index.COMPRESSIONS, default=VECTOR_COMPRESSION,
+                        help="Vektörleri fp16 / int8 / PQ olarak sıkıştır, tam vektörlerle yeniden sırala")
+    parser.add_argument("--convert-docstore", action="store_true",
+                        help="Mevcut index.pkl'den embedding yapmadan chunk deposu oluştur")
+    parser.add_argument("--shards", nargs="*", metavar="NAME",
+                        help=f"{PDF_FOLDER}/<isim> klasörlerini ayrı shard'lar olarak {SHARDS_PATH}/<isim> "
+                             "altına oluştur (isim verilmezse PDF içeren tüm alt klasörler)")
+    return parser.parse_args(argv)
+
+
+def build_targets(shards: list = None) -> list:
+    """(etiket, PDF klasörü, indeks klasörü) listesi; shards None ise tek indeks."""
+    if shards is None:
+        return [(None, PDF_FOLDER, INDEX_PATH)]
+    if not shards:
+        shards = sorted(name for name in os.listdir(PDF_FOLDER)
+                        if os.path.isdir(os.path.join(PDF_FOLDER, name))
+                        and list_pdfs(os.path.join(PDF_FOLDER, name)))
+    if not shards:
+        raise FileNotFoundError(f"{PDF_FOLDER} altında PDF içeren alt klasör yok")
+    return [(name, os.path.join(PDF_FOLDER, name), os.path.join(SHARDS_PATH, name)) for name in shards]
+
+
+def main(argv: list = None):
     """Ana fonksiyon - tüm pipeline'ı çalıştırır"""
+    args = parse_args(argv)
+    cache = None if args.no_cache else EmbeddingCache(EMBED_CACHE_DIR, EMBEDDING_MODEL)
+    
     print("\n" + "="*60)
     print("🚀 HUAWEI CLOUD RAG - VEKTÖR İNDEKSİ OLUŞTURMA")
     print("="*60 + "\n")
     
     try:
-        # 1. PDF'leri yükle
-        documents = load_pdfs(PDF_FOLDER)
-        
-        # 2. Chunk'lara böl
-        chunks = create_chunks(documents)
-        
-        # 3. FAISS vektör deposu oluştur (Progress bar ile!)
-        vectorstore = build_vector_store_with_progress(chunks)
+        for shard, pdf_folder, index_path in build_targets(args.shards):
+            if shard is not None:
+                print(f"\n📦 Shard: {shard} ({pdf_folder} -> {index_path})")
+            if args.convert_docstore:
+                # Embedding gerekmez; model sadece FAISS nesnesi için tembel tutulur
+                vectorstore = FAISS.load_local(
+                    index_path,
+                    LazyEmbeddings(functools.partial(create_embedding_model, EMBEDDING_MODEL)),
+                    allow_dangerous_deserialization=True
+                )
+                chunk_store.save_from_vectorstore(vectorstore, index_path)
+                bm25_index.BM25Index.from_vectorstore(vectorstore).save(index_path)
+                print(f"✅ Chunk deposu ve BM25 indeksi oluşturuldu: {index_path} ({vectorstore.index.ntotal} chunk)")
+            elif args.incremental:
+                update_vector_store_incremental(pdf_folder, index_path=index_path, workers=args.workers,
+                                                cache=cache, docstore_format=args.docstore,
+                                                threads_per_worker=args.threads_per_worker,
+                                                index_type=args.index_type, compression=args.compression)
+            else:
+                # 1. PDF'leri yükle
+                pdf_files = list_pdfs(pdf_folder)
+                documents = load_pdfs(pdf_folder, pdf_files)
+                
+                # 2. Chunk'lara böl
+                chunks = create_chunks(documents)
+                
+                # 3. FAISS vektör deposu oluştur (Progress bar ile!)
+                vectorstore = build_vector_store_with_progress(chunks, index_path=index_path,
+                                                               workers=args.workers,
+                                                               threads_per_worker=args.threads_per_worker,
+                                                               cache=cache,
+                                                               docstore_format=args.docstore,
+                                                               index_type=args.index_type,
+                                                               compression=args.compression)
+                
+                # 4. Incremental güncellemeler için manifest yaz
+                save_manifest(build_manifest(pdf_files, vectorstore), index_path)
         
         print("\n" + "="*60)
         print("🎉 İŞLEM TAMAMLANDI!")
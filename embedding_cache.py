@@ -0,0 +1,234 @@
+"""
+embedding_cache.py
+Embedding önbellekleri: chunk vektörleri için kalıcı disk önbelleği ve
+sorgu vektörleri için LRU önbellek.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional
+from langchain_core.embeddings import Embeddings
+
+KEY_SIZE = 16  # BLAKE2b özet boyutu (bayt)
+
+
+class EmbeddingCache:
+    """
+    (model adı, normalize bayrağı, chunk metni) özetiyle anahtarlanan vektör önbelleği.
+
+    Dosyalar (model başına bir klasör):
+        vectors.f32 - satır satır float32 vektörler, np.memmap ile okunur
+        keys.bin    - her satırın 16 baytlık özeti, vektörlerle aynı sırada
+        meta.json   - vektör boyutu
+
+    Kayıtlar her batch'ten sonra dosyaya eklenir; yarım kalan bir build
+    tekrar çalıştırıldığında kaldığı yerden devam eder.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, normalize: bool = True):
+        self.model_name = model_name
+        self.normalize = normalize
+        self.path = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.keys_path = os.path.join(self.path, "keys.bin")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        os.makedirs(self.path, exist_ok=True)
+
+        self.dim = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+
+        self.index = {}  # özet -> satır
+        self._mmap = None
+        self._load()
+
+    def _load(self):
+        """Hash indeksini okur; yarım yazılmış son kaydı keser."""
+        if self.dim is None:
+            return
+        key_bytes = os.path.getsize(self.keys_path) if os.path.exists(self.keys_path) else 0
+        vec_bytes = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        rows = min(key_bytes // KEY_SIZE, vec_bytes // (self.dim * 4))
+
+        # Süreç yazarken öldürüldüyse iki dosya arasında fark olabilir
+        if key_bytes != rows * KEY_SIZE:
+            os.truncate(self.keys_path, rows * KEY_SIZE)
+        if vec_bytes != rows * self.dim * 4:
+            os.truncate(self.vectors_path, rows * self.dim * 4)
+
+        if rows:
+            with open(self.keys_path, "rb") as f:
+                data = f.read()
+            self.index = {data[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(rows)}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def key(self, text: str) -> bytes:
+        """Metnin model ve normalize bayrağıyla birlikte özetini döndürür."""
+        payload = f"{self.model_name}\0{int(self.normalize)}\0{text}".encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=KEY_SIZE).digest()
+
+    def lookup(self, texts: List[str]) -> List[Optional[int]]:
+        """Her metin için önbellekteki satır numarasını (yoksa None) döndürür."""
+        return [self.index.get(self.key(text)) for text in texts]
+
+    def vectors(self, rows) -> np.ndarray:
+        """Verilen satırlardaki vektörleri memory-mapped dosyadan okur."""
+        if self._mmap is None or self._mmap.shape[0] < len(self.index):
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                   shape=(len(self.index), self.dim))
+        return np.asarray(self._mmap[np.asarray(rows, dtype=np.int64)])
+
+    def add(self, texts: List[str], vectors: np.ndarray) -> List[int]:
+        """Yeni vektörleri dosyaya ekler ve satır numaralarını döndürür."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding boyutu uyuşmuyor: {vectors.shape[1]} != {self.dim}")
+
+        rows = []
+        new_keys = []
+        new_vectors = []
+        for text, vector in zip(texts, vectors):
+            key = self.key(text)
+            if key in self.index:
+                rows.append(self.index[key])
+                continue
+            self.index[key] = len(self.index)
+            rows.append(self.index[key])
+            new_keys.append(key)
+            new_vectors.append(vector)
+
+        if new_keys:
+            # Önce vektörler, sonra anahtarlar: yarım kayıt _load'da kesilir
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.stack(new_vectors).tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+        return rows
+
+
+class QueryEmbeddingCache(Embeddings):
+    """
+    embed_query sonuçlarını normalize edilmiş sorgu metnine göre LRU önbellekte tutar.
+
+    Tekrarlanan sorgular ve bağlamsal yeniden yazımlar model çağrısı yapmaz.
+    embed_documents doğrudan alttaki modele iletilir. persist_path verilirse
+    önbellek save() ile diske yazılır ve sonraki açılışta yüklenir.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_size: int = 1024,
+                 persist_path: str = None, model_name: str = ""):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.model_name = model_name
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if persist_path and os.path.exists(persist_path):
+            self.load()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Boşlukları sadeleştirir ve büyük/küçük harf farkını kaldırır."""
+        return " ".join(text.split()).casefold()
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.normalize(text)
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+
+        vector = self.embeddings.embed_query(text)
+
+        with self._lock:
+            self.cache[key] = vector
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        embed_query'nin batch versiyonu: önbellekte olmayan sorgular tek
+        embed_documents çağrısıyla hesaplanıp önbelleğe eklenir.
+        """
+        keys = [self.normalize(text) for text in texts]
+        vectors = [None] * len(texts)
+        missing = {}  # anahtar -> ilk geldiği sıra (aynı sorgu bir kez hesaplanır)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    vectors[i] = self.cache[key]
+                else:
+                    self.misses += 1
+                    missing.setdefault(key, i)
+
+        if missing:
+            computed = self.embeddings.embed_documents([texts[i] for i in missing.values()])
+            computed = dict(zip(missing, computed))
+            with self._lock:
+                for key, vector in computed.items():
+                    self.cache[key] = vector
+                    self.cache.move_to_end(key)
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+            for i, key in enumerate(keys):
+                if vectors[i] is None:
+                    vectors[i] = computed[key]
+        return vectors
+
+    def stats(self) -> dict:
+        """Önbellek boyutu ve hit/miss sayaçları."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self.cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self):
+        """Önbelleği persist_path'e yazar (yol yoksa bir şey yapmaz)."""
+        if not self.persist_path:
+            return
+        with self._lock:
+            keys = list(self.cache.keys())
+            vectors = np.asarray(list(self.cache.values()), dtype=np.float32)
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+        with open(self.persist_path, "wb") as f:
+            np.savez(f, keys=np.asarray(keys, dtype=str), vectors=vectors,
+                     model=np.asarray(self.model_name))
+
+    def load(self):
+        """persist_path'teki önbelleği yükler; farklı modele aitse yok sayar."""
+        try:
+            with np.load(self.persist_path, allow_pickle=False) as data:
+                if str(data["model"]) != self.model_name:
+                    return
+                keys = data["keys"].tolist()
+                vectors = data["vectors"].tolist()
+        except (OSError, KeyError, ValueError):
+            return
+        for key, vector in list(zip(keys, vectors))[-self.max_size:]:
+            self.cache[key] = vector
@@ -0,0 +1,76 @@
+"""
+hybrid_retriever.py
+BM25 + dense (FAISS) aramayı reciprocal-rank fusion (RRF) ile birleştiren retriever.
+"""
+
+from typing import Any, List, Sequence, Tuple
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from metadata_filter import search_rows
+
+
+def reciprocal_rank_scores(rankings: Sequence[Sequence[int]], k: int,
+                           rrf_k: int = 60) -> List[Tuple[int, float]]:
+    """
+    Sıralı satır listelerini RRF ile birleştirir: skor = Σ 1 / (rrf_k + sıra).
+
+    Skorların ölçeği (L2 mesafesi / BM25) farklı olduğu için sadece sıralar
+    kullanılır. Eşitlikte ilk listede daha önce gelen satır öne geçer.
+    İlk k (satır, RRF skoru) çiftini döndürür.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, 1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])[:k]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int, rrf_k: int = 60) -> List[int]:
+    """reciprocal_rank_scores'un sadece satırları."""
+    return [row for row, _ in reciprocal_rank_scores(rankings, k, rrf_k)]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Dense ve BM25 sonuçlarından her birinde fetch_k aday alır, RRF ile
+    birleştirip ilk k chunk'ı döndürür. as_retriever() ile aynı arayüz
+    (invoke) kullanıldığı için rag_engine ve diagram_chat değişmeden çalışır.
+    rows verilirse (metadata filtresi) iki arama da sadece bu satırlarda yapılır.
+    """
+
+    vectorstore: Any
+    bm25: Any
+    k: int = 8
+    fetch_k: int = 40
+    rrf_k: int = 60
+    rows: Any = None
+
+    def dense_rows(self, query: str) -> List[int]:
+        """FAISS'te en yakın fetch_k satır."""
+        vector = np.asarray([self.vectorstore.embedding_function.embed_query(query)], dtype=np.float32)
+        if self.rows is not None:
+            _, rows = search_rows(self.vectorstore.index, vector, self.fetch_k, self.rows)
+        else:
+            _, rows = self.vectorstore.index.search(vector, self.fetch_k)
+        return [int(row) for row in rows[0] if row >= 0]
+
+    def bm25_rows(self, query: str) -> List[int]:
+        """BM25 skoru en yüksek fetch_k satır."""
+        rows, _ = self.bm25.search(query, self.fetch_k, self.rows)
+        return [int(row) for row in rows]
+
+    def fuse_with_scores(self, query: str, dense_rows: List[int]) -> List[Tuple[Document, float]]:
+        """Önceden bulunmuş dense satırlarını BM25 sonuçlarıyla birleştirir; (chunk, RRF skoru) döndürür."""
+        fused = reciprocal_rank_scores([dense_rows, self.bm25_rows(query)], self.k, self.rrf_k)
+        mapping = self.vectorstore.index_to_docstore_id
+        return [(self.vectorstore.docstore.search(mapping[row]), score) for row, score in fused]
+
+    def fuse(self, query: str, dense_rows: List[int]) -> List[Document]:
+        """fuse_with_scores'un sadece chunk'ları."""
+        return [doc for doc, _ in self.fuse_with_scores(query, dense_rows)]
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.fuse(query, self.dense_rows(query))
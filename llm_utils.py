@@ -4,10 +4,17 @@ LLM initialization and utility functions.
 """
 
 import os
+import time
+import warnings
+import functools
+from typing import Callable, Dict, Tuple
 from langchain_openai import ChatOpenAI
 
+TOKENIZER_ENCODING = "cl100k_base"
 
-def initialize_llm(api_key: str, api_base: str, model_name: str, temperature: float) -> ChatOpenAI:
+
+def initialize_llm(api_key: str, api_base: str, model_name: str, temperature: float,
+                   verbose: bool = True) -> ChatOpenAI:
     """LLM modelini başlatır."""
     # LangChain API ortam değişkenleri
     os.environ["OPENAI_API_KEY"] = api_key
@@ -16,13 +23,73 @@ def initialize_llm(api_key: str, api_base: str, model_name: str, temperature: fl
     llm = ChatOpenAI(
         model=model_name, 
         temperature=temperature,
-        max_tokens=5000
+        max_tokens=5000,
+        stream_usage=True  # stream sonunda token kullanımı da gelsin
     )
     
-    print("LLM ready!\n")
+    if verbose:
+        print("LLM ready!\n")
     return llm
 
 
+@functools.lru_cache(maxsize=1)
+def _token_encoder():
+    """tiktoken kodlayıcısı; yüklenemezse (ör. offline) None ve bir kez uyarı."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # Tahmin gerçek token sayısından az olabilir: CONTEXT_TOKEN_BUDGET aşılabilir
+        warnings.warn(f"tiktoken unavailable ({e}); token counts fall back to ~4 characters/token "
+                      f"and may exceed the context budget", RuntimeWarning, stacklevel=3)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Metnin token sayısı (tiktoken yoksa ~4 karakter/token tahmini)."""
+    encoder = _token_encoder()
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def stream_completion(llm: ChatOpenAI, prompt: str,
+                      on_token: Callable[[str], None] = None) -> Tuple[str, Dict]:
+    """
+    LLM cevabını stream ederek alır; her parça geldikçe on_token çağrılır.
+    
+    Returns:
+        (cevap metni, {"ttft", "total", "output_tokens", "tokens_per_sec"})
+        ttft: ilk token'a kadar geçen süre (sn). Endpoint kullanım bilgisi
+        göndermezse token sayısı tiktoken ile hesaplanır.
+    """
+    start = time.perf_counter()
+    first = None
+    usage = None
+    parts = []
+    
+    for chunk in llm.stream(prompt):
+        if chunk.content:
+            if first is None:
+                first = time.perf_counter()
+            parts.append(chunk.content)
+            if on_token:
+                on_token(chunk.content)
+        if getattr(chunk, "usage_metadata", None):
+            usage = chunk.usage_metadata
+    
+    end = time.perf_counter()
+    first = first or end
+    answer = "".join(parts)
+    tokens = usage["output_tokens"] if usage else count_tokens(answer)
+    return answer, {
+        "ttft": first - start,
+        "total": end - start,
+        "output_tokens": tokens,
+        "tokens_per_sec": tokens / (end - first) if end > first else 0.0,
+    }
+
+
 def create_rag_prompt(context: str, query: str) -> str:
     """RAG için optimize edilmiş prompt oluşturur."""
     prompt = f"""You are a Senior Cloud Engineer specialized in Huawei Cloud. Answer the question based on the provided documentation with your expertise.
@@ -4,64 +4,236 @@ FAISS vektör indeksi üzerinden RAG sorguları yapar.
 Modüler yapı ile yeniden düzenlenmiştir.
 """
 
-# Import modular components
+import time
+import threading
+import telemetry
+
+# Import modular components (ağır modüller arka planda yüklenir)
 from config import API_KEY, API_BASE, MODEL_NAME, EMBEDDING_MODEL, INDEX_PATH, TOP_K, TEMPERATURE, MAX_HISTORY
-from vectorstore import load_vectorstore
-from llm_utils import initialize_llm
-from rag_engine import query_rag_system
-from diagram_handler import handle_diagram_query
-from chat_history import ChatHistory
+from config import RETRIEVAL_MODE, HYBRID_TOP_K, CONTEXT_TOKEN_BUDGET, STREAM_ANSWERS
+from config import RELATEDNESS_GATE_LOW, RELATEDNESS_GATE_HIGH
+from config import QUERY_CACHE_SIZE, QUERY_CACHE_PATH, HNSW_EF_SEARCH, IVF_NPROBE, RERANK_FACTOR
+from config import SHARDS_PATH, INDEX_SHARDS, SHARD_SEARCH_WORKERS
+from config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE, ANSWER_CACHE_PATH
+from config import TELEMETRY_ENABLED, TRACE_PATH, METRICS_PATH
+from config import DIAGRAM_SPECULATION, DIAGRAM_SPECULATIVE_GENERATIONS
+from config import DIAGRAM_CACHE_ENABLED, DIAGRAM_CACHE_SIZE, DIAGRAM_CACHE_PATH
+
+
+class BackgroundLoader:
+    """
+    LangChain import'larını, embedding modelini, FAISS indeksini ve LLM'i
+    arka plan thread'inde yükler. Soru döngüsü hemen başlar; ilk sorgu
+    yükleme bitene kadar bekler.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.error = None
+        self.timings = {}
+        self.reported = False
+        self.started = time.perf_counter()
+
+    def start(self):
+        threading.Thread(target=self._load, name="startup-loader", daemon=True).start()
+
+    def _load(self):
+        try:
+            # 1. Ağır import'lar
+            began = time.perf_counter()
+            from vectorstore import load_vectorstore
+            from llm_utils import initialize_llm
+            from rag_engine import query_rag_system
+            from diagram_handler import handle_diagram_query
+            from chat_history import ChatHistory
+            from answer_cache import AnswerCache
+            from diagram_cache import DiagramCache
+            self.query_rag_system = query_rag_system
+            self.handle_diagram_query = handle_diagram_query
+            self.timings["imports"] = time.perf_counter() - began
+
+            # 2. Vektör deposunu yükle (model + indeks süreleri timings'e yazılır)
+            index_path = SHARDS_PATH if INDEX_SHARDS else INDEX_PATH
+            self.vectorstore = load_vectorstore(index_path, EMBEDDING_MODEL, QUERY_CACHE_SIZE, QUERY_CACHE_PATH,
+                                                verbose=False, timings=self.timings,
+                                                ef_search=HNSW_EF_SEARCH, nprobe=IVF_NPROBE,
+                                                rerank_factor=RERANK_FACTOR, retrieval_mode=RETRIEVAL_MODE,
+                                                shards=INDEX_SHARDS, shard_workers=SHARD_SEARCH_WORKERS)
+
+            # 3. LLM'i başlat
+            began = time.perf_counter()
+            self.llm = initialize_llm(API_KEY, API_BASE, MODEL_NAME, TEMPERATURE, verbose=False)
+            self.timings["llm_init"] = time.perf_counter() - began
+
+            # 4. Chat history'yi başlat (ilişki kontrolü önce embedding benzerliğiyle yapılır)
+            self.chat_history = ChatHistory(self.llm, MAX_HISTORY, embeddings=self.vectorstore.embedding_function,
+                                            gate_low=RELATEDNESS_GATE_LOW, gate_high=RELATEDNESS_GATE_HIGH)
+
+            # 5. Cevap önbelleği (indeks değiştiyse eski cevaplar geçersiz)
+            self.answer_cache = None
+            if ANSWER_CACHE_ENABLED:
+                self.answer_cache = AnswerCache(
+                    threshold=ANSWER_CACHE_THRESHOLD,
+                    ttl=ANSWER_CACHE_TTL,
+                    max_size=ANSWER_CACHE_SIZE,
+                    persist_path=ANSWER_CACHE_PATH,
+                    index_version=self.vectorstore.index_version
+                )
+
+            # 6. Diyagram önbelleği (aynı istek + netleştirme cevapları)
+            self.diagram_cache = None
+            if DIAGRAM_CACHE_ENABLED:
+                self.diagram_cache = DiagramCache(DIAGRAM_CACHE_SIZE, DIAGRAM_CACHE_PATH,
+                                                  self.vectorstore.index_version)
+        except BaseException as e:  # load_vectorstore hata durumunda exit() çağırır
+            self.error = e
+        finally:
+            self.timings["total"] = time.perf_counter() - self.started
+            self.ready.set()
+
+    def is_loaded(self) -> bool:
+        return self.ready.is_set() and self.error is None
+
+    def wait(self) -> "BackgroundLoader":
+        """Yükleme bitene kadar bekler; ilk beklemede başlangıç raporunu basar."""
+        if not self.ready.is_set():
+            print("Loading models, please wait...")
+        self.ready.wait()
+        if self.error is not None:
+            print(f"\nStartup failed: {self.error}")
+            raise SystemExit(1)
+        if not self.reported:
+            self.reported = True
+            print_startup_report(self.timings)
+        return self
+
+
+def print_startup_report(timings: dict):
+    """Başlangıç süresinin aşamalara göre dağılımını gösterir."""
+    print("\n" + "="*60)
+    print("STARTUP TIME:")
+    print(f"   Imports:     {timings.get('imports', 0):6.2f}s")
+    print(f"   Model load:  {timings.get('model_load', 0):6.2f}s")
+    print(f"   Index load:  {timings.get('index_load', 0):6.2f}s")
+    print(f"   LLM init:    {timings.get('llm_init', 0):6.2f}s")
+    print(f"   Total:       {timings.get('total', 0):6.2f}s (REPL ready after {timings.get('repl_ready', 0):.2f}s)")
+    print("="*60)
+
+
+def print_answer_stats(answer_metrics: list):
+    """Oturumdaki stream edilen cevapların ortalama TTFT ve token/sn değerleri."""
+    streamed = [m for m in answer_metrics if "ttft" in m]
+    if not streamed:
+        return
+    ttft = sum(m["ttft"] for m in streamed) / len(streamed)
+    rate = sum(m["tokens_per_sec"] for m in streamed) / len(streamed)
+    print(f"Answers: {len(streamed)} streamed, avg TTFT {ttft:.2f}s, avg {rate:.1f} tokens/s")
+
+
+def save_caches(vectorstore, answer_cache=None, chat_history=None, diagram_cache=None):
+    """Sorgu embedding, cevap ve diyagram önbelleklerini kaydeder, istatistiklerini gösterir."""
+    from embedding_cache import QueryEmbeddingCache
+
+    emb_model = vectorstore.embedding_function
+    if isinstance(emb_model, QueryEmbeddingCache):
+        stats = emb_model.stats()
+        print(f"Query embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%} hit rate)")
+        emb_model.save()
+    if answer_cache is not None:
+        stats = answer_cache.stats()
+        print(f"Answer cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%} hit rate)")
+        answer_cache.save()
+    if diagram_cache is not None:
+        stats = diagram_cache.stats()
+        print(f"Diagram cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%} hit rate)")
+        diagram_cache.save()
+    if chat_history is not None and chat_history.embeddings is not None:
+        stats = chat_history.gate_stats()
+        print(f"Relatedness check: {stats['llm_calls']} LLM calls, {stats['llm_calls_avoided']} avoided "
+              f"({stats['skipped_unrelated']} unrelated, {stats['skipped_standalone']} standalone, "
+              f"{stats['cache_hits']} cached)")
 
 
 def main():
     """Ana fonksiyon - RAG query loop"""
     print("HUAWEI CLOUD RAG - Q&A SYSTEM")
-    
-    # 1. Vektör deposunu yükle
-    vectorstore = load_vectorstore(INDEX_PATH, EMBEDDING_MODEL)
-    
-    # 2. LLM'i başlat
-    llm = initialize_llm(API_KEY, API_BASE, MODEL_NAME, TEMPERATURE)
-    
-    # 3. Chat history'yi başlat
-    chat_history = ChatHistory(llm, MAX_HISTORY)
+    telemetry.configure(TELEMETRY_ENABLED, TRACE_PATH, METRICS_PATH)
+
+    # 1-6. Model, indeks, LLM ve önbellekler arka planda yüklenir
+    loader = BackgroundLoader()
+    loader.start()
+    loader.timings["repl_ready"] = time.perf_counter() - loader.started
 
     print("="*60)
     print("System ready! You can start asking questions.")
+    print("   (Models are loading in the background)")
     print("   To exit: type 'quit', 'exit', or 'q'")
+    print("   To search one document: '@filter source:NAME.pdf page:3-10' ('@filter' clears)")
     print("="*60)
-    
-    # 4. Soru-cevap döngüsü
+
+    # 7. Soru-cevap döngüsü (hybrid aramada daha az chunk yeterli)
+    top_k = HYBRID_TOP_K if RETRIEVAL_MODE == "hybrid" else TOP_K
     query_count = 0
+    answer_metrics = []
+    filters = None  # @filter ile ayarlanan source / page filtresi (tüm sorgulara uygulanır)
     while True:
         try:
             query = input("\nQuestion: ").strip()
-            
+
             # Çıkış kontrolü
             if query.lower() in ['quit', 'exit', 'q']:
                 print(f"\nTotal {query_count} questions asked. Goodbye!")
+                print_answer_stats(answer_metrics)
+                if loader.is_loaded():
+                    save_caches(loader.vectorstore, loader.answer_cache, loader.chat_history, loader.diagram_cache)
                 break
-            
+
             # Boş sorgu kontrolü
             if not query:
                 print("Please enter a question!")
                 continue
-            
+
+            # Metadata filtresi: sonraki sorular sadece eşleşen chunk'larda aranır
+            if query.startswith("@filter"):
+                from metadata_filter import parse_filter
+                try:
+                    filters = parse_filter(query[len("@filter"):].strip())
+                except ValueError as e:
+                    print(f"Invalid filter: {e}")
+                    continue
+                print(f"Filter: {query[len('@filter'):].strip()}" if filters else "Filter cleared.")
+                continue
+
+            # İlk sorguda yüklemenin bitmesini bekle
+            runtime = loader.wait()
+
             # Diagram etiketi kontrolü
             if query.startswith("@diagram"):
-                handle_diagram_query(query, vectorstore, llm, TOP_K)
+                runtime.handle_diagram_query(query, runtime.vectorstore, runtime.llm, top_k,
+                                             DIAGRAM_SPECULATION, DIAGRAM_SPECULATIVE_GENERATIONS,
+                                             runtime.diagram_cache, filters)
                 continue  # Diagram tamamlandı, normal RAG'a gitme
-            
+
             # Normal RAG sorgusu
             query_count += 1
-            query_rag_system(vectorstore, llm, query, TOP_K, chat_history)
-            
+            metrics = {}
+            runtime.query_rag_system(runtime.vectorstore, runtime.llm, query, top_k,
+                                     runtime.chat_history, runtime.answer_cache, CONTEXT_TOKEN_BUDGET,
+                                     stream=STREAM_ANSWERS, metrics=metrics, filters=filters)
+            answer_metrics.append(metrics)
+
         except KeyboardInterrupt:
             print(f"\n\nShutting down... (Total {query_count} questions)")
+            print_answer_stats(answer_metrics)
+            if loader.is_loaded():
+                save_caches(loader.vectorstore, loader.answer_cache, loader.chat_history, loader.diagram_cache)
             break
         except Exception as e:
             print(f"\nUnexpected error: {e}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,292 @@
+"""
+metadata_filter.py
+source / page metadata filtreleriyle FAISS araması.
+
+Filtre sonuç Document'larına sonradan uygulanmaz (top-k'nın çoğu filtre
+dışında kalıp az sonuç dönerdi): satır bazındaki kaynak ve sayfa kolonlarından
+filtreye uyan FAISS satırları (id kümesi) bir kez hesaplanıp önbelleğe alınır,
+arama bu satırlarla sınırlı yapılır (FAISS IDSelector ile).
+
+Filtre biçimleri:
+    "source:csms.pdf page:3-10"                     - metin (boşlukla ayrılmış, virgülle çoklu değer)
+    {"source": ["csms.pdf", "iam*"], "page": [1, "5-8"]}
+source dosya yolu, dosya adı veya uzantısız adla (büyük/küçük harf farksız,
+* ve ? joker) eşleşir. Sayfa numaraları metadata'daki gibidir (SOURCES
+çıktısındaki "Page"); aralıklar iki uç dahildir.
+"""
+
+import os
+import math
+import fnmatch
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+import numpy as np
+import faiss
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import chunk_store
+
+FIELDS = ("source", "page")
+EXACT_SEARCH_ROWS = 8192  # HNSW'de bundan küçük id kümeleri graf yerine tam taranır
+MAX_EF_SEARCH = 4096
+SUBSET_BLOCK_ROWS = 4096  # PQ filtreli aramada bir seferde decode edilen satır sayısı
+
+Filter = Tuple[Optional[Tuple[str, ...]], Optional[Tuple[Tuple[int, int], ...]]]
+
+
+# ===============================
+# FİLTRE İFADELERİ
+# ===============================
+def _page_range(value) -> Tuple[int, int]:
+    if isinstance(value, bool):
+        raise ValueError(f"invalid page: {value!r}")
+    if isinstance(value, int):
+        return value, value
+    lo, sep, hi = str(value).strip().partition("-")
+    try:
+        lo = int(lo)
+        hi = int(hi) if sep else lo
+    except ValueError:
+        raise ValueError(f"invalid page: {value!r} (use 5 or 3-10)") from None
+    if lo > hi:
+        raise ValueError(f"invalid page range: {value!r}")
+    return lo, hi
+
+
+def _values(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if isinstance(value, str):
+        return [part for part in value.split(",") if part.strip()]
+    return [value]
+
+
+def parse_filter(spec: Union[str, Dict, None]) -> Optional[Filter]:
+    """
+    Filtre ifadesini (metin veya dict) kanonik (kaynaklar, sayfa aralıkları)
+    tuple'ına çevirir; boş filtre None döner. Geçersiz ifadede ValueError.
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, str):
+        fields = {}
+        for term in spec.split():
+            name, sep, value = term.replace("=", ":", 1).partition(":")
+            if not sep or not value:
+                raise ValueError(f"invalid filter term: {term!r} (use source:NAME or page:3-10)")
+            fields.setdefault(name.lower(), []).extend(_values(value))
+        spec = fields
+    if not isinstance(spec, dict):
+        raise ValueError("filter must be a string or an object")
+    unknown = set(spec) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"unknown filter field(s): {', '.join(sorted(unknown))} (supported: {', '.join(FIELDS)})")
+
+    source, page = spec.get("source"), spec.get("page")
+    sources = tuple(sorted({str(value).strip().lower() for value in _values(source)}))
+    pages = tuple(sorted({_page_range(value) for value in _values(page)}))
+    if not sources and not pages:
+        return None
+    return sources or None, pages or None
+
+
+def source_matches(source: str, patterns: Tuple[str, ...]) -> bool:
+    """Kaynak yolu, dosya adı veya uzantısız ad kalıplardan biriyle eşleşiyor mu?"""
+    path = source.replace("\\", "/").lower()
+    name = os.path.basename(path)
+    names = (path, path[2:] if path.startswith("./") else path, name, os.path.splitext(name)[0])
+    return any(fnmatch.fnmatchcase(candidate, pattern) for pattern in patterns for candidate in names)
+
+
+# ===============================
+# SATIR KOLONLARI / ID KÜMELERİ
+# ===============================
+class MetadataIndex:
+    """
+    FAISS satırı başına kaynak numarası ve sayfa kolonu; kaynak -> satırlar
+    tablosu (CSR). Çözümlenen filtrelerin id kümeleri LRU'da tutulur.
+    """
+
+    def __init__(self, sources: List[str], source: np.ndarray, page: np.ndarray, cache_size: int = 128):
+        self.sources = list(sources)
+        self.source = np.asarray(source, dtype=np.int32)
+        self.page = np.asarray(page, dtype=np.int32)
+        self.order = np.argsort(self.source, kind="stable").astype(np.int64)  # kaynak içinde satır sırası korunur
+        self.offsets = np.zeros(len(self.sources) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.source, minlength=len(self.sources)), out=self.offsets[1:])
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+    @classmethod
+    def from_documents(cls, docs) -> "MetadataIndex":
+        """Document'ları (FAISS satır sırasıyla) bir kez tarayarak kolonları oluşturur."""
+        source_ids, source_col, page_col = {}, [], []
+        for doc in docs:
+            meta = doc.metadata if isinstance(doc, Document) else {}
+            source_col.append(source_ids.setdefault(meta.get("source", "Unknown"), len(source_ids)))
+            page = meta.get("page", -1)
+            page_col.append(page if isinstance(page, int) else -1)
+        return cls(list(source_ids), np.asarray(source_col, dtype=np.int32), np.asarray(page_col, dtype=np.int32))
+
+    @classmethod
+    def concat(cls, indexes: List["MetadataIndex"]) -> "MetadataIndex":
+        """Shard kolonlarını satırları art arda gelecek şekilde birleştirir."""
+        sources, source_cols = [], []
+        for index in indexes:
+            source_cols.append(index.source + len(sources))
+            sources.extend(index.sources)
+        return cls(sources, np.concatenate(source_cols), np.concatenate([index.page for index in indexes]))
+
+    @classmethod
+    def from_docstore(cls, docstore, mapping) -> "MetadataIndex":
+        """Chunk deposunda kayıtlı kolonları kullanır; diğer docstore'ları bir kez tarar."""
+        from sharded_index import ShardedDocstore
+
+        if isinstance(docstore, chunk_store.ChunkStore):
+            return cls([info["source"] for info in docstore.sources], docstore.source, docstore.page)
+        if isinstance(docstore, ShardedDocstore):
+            return cls.concat([cls.from_docstore(part, part_mapping)
+                               for part, part_mapping in zip(docstore.docstores.values(), mapping.mappings)])
+        return cls.from_documents(docstore.search(mapping[row]) for row in range(len(mapping)))
+
+    def select(self, filters: Filter) -> np.ndarray:
+        """Filtreye uyan FAISS satırları (sıralı int64)."""
+        with self._lock:
+            rows = self._cache.get(filters)
+            if rows is not None:
+                self._cache.move_to_end(filters)
+                return rows
+
+        sources, pages = filters
+        if sources is None:
+            rows = np.arange(len(self.source), dtype=np.int64)
+        else:
+            matched = [i for i, source in enumerate(self.sources) if source_matches(source, sources)]
+            rows = np.sort(np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in matched]
+                                          or [np.empty(0, dtype=np.int64)]))
+        if pages is not None:
+            page = self.page[rows]
+            keep = np.zeros(len(rows), dtype=bool)
+            for lo, hi in pages:
+                keep |= (page >= lo) & (page <= hi)
+            rows = rows[keep]
+        rows.setflags(write=False)
+
+        with self._lock:
+            self._cache[filters] = rows
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return rows
+
+
+def metadata_index(vectorstore) -> MetadataIndex:
+    """Vektör deposunun kolonları (ilk kullanımda oluşturulup depoya eklenir)."""
+    index = getattr(vectorstore, "metadata_index", None)
+    if index is None:
+        index = MetadataIndex.from_docstore(vectorstore.docstore, vectorstore.index_to_docstore_id)
+        vectorstore.metadata_index = index
+    return index
+
+
+def select_rows(vectorstore, filters) -> Optional[np.ndarray]:
+    """Filtre ifadesine uyan FAISS satırları; filtre boşsa None (tüm satırlar)."""
+    filters = parse_filter(filters) if not isinstance(filters, tuple) else filters
+    if filters is None:
+        return None
+    return metadata_index(vectorstore).select(filters)
+
+
+# ===============================
+# FİLTRELİ ARAMA
+# ===============================
+def empty_result(n_queries: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    return (np.full((n_queries, k), np.inf, dtype=np.float32),
+            np.full((n_queries, k), -1, dtype=np.int64))
+
+
+def id_selector(rows: np.ndarray):
+    """Sıralı satırlar ardışıksa aralık, değilse küme seçicisi."""
+    if rows[-1] - rows[0] + 1 == len(rows):
+        return faiss.IDSelectorRange(int(rows[0]), int(rows[-1]) + 1)
+    return faiss.IDSelectorBatch(np.ascontiguousarray(rows, dtype=np.int64))
+
+
+def _subset_search(index, queries: np.ndarray, k: int, rows: np.ndarray):
+    """
+    Verilen satırların decode edilmiş vektörleri üzerinde tam L2 araması.
+
+    Satırlar SUBSET_BLOCK_ROWS'luk bloklar halinde decode edilir ve ilk k
+    blok blok birleştirilir; geniş bir filtre (ör. source:*) tüm korpusu
+    float32 olarak belleğe açmaz.
+    """
+    found, labels = empty_result(len(queries), k)
+    query_norms = (queries ** 2).sum(axis=1)[:, None]
+    for begin in range(0, len(rows), SUBSET_BLOCK_ROWS):
+        block = rows[begin:begin + SUBSET_BLOCK_ROWS]
+        vectors = index.reconstruct_batch(block)
+        distances = query_norms - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)[None, :]
+        # Önceki en iyiler önde: eşit mesafede küçük satır numarası kalır
+        distances = np.hstack([found, distances])
+        candidates = np.hstack([labels, np.broadcast_to(block, (len(queries), len(block)))])
+        top = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        found = np.take_along_axis(distances, top, axis=1).astype(np.float32)
+        labels = np.take_along_axis(candidates, top, axis=1)
+    return found, labels
+
+
+def search_rows(index, queries: np.ndarray, k: int, rows: np.ndarray):
+    """
+    index.search'ün sadece verilen satırlarla sınırlı hali (aynı dönüş biçimi).
+
+    Sarmalayıcı indeksler (RerankIndex, ShardedIndex) search(..., rows=...)
+    ile çağrılır. Flat / SQ / IVF indekslerde arama IDSelector ile yapılır;
+    seçici graf / küme taramasını daralttığı için HNSW efSearch'ü ve IVF
+    nprobe'u filtrenin seçiciliğiyle orantılı büyütülür, küçük id kümeleri
+    HNSW'de tam taranır. IDSelector desteklemeyen PQ indeksinde satırlar
+    bloklar halinde decode edilip tam aranır.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if not isinstance(index, faiss.Index):
+        return index.search(queries, k, rows=rows)
+    if len(rows) == 0:
+        return empty_result(len(queries), k)
+
+    base = faiss.downcast_index(index)
+    ratio = index.ntotal / len(rows)
+    selector = id_selector(rows)
+    ivf = faiss.try_extract_index_ivf(base)
+    if isinstance(base, faiss.IndexHNSW):
+        if len(rows) <= EXACT_SEARCH_ROWS:
+            return search_rows(faiss.downcast_index(base.storage), queries, k, rows)
+        params = faiss.SearchParametersHNSW(
+            sel=selector, efSearch=min(MAX_EF_SEARCH, math.ceil(base.hnsw.efSearch * ratio)))
+    elif ivf is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=min(ivf.nlist, math.ceil(ivf.nprobe * ratio)))
+    elif isinstance(base, faiss.IndexPQ):
+        return _subset_search(base, queries, k, rows)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(queries, k, params=params)
+
+
+class FilteredRetriever(BaseRetriever):
+    """Sadece filtreye uyan satırlarda dense arama yapan retriever (get_retriever filtre verilince döndürür)."""
+
+    vectorstore: Any
+    rows: Any
+    k: int = 20
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector = np.asarray([self.vectorstore.embedding_function.embed_query(query)], dtype=np.float32)
+        _, rows = search_rows(self.vectorstore.index, vector, self.k, self.rows)
+        mapping = self.vectorstore.index_to_docstore_id
+        return [self.vectorstore.docstore.search(mapping[int(row)]) for row in rows[0] if row >= 0]
@@ -3,69 +3,259 @@ rag_engine.py
 RAG (Retrieval Augmented Generation) engine operations.
 """
 
+import time
+import asyncio
+from typing import List, Tuple
+import numpy as np
 from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 from langchain_openai import ChatOpenAI
-from vectorstore import display_sources
-from llm_utils import create_rag_prompt
+from langchain_core.retrievers import BaseRetriever
+from vectorstore import display_sources, chunk_id, get_retriever
+from metadata_filter import select_rows, search_rows
+from llm_utils import create_rag_prompt, stream_completion, count_tokens
+from context_packer import pack_context
 from chat_history import ChatHistory
+from answer_cache import AnswerCache
+from embedding_cache import QueryEmbeddingCache
+import telemetry
 
 
-def query_rag_system(vectorstore: FAISS, llm: ChatOpenAI, query: str, top_k: int = 20, chat_history: ChatHistory = None):
-    """RAG sistemine sorgu yapar ve sonucu döndürür."""
-    try:
-        # Bağlam kontrolü: Önceki soruyla ilişkili mi?
+def embed_queries(embeddings, queries: List[str]) -> np.ndarray:
+    """Sorguları tek model çağrısıyla embed eder (sorgu LRU önbelleği varsa önce ona bakar)."""
+    if isinstance(embeddings, QueryEmbeddingCache):
+        vectors = embeddings.embed_queries(queries)
+    else:
+        vectors = embeddings.embed_documents(queries)
+    return np.asarray(vectors, dtype=np.float32).reshape(len(queries), -1)
+
+
+def retrieve_batch(vectorstore: FAISS, queries: List[str], top_k: int = 20,
+                   filters=None) -> List[List[Tuple[Document, float]]]:
+    """
+    Sorgu listesini tek embedding çağrısı ve tek matris index.search ile arar.
+    
+    Sorgu başına retriever oluşturulmaz. Sonuçlar get_retriever(...).invoke
+    ile aynı chunk'lardır: dense modda skor L2 mesafesi (küçük daha yakın),
+    hybrid modda (BM25 yüklüyse) dense adaylar batch'te bulunur, BM25 ve RRF
+    sorgu başına uygulanır ve skor RRF skorudur (büyük daha alakalı).
+    filters verilirse (ör. "source:csms.pdf page:3-10", bkz. metadata_filter)
+    FAISS ve BM25 araması sadece filtreye uyan satırlarda yapılır; top_k
+    sonucun hepsi filtreye uyar.
+    
+    Returns:
+        Her sorgu için [(Document, skor), ...], en alakalı ilk sırada
+    """
+    if not queries:
+        return []
+    bm25 = getattr(vectorstore, "bm25_index", None)
+    allowed = select_rows(vectorstore, filters)
+    hybrid = get_retriever(vectorstore, top_k, filters) if bm25 is not None else None
+    k = hybrid.fetch_k if hybrid else top_k
+    
+    with telemetry.span("retrieval", queries=len(queries), mode="hybrid" if hybrid else "dense") as span:
+        with telemetry.span("embedding", queries=len(queries)):
+            vectors = embed_queries(vectorstore.embedding_function, queries)
+        with telemetry.span("faiss_search", queries=len(queries), k=k) as search_span:
+            if allowed is not None:
+                search_span.set(filtered_rows=len(allowed))
+                distances, rows = search_rows(vectorstore.index, vectors, k, allowed)
+            else:
+                distances, rows = vectorstore.index.search(vectors, k)
+        
+        mapping = vectorstore.index_to_docstore_id
+        results = []
+        with telemetry.span("bm25_fusion" if hybrid else "docstore"):
+            for query, found, scores in zip(queries, rows, distances):
+                if hybrid is not None:
+                    results.append(hybrid.fuse_with_scores(query, [int(row) for row in found if row >= 0]))
+                else:
+                    results.append([(vectorstore.docstore.search(mapping[int(row)]), float(score))
+                                    for row, score in zip(found, scores) if row >= 0])
+        span.set(chunks=sum(len(hits) for hits in results))
+    return results
+
+
+def query_rag_system(vectorstore: FAISS, llm: ChatOpenAI, query: str, top_k: int = 20, chat_history: ChatHistory = None,
+                     answer_cache: AnswerCache = None, token_budget: int = 6000, stream: bool = False,
+                     metrics: dict = None, filters=None):
+    """
+    RAG sistemine sorgu yapar ve sonucu döndürür.
+    
+    stream=True ise cevap token token ekrana basılır. metrics verilirse
+    LLM süreleri içine yazılır (stream modunda ttft ve tokens_per_sec de).
+    Telemetri açıksa her aşama "rag_query" trace'ine span olarak kaydedilir.
+    filters verilirse (bkz. retrieve_batch) sadece eşleşen chunk'lar kullanılır.
+    """
+    with telemetry.span("rag_query", top_k=top_k, stream=stream) as trace:
         try:
-            is_related, contextualized_query = chat_history.is_related_to_previous(query)
-            query_to_use = contextualized_query if (is_related and contextualized_query) else query
+            # Bağlam kontrolü: Önceki soruyla ilişkili mi?
+            try:
+                is_related, contextualized_query = chat_history.is_related_to_previous(query)
+                query_to_use = contextualized_query if (is_related and contextualized_query) else query
+
+                if is_related:
+                    print("Bağlam kuruldu. Sorun, önceki soruyla ilişkili.")
+                
+            except (NameError, AttributeError):
+                # Eğer chat_history tanımlı değilse bağlam kontrolünü atla
+                query_to_use = query
+            trace.set(rewritten=query_to_use != query)
 
-            if is_related:
-                print("Bağlam kuruldu. Sorun, önceki soruyla ilişkili.")
+            # 1. İlgili dokümanları bul (retrieval)
+            print(f"Query: '{query}'")
+            print(f"   Retrieving top-{top_k} documents...\n")
+            
+            relevant_docs = [doc for doc, _ in retrieve_batch(vectorstore, [query_to_use], top_k, filters)[0]]
+            
+            if not relevant_docs:
+                print("No relevant documents found!")
+                return None
+            
+            print(f"Found {len(relevant_docs)} relevant documents.")
+            
+            # Cevap önbelleği: benzer soru ve aynı chunk seti varsa LLM'e gitme
+            if answer_cache is not None:
+                with telemetry.span("answer_cache") as span:
+                    query_vector = vectorstore.embedding_function.embed_query(query_to_use)
+                    chunk_ids = [chunk_id(doc) for doc in relevant_docs]
+                    cached_answer = answer_cache.lookup(query_vector, chunk_ids)
+                    span.set(hit=cached_answer is not None)
+                
+                if cached_answer is not None:
+                    print("ANSWER (cached):")
+                    print(cached_answer)
+                    if chat_history:
+                        chat_history.add_exchange(query, cached_answer)
+                    display_sources(relevant_docs, show_content=False)
+                    return cached_answer
+            
+            # 2. Context oluştur (örtüşen chunk'lar birleştirilir, tekrarlar atılır, bütçeye sığdırılır)
+            with telemetry.span("context_packing") as span:
+                context, context_docs, stats = pack_context(relevant_docs, token_budget)
+                span.set(chunks=stats["spans"], context_tokens=stats["tokens"], merged=stats["merged"],
+                         duplicates=stats["duplicates"], skipped=stats["skipped"])
+            print(f"Context: {stats['chunks']} chunks -> {stats['spans']} passages, {stats['tokens']} tokens "
+                  f"({stats['merged']} merged, {stats['duplicates']} duplicates, {stats['skipped']} over budget)")
+            
+            # 3. Prompt hazırla
+            with telemetry.span("prompt") as span:
+                prompt = create_rag_prompt(context, query)
+                if span.recording:
+                    span.set(prompt_chars=len(prompt))
+            
+            # 4-5. LLM'den cevap al ve göster
+            with telemetry.span("llm", stream=stream) as span:
+                if stream:
+                    print("ANSWER:")
+                    answer, stats = stream_completion(llm, prompt, on_token=lambda t: print(t, end="", flush=True))
+                    print(f"\n\n(TTFT {stats['ttft']:.2f}s, {stats['tokens_per_sec']:.1f} tokens/s, "
+                          f"{stats['output_tokens']} tokens)")
+                    if span.recording:
+                        span.set(ttft_ms=round(stats["ttft"] * 1000, 3), completion_tokens=stats["output_tokens"],
+                                 prompt_tokens=count_tokens(prompt))
+                else:
+                    print("Generating answer...\n")
+                    began = time.perf_counter()
+                    response = llm.invoke(prompt)
+                    answer = response.content
+                    stats = {"total": time.perf_counter() - began}
+                    print("ANSWER:")
+                    print(answer)
+                    if span.recording:
+                        span.set(**telemetry.llm_tokens(prompt, response))
             
-        except (NameError, AttributeError):
-            # Eğer chat_history tanımlı değilse bağlam kontrolünü atla
-            query_to_use = query
+            if metrics is not None:
+                metrics.update(stats)
+            
+            if chat_history:
+                chat_history.add_exchange(query, answer)
+            
+            if answer_cache is not None:
+                answer_cache.add(query_to_use, query_vector, chunk_ids, answer)
+            
+            # 6. Kaynakları göster
+            display_sources(context_docs, show_content=False)
+            
+            return answer
+            
+        except Exception as e:
+            trace.set(error=str(e))
+            print(f"\nError processing query: {e}")
+            return None
+
 
-        # 1. İlgili dokümanları bul (retrieval)
-        print(f"Query: '{query}'")
-        print(f"   Retrieving top-{top_k} documents...\n")
+async def aquery_rag_system(vectorstore: FAISS, llm: ChatOpenAI, query: str, top_k: int = 20,
+                            chat_history: ChatHistory = None, answer_cache: AnswerCache = None,
+                            token_budget: int = 6000, retriever: BaseRetriever = None,
+                            filters=None) -> dict:
+    """
+    query_rag_system'in asyncio versiyonu; ekrana basmaz, sonucu dict olarak döndürür.
+    
+    Ham sorgu için retrieval, bağlam kontrolü (LLM çağrısı) ile aynı anda
+    başlar. Yeniden yazılan sorgu ham sorgudan farklıysa retrieval bir kez
+    daha yapılır, aynıysa ilk sonuç kullanılır. Vektör deposu, LLM ve
+    önbellekler paylaşılabilir; her oturum kendi ChatHistory'sini verir.
+    retriever verilmezse get_retriever ile (filters uygulanarak) oluşturulur
+    (sunucu micro-batch retriever'ını verir).
+    
+    Returns:
+        {"answer", "docs", "query", "cached", "timings"} (hata: answer=None, "error")
+    """
+    timings = {}
+    began = time.perf_counter()
+    if retriever is None:
+        retriever = get_retriever(vectorstore, top_k, filters)
+    retrieval = asyncio.create_task(retriever.ainvoke(query))
+    
+    try:
+        # 1. Bağlam kontrolü ve ham sorgu retrieval'ı paralel
+        query_to_use = query
+        if chat_history is not None:
+            is_related, contextualized_query = await chat_history.ais_related_to_previous(query)
+            if is_related and contextualized_query:
+                query_to_use = contextualized_query
+        timings["contextualize"] = time.perf_counter() - began
         
-        retriever = vectorstore.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": top_k}
-        )
-        relevant_docs = retriever.invoke(query_to_use)
+        if query_to_use.strip() != query.strip():
+            retrieval.cancel()  # ham sorgunun sonucu kullanılmayacak
+            relevant_docs = await retriever.ainvoke(query_to_use)
+        else:
+            relevant_docs = await retrieval
+        timings["retrieval_wait"] = time.perf_counter() - began - timings["contextualize"]
         
         if not relevant_docs:
-            print("No relevant documents found!")
-            return None
-        
-        print(f"Found {len(relevant_docs)} relevant documents.")
-        
-        # 2. Context oluştur
-        context = "\n\n---\n\n".join([
-            f"[Document {i+1}]\n{doc.page_content}" 
-            for i, doc in enumerate(relevant_docs)
-        ])
+            return {"answer": None, "docs": [], "query": query_to_use, "cached": False, "timings": timings}
         
-        # 3. Prompt hazırla
-        prompt = create_rag_prompt(context, query)
+        # 2. Cevap önbelleği
+        chunk_ids = [chunk_id(doc) for doc in relevant_docs]
+        if answer_cache is not None:
+            query_vector = await asyncio.to_thread(vectorstore.embedding_function.embed_query, query_to_use)
+            cached_answer = answer_cache.lookup(query_vector, chunk_ids)
+            if cached_answer is not None:
+                if chat_history is not None:
+                    chat_history.add_exchange(query, cached_answer)
+                timings["total"] = time.perf_counter() - began
+                return {"answer": cached_answer, "docs": relevant_docs, "query": query_to_use,
+                        "cached": True, "timings": timings}
         
-        # 4. LLM'den cevap al
-        print("Generating answer...\n")
-        response = llm.invoke(prompt)
+        # 3. Context ve LLM cevabı
+        context, context_docs, _ = pack_context(relevant_docs, token_budget)
+        generation_start = time.perf_counter()
+        response = await llm.ainvoke(create_rag_prompt(context, query))
+        timings["generation"] = time.perf_counter() - generation_start
         
-        # 5. Sonucu göster
-        print("ANSWER:")
-        print(response.content)
-        
-        if chat_history:
+        if chat_history is not None:
             chat_history.add_exchange(query, response.content)
+        if answer_cache is not None:
+            answer_cache.add(query_to_use, query_vector, chunk_ids, response.content)
         
-        # 6. Kaynakları göster
-        display_sources(relevant_docs, show_content=False)
-        
-        return response.content
-        
+        timings["total"] = time.perf_counter() - began
+        return {"answer": response.content, "docs": context_docs, "query": query_to_use,
+                "cached": False, "timings": timings}
+    
     except Exception as e:
-        print(f"\nError processing query: {e}")
-        return None
+        if not retrieval.done():
+            retrieval.cancel()
+        return {"answer": None, "docs": [], "query": query, "cached": False, "timings": timings,
+                "error": str(e)}
@@ -0,0 +1,441 @@
+"""
+server.py
+RAG ve @diagram akışlarını HTTP (JSON) üzerinden çok oturumlu sunar.
+
+Aynı anda gelen sorguların embedding'i ve FAISS araması micro-batch ile
+yapılır: ilk sorgudan sonra batch_window_ms boyunca (veya max_batch sorgu
+dolana kadar) gelen sorgular rag_engine.retrieve_batch ile (tek
+embedding çağrısı ve tek matris index.search) cevaplanır. LLM çağrıları async motorda (aquery_rag_system)
+eşzamanlı yürür; her oturumun kendi ChatHistory'si vardır.
+
+Endpoint'ler:
+    POST /query     {"session", "query", "filter"?}     -> {"answer", "sources", "query", "cached", "timings"}
+    POST /retrieve  {"query", "filter"?}                -> {"sources"}
+    POST /diagram   {"session", "query", "filter"?}     -> ilk netleştirme sorusu
+                    {"session", "answer"}               -> sonraki soru veya {"diagram": {...}}
+    filter: "source:csms.pdf page:3-10" veya {"source": [...], "page": [...]} (bkz. metadata_filter);
+    filtreli sorgular micro-batch'e girmez, kendi id kümesiyle aranır
+    GET  /health, /stats
+    GET  /metrics                                       -> aşama metrikleri (Prometheus text, telemetri açıksa)
+
+Çalıştırma:
+    python server.py --port 8000 --batch-window-ms 5 --max-batch 32
+"""
+
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from chat_history import ChatHistory
+from rag_engine import aquery_rag_system, retrieve_batch
+from vectorstore import get_retriever
+from metadata_filter import parse_filter
+from diagram_chat import generate_diagram_flow, get_clarification_questions, strip_diagram_intent, DiagramSpeculator
+import telemetry
+
+
+# ===============================
+# MICRO-BATCHING
+# ===============================
+class MicroBatcher:
+    """
+    Farklı thread'lerden gelen işleri toplayıp fn(list) ile tek seferde çalıştırır.
+
+    Kuyruktaki ilk iş geldikten sonra window_ms kadar beklenir; bu sürede
+    gelenler (en fazla max_batch) aynı batch'e girer. Batch çalışırken
+    biriken işler bir sonraki batch'e bekleme süresi olmadan katılır.
+    max_batch=1 batch'lemeyi kapatır. close() kuyruktaki işler bittikten
+    sonra thread'i durdurur.
+    """
+
+    _STOP = object()  # kuyruğa konan durdurma işareti
+
+    def __init__(self, fn: Callable[[List[Any]], List[Any]], window_ms: float = 5, max_batch: int = 32):
+        self.fn = fn
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.largest = 0
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        """İşi kuyruğa ekler; sonucu Future ile döner."""
+        if self.closed:
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def close(self, timeout: float = None):
+        """Yeni iş kabul etmez; kuyruktaki işler çalıştırıldıktan sonra thread'i durdurur."""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _collect(self) -> list:
+        first = self.queue.get()
+        if first is self._STOP:
+            return None
+        pending = [first]
+        deadline = time.perf_counter() + self.window
+        while len(pending) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                self.queue.put(item)  # bu batch çalıştıktan sonra durulur
+                break
+            pending.append(item)
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            if pending is None:
+                return
+            try:
+                results = self.fn([item for item, _ in pending])
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(pending)
+            self.largest = max(self.largest, len(pending))
+            for (_, future), result in zip(pending, results):
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        """Batch sayısı ve ortalama / en büyük batch boyu."""
+        return {"batches": self.batches, "items": self.items, "largest": self.largest,
+                "avg_batch": self.items / self.batches if self.batches else 0.0}
+
+
+def search_batch(vectorstore, queries: List[str], top_k: int) -> List[List[Document]]:
+    """MicroBatcher işlevi: retrieve_batch sonuçlarının sadece chunk'ları."""
+    return [[doc for doc, _ in hits] for hits in retrieve_batch(vectorstore, queries, top_k)]
+
+
+class BatchedRetriever(BaseRetriever):
+    """Sorguları MicroBatcher üzerinden arayan retriever (sync ve async)."""
+
+    batcher: Any
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.batcher.submit(query).result()
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return await asyncio.wrap_future(self.batcher.submit(query))
+
+
+# ===============================
+# SESSIONS / SERVICE
+# ===============================
+class Session:
+    """Bir kullanıcının chat geçmişi ve yarım kalan @diagram netleştirme durumu."""
+
+    def __init__(self, history: ChatHistory):
+        self.history = history
+        self.lock = threading.Lock()  # aynı oturumun istekleri sırayla işlenir
+        self.diagram_query = None
+        self.diagram_answers = {}
+        self.diagram_speculator = None
+        self.diagram_filters = None
+
+    def reset_diagram(self):
+        if self.diagram_speculator is not None:
+            self.diagram_speculator.close()
+        self.diagram_query = None
+        self.diagram_answers = {}
+        self.diagram_speculator = None
+        self.diagram_filters = None
+
+
+def serialize_sources(docs: List[Document]) -> List[dict]:
+    return [{"source": doc.metadata.get("source", "Unknown"), "page": doc.metadata.get("page", "N/A")}
+            for doc in docs]
+
+
+class RAGService:
+    """
+    Sunucunun paylaşılan durumu: vektör deposu, LLM, cevap önbelleği,
+    micro-batcher ve oturumlar. HTTP'den bağımsızdır (benchmark ve
+    testler doğrudan kullanabilir).
+    """
+
+    def __init__(self, vectorstore, llm, top_k: int = 8, answer_cache=None, token_budget: int = 6000,
+                 batch_window_ms: float = 5, max_batch: int = 32, max_sessions: int = 1000,
+                 max_history: int = 5, gate_low: float = 0.45, gate_high: float = 0.85,
+                 diagram_speculation: bool = True, speculative_generations: int = 2, diagram_cache=None):
+        self.vectorstore = vectorstore
+        self.llm = llm
+        self.top_k = top_k
+        self.answer_cache = answer_cache
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self.diagram_speculation = diagram_speculation
+        self.speculative_generations = speculative_generations
+        self.diagram_cache = diagram_cache
+        self.history_kwargs = {"max_history": max_history, "embeddings": vectorstore.embedding_function,
+                               "gate_low": gate_low, "gate_high": gate_high}
+        self.batcher = MicroBatcher(lambda queries: search_batch(vectorstore, queries, top_k),
+                                    batch_window_ms, max_batch)
+        self.retriever = BatchedRetriever(batcher=self.batcher)
+        self.sessions = OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self.requests = 0
+
+        # async RAG motoru için tek event loop
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="rag-event-loop", daemon=True).start()
+
+    def session(self, session_id: str) -> Session:
+        """Oturumu getirir veya oluşturur; sınır aşılırsa en eski kullanılan atılır."""
+        with self._sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(ChatHistory(self.llm, **self.history_kwargs))
+                self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)[1].reset_diagram()
+            return session
+
+    def retriever_for(self, filters=None):
+        """Filtresiz sorgular micro-batch retriever'ını, filtreli sorgular kendi id kümeleriyle arar."""
+        return self.retriever if filters is None else get_retriever(self.vectorstore, self.top_k, filters)
+
+    def retrieve(self, query: str, filters=None) -> dict:
+        self.requests += 1
+        return {"sources": serialize_sources(self.retriever_for(filters).invoke(query))}
+
+    def query(self, session_id: str, query: str, filters=None) -> dict:
+        """Oturumun geçmişiyle RAG cevabı üretir."""
+        self.requests += 1
+        session = self.session(session_id)
+        with session.lock:
+            result = asyncio.run_coroutine_threadsafe(
+                aquery_rag_system(self.vectorstore, self.llm, query, self.top_k, session.history,
+                                  self.answer_cache, self.token_budget, retriever=self.retriever_for(filters)),
+                self.loop
+            ).result()
+        result["sources"] = serialize_sources(result.pop("docs"))
+        return result
+
+    def diagram(self, session_id: str, query: str = None, answer: str = None, filters=None) -> dict:
+        """
+        @diagram netleştirme diyaloğu: query ile başlar, her answer bir sonraki
+        soruyu döndürür. Sorular bitince diyagram JSON'u üretilir. filters
+        query ile verilir ve diyalog boyunca geçerlidir (filtreli diyagramlar
+        önbelleğe alınmaz).
+        """
+        self.requests += 1
+        session = self.session(session_id)
+        with session.lock:
+            if query is not None:
+                session.reset_diagram()
+                session.diagram_query = query
+                session.diagram_filters = filters
+                if self.diagram_speculation:
+                    session.diagram_speculator = DiagramSpeculator(query, self.retriever_for(filters), self.llm,
+                                                                   self.top_k, self.speculative_generations,
+                                                                   self.diagram_cache if filters is None else None)
+            elif session.diagram_query is None:
+                raise ValueError("no diagram in progress, send 'query' first")
+            else:
+                index = len(session.diagram_answers)
+                question = get_clarification_questions("", index)
+                session.diagram_answers[f"question_{index}"] = (answer or "").strip() or question["default"]
+
+            index = len(session.diagram_answers)
+            question = get_clarification_questions(strip_diagram_intent(session.diagram_query), index)
+            if question:
+                if session.diagram_speculator is not None:
+                    session.diagram_speculator.update(session.diagram_answers)
+                return {"question": question["question"], "options": question["options"],
+                        "default": question["default"], "index": index,
+                        "total": question["total_questions"]}
+
+            filters = session.diagram_filters
+            diagram = generate_diagram_flow(session.diagram_query, self.retriever_for(filters), self.llm,
+                                            top_k=self.top_k, clarification_answers=session.diagram_answers,
+                                            question_index=index, speculator=session.diagram_speculator,
+                                            cache=self.diagram_cache if filters is None else None)
+            session.reset_diagram()
+            return {"diagram": diagram}
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "sessions": len(self.sessions), "batching": self.batcher.stats()}
+
+    def close(self):
+        """Micro-batch thread'ini ve oturumların tahmin havuzlarını durdurur, event loop'u kapatır."""
+        self.batcher.close()
+        with self._sessions_lock:
+            for session in self.sessions.values():
+                session.reset_diagram()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+# ===============================
+# HTTP
+# ===============================
+class RAGRequestHandler(BaseHTTPRequestHandler):
+    """JSON istek/cevap; hatalar {"error": ...} olarak döner."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive: istemci bağlantıyı yeniden kullanabilir
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, service.stats())
+        elif self.path == "/metrics":
+            data = telemetry.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(404, {"error": f"unknown path: {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            session_id = str(body.get("session", "default"))
+            filters = parse_filter(body.get("filter"))
+            if self.path == "/query":
+                result = service.query(session_id, self._required(body, "query"), filters)
+            elif self.path == "/retrieve":
+                result = service.retrieve(self._required(body, "query"), filters)
+            elif self.path == "/diagram":
+                if "query" in body:
+                    result = service.diagram(session_id, query=self._required(body, "query"), filters=filters)
+                else:
+                    result = service.diagram(session_id, answer=body.get("answer", ""))
+            else:
+                self._send_json(404, {"error": f"unknown path: {self.path}"})
+                return
+        except ValueError as e:  # geçersiz JSON, eksik alan veya geçersiz filtre
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(500 if result.get("error") else 200, result)
+
+    @staticmethod
+    def _required(body: dict, key: str) -> str:
+        value = str(body.get(key) or "").strip()
+        if not value:
+            raise ValueError(f"'{key}' is required")
+        return value
+
+
+class RAGHTTPServer(ThreadingHTTPServer):
+    """Her isteği ayrı thread'de işler."""
+
+    daemon_threads = True
+    request_queue_size = 256  # varsayılan listen backlog (5) eşzamanlı bağlantılarda reset'e yol açar
+
+
+def create_server(service: RAGService, host: str = "127.0.0.1", port: int = 8000) -> RAGHTTPServer:
+    """Servisi HTTP sunucusuna bağlar (port=0: rastgele port)."""
+    server = RAGHTTPServer((host, port), RAGRequestHandler)
+    server.service = service
+    return server
+
+
+def main(argv: list = None):
+    from config import API_KEY, API_BASE, MODEL_NAME, EMBEDDING_MODEL, INDEX_PATH, TOP_K, TEMPERATURE
+    from config import RETRIEVAL_MODE, HYBRID_TOP_K, CONTEXT_TOKEN_BUDGET, MAX_HISTORY
+    from config import RELATEDNESS_GATE_LOW, RELATEDNESS_GATE_HIGH
+    from config import QUERY_CACHE_SIZE, QUERY_CACHE_PATH, HNSW_EF_SEARCH, IVF_NPROBE, RERANK_FACTOR
+    from config import SHARDS_PATH, INDEX_SHARDS, SHARD_SEARCH_WORKERS
+    from config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE, ANSWER_CACHE_PATH
+    from config import SERVER_HOST, SERVER_PORT, BATCH_WINDOW_MS, BATCH_MAX_SIZE, MAX_SESSIONS
+    from config import DIAGRAM_SPECULATION, DIAGRAM_SPECULATIVE_GENERATIONS
+    from config import DIAGRAM_CACHE_ENABLED, DIAGRAM_CACHE_SIZE, DIAGRAM_CACHE_PATH
+    from config import TELEMETRY_ENABLED, TRACE_PATH, METRICS_PATH
+    from vectorstore import load_vectorstore
+    from llm_utils import initialize_llm
+    from answer_cache import AnswerCache
+    from diagram_cache import DiagramCache
+    from main import save_caches
+
+    parser = argparse.ArgumentParser(description="HTTP server for RAG and @diagram queries.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW_MS)
+    parser.add_argument("--max-batch", type=int, default=BATCH_MAX_SIZE, help="1 disables batching")
+    args = parser.parse_args(argv)
+    telemetry.configure(TELEMETRY_ENABLED, TRACE_PATH, METRICS_PATH)
+
+    index_path = SHARDS_PATH if INDEX_SHARDS else INDEX_PATH
+    vectorstore = load_vectorstore(index_path, EMBEDDING_MODEL, QUERY_CACHE_SIZE, QUERY_CACHE_PATH,
+                                   ef_search=HNSW_EF_SEARCH, nprobe=IVF_NPROBE,
+                                   rerank_factor=RERANK_FACTOR, retrieval_mode=RETRIEVAL_MODE,
+                                   shards=INDEX_SHARDS, shard_workers=SHARD_SEARCH_WORKERS)
+    llm = initialize_llm(API_KEY, API_BASE, MODEL_NAME, TEMPERATURE)
+    answer_cache = None
+    if ANSWER_CACHE_ENABLED:
+        answer_cache = AnswerCache(threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                                   max_size=ANSWER_CACHE_SIZE, persist_path=ANSWER_CACHE_PATH,
+                                   index_version=vectorstore.index_version)
+    diagram_cache = None
+    if DIAGRAM_CACHE_ENABLED:
+        diagram_cache = DiagramCache(DIAGRAM_CACHE_SIZE, DIAGRAM_CACHE_PATH, vectorstore.index_version)
+
+    service = RAGService(vectorstore, llm, HYBRID_TOP_K if RETRIEVAL_MODE == "hybrid" else TOP_K,
+                         answer_cache, CONTEXT_TOKEN_BUDGET, args.batch_window_ms, args.max_batch,
+                         MAX_SESSIONS, MAX_HISTORY, RELATEDNESS_GATE_LOW, RELATEDNESS_GATE_HIGH,
+                         DIAGRAM_SPECULATION, DIAGRAM_SPECULATIVE_GENERATIONS, diagram_cache)
+    server = create_server(service, args.host, args.port)
+    print(f"Serving on http://{args.host}:{server.server_address[1]} "
+          f"(batch window {args.batch_window_ms:g} ms, max batch {args.max_batch})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+    finally:
+        server.server_close()
+        service.close()
+        stats = service.stats()
+        print(f"Requests: {stats['requests']}, sessions: {stats['sessions']}, "
+              f"avg retrieval batch {stats['batching']['avg_batch']:.1f}")
+        save_caches(vectorstore, answer_cache, diagram_cache=diagram_cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+sharded_index.py
+Birden çok bağımsız FAISS indeksini (shard) tek bir vektör deposu gibi sunar.
+
+Her shard (ör. ürün grubu veya PDF koleksiyonu başına) embed_builder.py ile
+ayrı bir klasöre kendi başına oluşturulur; yeni bir koleksiyon eklemek diğer
+shard'ları yeniden oluşturmayı gerektirmez:
+
+    embeddings/shards/<isim>/   - index.faiss, chunk deposu, bm25.*, ...
+
+Arama her shard'a thread havuzunda paralel gönderilir (FAISS arama sırasında
+GIL'i bırakır), sonuçlar mesafeye göre birleştirilip global top-k alınır.
+Global satır numaraları shard'ların art arda dizilmesiyle oluşur; docstore
+id'leri "<shard>/<id>" biçimindedir.
+"""
+
+import os
+import numpy as np
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from metadata_filter import search_rows
+
+SEPARATOR = "/"
+
+
+def list_shards(folder: str) -> List[str]:
+    """Klasördeki shard isimleri (index.faiss içeren alt klasörler, alfabetik)."""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder)
+                  if os.path.exists(os.path.join(folder, name, "index.faiss")))
+
+
+class ShardedIndex:
+    """
+    Shard indekslerini saran, FAISS arama arayüzüyle uyumlu sınıf.
+
+    LangChain FAISS sadece search / ntotal / d (MMR için reconstruct)
+    kullandığı için vectorstore.index yerine doğrudan konabilir. Tüm
+    shard'lar L2 mesafesi kullanır; küçük mesafe daha iyidir.
+    """
+
+    def __init__(self, shards: list, workers: int = None):
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [shard.ntotal for shard in shards])
+        workers = min(len(shards), workers or os.cpu_count() or 1)
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="shard-search") if workers > 1 else None
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def d(self) -> int:
+        return self.shards[0].d
+
+    def locate(self, row: int) -> Tuple[int, int]:
+        """Global satırın (shard sırası, shard içindeki satır) karşılığı."""
+        shard = int(np.searchsorted(self.offsets, row, side="right")) - 1
+        return shard, row - int(self.offsets[shard])
+
+    def reconstruct(self, row: int) -> np.ndarray:
+        shard, local = self.locate(row)
+        return self.shards[shard].reconstruct(local)
+
+    def search(self, queries: np.ndarray, k: int, rows: np.ndarray = None):
+        """
+        Her shard'da k en yakını arar, shard sonuçlarından global k en yakını seçer.
+        rows (sıralı global satırlar) verilirse her shard sadece kendi payına düşen satırlarda arar.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if rows is None:
+            search = lambda shard, _: shard.search(queries, k)
+        else:
+            bounds = np.searchsorted(rows, self.offsets)
+            parts = [rows[bounds[i]:bounds[i + 1]] - self.offsets[i] for i in range(len(self.shards))]
+            search = lambda shard, i: search_rows(shard, queries, k, parts[i])
+        if self._pool is not None:
+            results = list(self._pool.map(search, self.shards, range(len(self.shards))))
+        else:
+            results = [search(shard, i) for i, shard in enumerate(self.shards)]
+        if len(results) == 1:
+            return results[0]
+
+        labels = np.hstack([np.where(rows >= 0, rows + offset, -1)
+                            for (_, rows), offset in zip(results, self.offsets)])
+        distances = np.hstack([dist for dist, _ in results]).astype(np.float32)
+        distances[labels < 0] = np.inf
+        top = np.argsort(distances, axis=1, kind="stable")[:, :k]  # eşitlikte shard sırası korunur
+        return np.take_along_axis(distances, top, axis=1), np.take_along_axis(labels, top, axis=1)
+
+
+class ShardedRowIdMapping(Mapping):
+    """Global FAISS satırı -> "<shard>/<docstore id>" eşlemesi."""
+
+    def __init__(self, index: ShardedIndex, names: List[str], mappings: list):
+        self.index = index
+        self.names = names
+        self.mappings = mappings
+
+    def __getitem__(self, row) -> str:
+        if not 0 <= row < self.index.ntotal:
+            raise KeyError(row)
+        shard, local = self.index.locate(row)
+        return f"{self.names[shard]}{SEPARATOR}{self.mappings[shard][local]}"
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def __iter__(self):
+        return iter(range(self.index.ntotal))
+
+
+class ShardedDocstore(Docstore):
+    """Id önekine göre ilgili shard'ın docstore'una yönlendirir."""
+
+    def __init__(self, names: List[str], docstores: list):
+        self.docstores = dict(zip(names, docstores))
+
+    def search(self, search: str) -> Union[str, Document]:
+        name, _, doc_id = search.partition(SEPARATOR)
+        docstore = self.docstores.get(name)
+        if docstore is None:
+            return f"ID {search} not found."
+        return docstore.search(doc_id)
+
+
+def combine(embedding_function, names: List[str], vectorstores: list, workers: int = None):
+    """Shard vektör depolarını tek bir LangChain FAISS deposunda birleştirir."""
+    from langchain_community.vectorstores import FAISS
+
+    index = ShardedIndex([vs.index for vs in vectorstores], workers)
+    mapping = ShardedRowIdMapping(index, names, [vs.index_to_docstore_id for vs in vectorstores])
+    docstore = ShardedDocstore(names, [vs.docstore for vs in vectorstores])
+    return FAISS(embedding_function, index, docstore, mapping)
@@ -0,0 +1,212 @@
+"""
+telemetry.py
+Sorgu aşamaları için süre / token / chunk ölçümü.
+
+Her aşama bir span'dir; iç içe span'ler bir ağaç oluşturur, en dıştaki span
+bittiğinde ağaç JSONL trace dosyasına tek satır olarak yazılır. Tüm span'ler
+ayrıca aşama bazında toplanıp Prometheus text formatında (histogram ve
+sayaçlar) dosyaya yazılır; sunucuda /metrics bu metni döndürür.
+
+Kapalıyken span() her seferinde aynı boş nesneyi döndürür; ölçüm, token
+sayımı ve dosya yazımı yapılmaz. Token sayımı gibi pahalı öznitelikler
+span.recording kontrol edilerek hesaplanmalıdır:
+
+    with telemetry.span("llm") as span:
+        answer = llm.invoke(prompt)
+        if span.recording:
+            span.set(prompt_tokens=count_tokens(prompt))
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from typing import Dict, Optional
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_KINDS = ("prompt_tokens", "completion_tokens")
+
+_current = contextvars.ContextVar("telemetry_span", default=None)
+
+
+class _NoopSpan:
+    """Telemetri kapalıyken kullanılan span: hiçbir şey kaydetmez."""
+
+    recording = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """Bir aşamanın başlangıcı, süresi, öznitelikleri ve alt aşamaları."""
+
+    recording = True
+    __slots__ = ("name", "attrs", "start", "duration", "children", "parent", "_began", "_token")
+
+    def __init__(self, name: str, attrs: Dict):
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.duration = 0.0
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._began = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._began
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        _tracer.finish(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict:
+        record = {"name": self.name, "start": round(self.start, 6), "duration_ms": round(self.duration * 1000, 3),
+                  **self.attrs}
+        if self.children:
+            record["children"] = [child.to_dict() for child in self.children]
+        return record
+
+
+class Tracer:
+    """Trace dosyası ve aşama metrikleri (thread-safe)."""
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_path = None
+        self.metrics_path = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.durations = {}  # aşama -> [bucket sayıları..., count, sum]
+        self.tokens = {}  # (aşama, tür) -> toplam
+        self.chunks = {}  # aşama -> toplam
+
+    def finish(self, span: Span):
+        with self._lock:
+            stats = self.durations.setdefault(span.name, [0] * len(DURATION_BUCKETS) + [0, 0.0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if span.duration <= bound:
+                    stats[i] += 1
+            stats[-2] += 1
+            stats[-1] += span.duration
+            for kind in TOKEN_KINDS:
+                if isinstance(span.attrs.get(kind), int):
+                    key = (span.name, kind.replace("_tokens", ""))
+                    self.tokens[key] = self.tokens.get(key, 0) + span.attrs[kind]
+            if isinstance(span.attrs.get("chunks"), int):
+                self.chunks[span.name] = self.chunks.get(span.name, 0) + span.attrs["chunks"]
+
+        if span.parent is not None:
+            span.parent.children.append(span)
+            return
+        # En dıştaki span: trace'i ve güncel metrikleri yaz
+        if self.trace_path:
+            line = json.dumps({"trace_id": uuid.uuid4().hex[:16], **span.to_dict()}, ensure_ascii=False, default=str)
+            with self._lock, open(self.trace_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        if self.metrics_path:
+            self.write_metrics(self.metrics_path)
+
+    def prometheus_text(self) -> str:
+        """Toplanan metrikler Prometheus text exposition formatında."""
+        lines = ["# HELP rag_stage_duration_seconds Duration of each query stage.",
+                 "# TYPE rag_stage_duration_seconds histogram"]
+        with self._lock:
+            durations = {name: list(stats) for name, stats in self.durations.items()}
+            tokens = dict(self.tokens)
+            chunks = dict(self.chunks)
+        for name, stats in sorted(durations.items()):
+            for bound, count in zip(DURATION_BUCKETS, stats):
+                lines.append(f'rag_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'rag_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stats[-2]}')
+            lines.append(f'rag_stage_duration_seconds_sum{{stage="{name}"}} {stats[-1]:.6f}')
+            lines.append(f'rag_stage_duration_seconds_count{{stage="{name}"}} {stats[-2]}')
+        lines += ["# HELP rag_tokens_total LLM tokens by stage and kind.", "# TYPE rag_tokens_total counter"]
+        for (name, kind), total in sorted(tokens.items()):
+            lines.append(f'rag_tokens_total{{stage="{name}",kind="{kind}"}} {total}')
+        lines += ["# HELP rag_chunks_total Retrieved chunks by stage.", "# TYPE rag_chunks_total counter"]
+        for name, total in sorted(chunks.items()):
+            lines.append(f'rag_chunks_total{{stage="{name}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path: str):
+        """Metrikleri dosyaya atomik olarak yazar (node_exporter textfile collector uyumlu)."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+_tracer = Tracer()
+
+
+def configure(enabled: bool, trace_path: Optional[str] = None, metrics_path: Optional[str] = None) -> Tracer:
+    """Telemetriyi açar/kapatır; dosya yolları None ise o çıktı yazılmaz."""
+    for path in (trace_path, metrics_path):
+        if enabled and path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    _tracer.enabled = enabled
+    _tracer.trace_path = trace_path
+    _tracer.metrics_path = metrics_path
+    return _tracer
+
+
+def is_enabled() -> bool:
+    return _tracer.enabled
+
+
+def span(name: str, **attrs):
+    """Aşama span'i başlatır (with ile kullanılır); kapalıyken NOOP_SPAN döner."""
+    if not _tracer.enabled:
+        return NOOP_SPAN
+    return Span(name, attrs)
+
+
+def prometheus_text() -> str:
+    return _tracer.prometheus_text()
+
+
+def usage_tokens(message) -> Dict:
+    """LLM cevabındaki token kullanımı (sağlayıcı döndürdüyse)."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    tokens = {}
+    if usage.get("input_tokens") is not None:
+        tokens["prompt_tokens"] = int(usage["input_tokens"])
+    if usage.get("output_tokens") is not None:
+        tokens["completion_tokens"] = int(usage["output_tokens"])
+    return tokens
+
+
+def llm_tokens(prompt: str, message) -> Dict:
+    """
+    Prompt ve cevap token sayıları; sağlayıcı usage döndürmediyse (veya
+    message düz metinse) yerel sayaçla sayılır.
+    """
+    from llm_utils import count_tokens
+
+    tokens = usage_tokens(message)
+    content = message if isinstance(message, str) else getattr(message, "content", "")
+    tokens.setdefault("prompt_tokens", count_tokens(prompt))
+    tokens.setdefault("completion_tokens", count_tokens(content or ""))
+    return tokens
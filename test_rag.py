@@ -0,0 +1,1791 @@
+"""
+test_rag.py
+Offline testler: sahte embedding, sahte vektör deposu ve yerel, OpenAI uyumlu
+sahte bir LLM sunucusu (stream destekli) ile çalışır.
+
+Çalıştırma:
+    python -m pytest -q test_rag.py
+
+Micro-benchmark'lar (sahte bge-m3 boyutlu embedding, sahte LLM, sentetik
+korpuslar; sonuçlar JSON olarak yazılır ve önceki bir çalışmayla karşılaştırılır):
+    python test_rag.py bench --sizes 100 1000 --output bench.json
+    python test_rag.py bench --compare bench.json
+"""
+
+import io
+import os
+import re
+import sys
+import copy
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+ANSWER_TOKENS = ["Huawei", " Cloud", " CSMS", " manages", " secrets", "."]
+
+
+# ===============================
+# FAKE OPENAI-COMPATIBLE SERVER
+# ===============================
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """/v1/chat/completions: stream=true ise SSE ile token token, değilse tek JSON cevap."""
+
+    tokens = ANSWER_TOKENS
+    first_token_delay = 0.2  # prompt işleme süresi
+    token_delay = 0.05
+
+    def log_message(self, *args):
+        pass
+
+    def _chunk(self, delta: dict, finish_reason=None) -> dict:
+        return {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def _send_event(self, payload):
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        usage = {"prompt_tokens": 10, "completion_tokens": len(self.tokens),
+                 "total_tokens": 10 + len(self.tokens)}
+        time.sleep(self.first_token_delay)
+
+        if not body.get("stream"):
+            time.sleep(self.token_delay * len(self.tokens))
+            payload = json.dumps({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": 0, "model": "fake",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(self.tokens)}}],
+                "usage": usage,
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        self._send_event(self._chunk({"role": "assistant", "content": ""}))
+        for i, token in enumerate(self.tokens):
+            if i:
+                time.sleep(self.token_delay)
+            self._send_event(self._chunk({"content": token}))
+        self._send_event(self._chunk({}, "stop"))
+        if body.get("stream_options", {}).get("include_usage"):
+            self._send_event({"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0,
+                              "model": "fake", "choices": [], "usage": usage})
+        self._send_event("[DONE]")
+
+
+@pytest.fixture
+def fake_llm_server():
+    """Rastgele portta sahte LLM sunucusu başlatır, base URL'ini verir."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_llm(fake_llm_server, monkeypatch):
+    """Sahte sunucuya bağlı ChatOpenAI (initialize_llm ile)."""
+    from llm_utils import initialize_llm
+
+    _, base_url = fake_llm_server
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+    return initialize_llm("test", base_url, "fake", 0, verbose=False)
+
+
+@pytest.fixture
+def small_vectorstore():
+    """Sahte embedding'li küçük FAISS deposu."""
+    texts = [f"CSMS stores secrets for service {i}." for i in range(10)]
+    metadatas = [{"source": "./docs/csms.pdf", "page": i, "start_index": 0} for i in range(10)]
+    return FAISS.from_texts(texts, DeterministicFakeEmbedding(size=64), metadatas=metadatas)
+
+
+# ===============================
+# STREAMING
+# ===============================
+def test_stream_completion_reports_ttft_and_rate(fake_llm):
+    from llm_utils import stream_completion
+
+    received = []
+    answer, stats = stream_completion(fake_llm, "What is CSMS?", on_token=received.append)
+
+    assert answer == "".join(ANSWER_TOKENS)
+    assert received == ANSWER_TOKENS
+    assert stats["output_tokens"] == len(ANSWER_TOKENS)  # sunucunun usage bilgisi
+    assert FakeOpenAIHandler.first_token_delay <= stats["ttft"] < stats["total"]
+    assert stats["tokens_per_sec"] > 0
+
+
+def test_query_rag_system_streams_and_records_history(fake_llm, fake_llm_server, small_vectorstore, capsys):
+    from chat_history import ChatHistory
+    from rag_engine import query_rag_system
+
+    server, _ = fake_llm_server
+    history = ChatHistory(fake_llm)
+    metrics = {}
+    answer = query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=3,
+                              chat_history=history, stream=True, metrics=metrics)
+
+    out = capsys.readouterr().out
+    assert answer == "".join(ANSWER_TOKENS)
+    assert history.history[-1] == {"query": "What is CSMS?", "answer": answer}
+    assert server.requests[-1]["stream"] is True
+    assert "TTFT" in out and out.index("ANSWER:") < out.index("SOURCES:")
+    assert metrics["ttft"] < metrics["total"]
+
+
+def test_query_rag_system_without_stream(fake_llm, fake_llm_server, small_vectorstore, capsys):
+    from rag_engine import query_rag_system
+
+    server, _ = fake_llm_server
+    metrics = {}
+    answer = query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=3, metrics=metrics)
+
+    assert answer == "".join(ANSWER_TOKENS)
+    assert not server.requests[-1].get("stream")
+    assert "ttft" not in metrics and metrics["total"] > 0
+
+
+# ===============================
+# ASYNC ENGINE
+# ===============================
+def test_aquery_rag_system_shared_by_concurrent_sessions(fake_llm, fake_llm_server, small_vectorstore):
+    from chat_history import ChatHistory
+    from rag_engine import aquery_rag_system
+
+    server, _ = fake_llm_server
+    histories = [ChatHistory(fake_llm) for _ in range(4)]
+
+    async def run():
+        return await asyncio.gather(*(
+            aquery_rag_system(small_vectorstore, fake_llm, f"What is CSMS {i}?", top_k=3, chat_history=history)
+            for i, history in enumerate(histories)
+        ))
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    single_call = FakeOpenAIHandler.first_token_delay + FakeOpenAIHandler.token_delay * len(ANSWER_TOKENS)
+    assert elapsed < 2 * single_call  # dört oturum aynı anda cevaplandı
+    assert len(server.requests) == 4
+    for i, (result, history) in enumerate(zip(results, histories)):
+        assert result["answer"] == "".join(ANSWER_TOKENS)
+        assert result["query"] == f"What is CSMS {i}?"
+        assert history.history[-1]["answer"] == result["answer"]
+
+
+class ContextualizingLLM:
+    """Bağlam kontrolüne verilen cevabı döndürür; cevap, ham sorgunun retrieval'ı başlamadan verilmez."""
+
+    def __init__(self, relatedness: str, retrieval_started: asyncio.Event):
+        self.relatedness = relatedness
+        self.retrieval_started = retrieval_started
+        self.prompts = []
+
+    async def ainvoke(self, prompt: str):
+        from langchain_core.messages import AIMessage
+
+        self.prompts.append(prompt)
+        if "STANDALONE_QUERY" in prompt:
+            # Retrieval bağlam kontrolünü beklerse burada zaman aşımı olur
+            await asyncio.wait_for(self.retrieval_started.wait(), timeout=5)
+            return AIMessage(content=self.relatedness)
+        return AIMessage(content="CSMS rotates secrets automatically.")
+
+
+@pytest.mark.parametrize("relatedness, rewritten", [
+    ("STATUS: RELATED\nSTANDALONE_QUERY: How does CSMS rotate secrets for service 3?",
+     "How does CSMS rotate secrets for service 3?"),
+    ("STATUS: RELATED\nSTANDALONE_QUERY: How often does it rotate them?", None),  # yeniden yazım aynı
+    ("STATUS: UNRELATED\nSTANDALONE_QUERY:", None),
+])
+def test_aquery_rag_system_retrieves_again_for_rewritten_query(small_vectorstore, relatedness, rewritten):
+    from typing import Any
+    from langchain_core.retrievers import BaseRetriever
+    from chat_history import ChatHistory
+    from rag_engine import aquery_rag_system
+
+    query = "How often does it rotate them?"
+
+    class RecordingRetriever(BaseRetriever):
+        vectorstore: Any
+        queries: list
+        started: Any
+
+        def _get_relevant_documents(self, text, *, run_manager):
+            return self.vectorstore.similarity_search(text, k=3)
+
+        async def _aget_relevant_documents(self, text, *, run_manager):
+            self.queries.append(text)
+            self.started.set()
+            return self._get_relevant_documents(text, run_manager=run_manager)
+
+    async def run():
+        retriever = RecordingRetriever(vectorstore=small_vectorstore, queries=[], started=asyncio.Event())
+        llm = ContextualizingLLM(relatedness, retriever.started)
+        history = ChatHistory(llm)
+        history.add_exchange("What does CSMS do?", "CSMS stores and rotates secrets.")
+        result = await aquery_rag_system(small_vectorstore, llm, query, top_k=3, chat_history=history,
+                                         retriever=retriever)
+        return result, retriever.queries, llm.prompts
+
+    result, queries, prompts = asyncio.run(run())
+    assert "error" not in result and result["answer"] == "CSMS rotates secrets automatically."
+    assert len(prompts) == 2 and "STANDALONE_QUERY" in prompts[0]
+    expected_query = rewritten or query
+    assert queries == ([query, rewritten] if rewritten else [query])  # ham sorgu bağlam kontrolüyle aynı anda
+    assert result["query"] == expected_query
+    assert ([doc.page_content for doc in result["docs"]] ==
+            [doc.page_content for doc in small_vectorstore.similarity_search(expected_query, k=3)])
+    assert f"QUESTION: {query}" in prompts[1]  # cevap promptu kullanıcının kendi sorusunu içerir
+
+
+# ===============================
+# RELATEDNESS GATE
+# ===============================
+class KeywordEmbedding(Embeddings):
+    """Metindeki konu kelimesine göre sabit vektör; benzerlikler testte kontrol edilir."""
+
+    TOPICS = {"iam": [1.0, 0.0, 0.0], "waf": [0.0, 1.0, 0.0], "csms": [0.6, 0.0, 0.8]}
+
+    def _vector(self, text: str) -> list:
+        words = text.casefold().replace("?", " ").split()
+        return next((v for t, v in self.TOPICS.items() if t in words), [0.0, 0.0, 1.0])
+
+    def embed_query(self, text: str) -> list:
+        return self._vector(text)
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._vector(t) for t in texts]
+
+
+def test_relatedness_gate_skips_llm_outside_ambiguous_band():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from chat_history import ChatHistory
+
+    llm = FakeListChatModel(responses=["STATUS: RELATED\nSTANDALONE_QUERY: How does CSMS rotate IAM keys?"] * 5)
+    history = ChatHistory(llm, embeddings=KeywordEmbedding(), gate_low=0.45, gate_high=0.85)
+    history.add_exchange("How do I create an IAM user?", "Open the IAM console.")
+
+    # cos = 0: ilişkisiz, LLM çağrılmaz
+    assert history.is_related_to_previous("How do I configure WAF rules for my site?") == (False, None)
+    # cos = 1: aynı konu, soru zaten bağımsız
+    assert history.is_related_to_previous("How do I delete an IAM user account?") == (True, None)
+    # cos = 0.6: belirsiz bant, LLM yeniden yazar; aynı çift tekrar gelirse önbellekten
+    question = "Does CSMS also handle key rotation for accounts?"
+    assert history.is_related_to_previous(question) == (True, "How does CSMS rotate IAM keys?")
+    assert history.is_related_to_previous(question) == (True, "How does CSMS rotate IAM keys?")
+    # zamirli takip sorusu benzerlik düşük olsa da LLM'e gider
+    history.is_related_to_previous("What does it cost?")
+
+    stats = history.gate_stats()
+    assert stats["llm_calls"] == 2
+    assert stats["skipped_unrelated"] == 1 and stats["skipped_standalone"] == 1 and stats["cache_hits"] == 1
+    assert stats["llm_calls_avoided"] == 3
+
+
+# ===============================
+# HTTP SERVER
+# ===============================
+@pytest.fixture
+def rag_server(fake_llm, small_vectorstore):
+    """Sahte LLM ve küçük depoyla rastgele portta çalışan RAG sunucusu."""
+    from server import RAGService, create_server
+
+    service = RAGService(small_vectorstore, fake_llm, top_k=3, batch_window_ms=50, max_batch=16)
+    server = create_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield service, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    service.close()
+    assert not service.batcher._thread.is_alive()
+    assert all(session.diagram_speculator is None for session in service.sessions.values())
+
+
+def _post(port: int, path: str, payload: dict) -> tuple:
+    import http.client
+
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", path, json.dumps(payload), {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read())
+    conn.close()
+    return result
+
+
+def test_server_batches_concurrent_retrievals(rag_server):
+    from concurrent.futures import ThreadPoolExecutor
+    from server import search_batch
+
+    service, port = rag_server
+    queries = [f"CSMS service {i}" for i in range(8)]
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda q: _post(port, "/retrieve", {"query": q}), queries))
+
+    expected = search_batch(service.vectorstore, queries, 3)
+    for (status, body), docs in zip(responses, expected):
+        assert status == 200
+        assert [s["page"] for s in body["sources"]] == [d.metadata["page"] for d in docs]
+    assert service.batcher.stats()["batches"] < len(queries)  # en az bir batch birden çok sorgu içerdi
+
+    status, body = _post(port, "/retrieve", {"query": "CSMS service 1", "filter": "source:csms page:6-7"})
+    assert status == 200 and sorted(s["page"] for s in body["sources"]) == [6, 7]
+    assert _post(port, "/retrieve", {"query": "CSMS", "filter": {"page": "7-6"}})[0] == 400
+
+
+def test_micro_batcher_close_runs_queued_items_then_stops():
+    from server import MicroBatcher
+
+    release = threading.Event()
+
+    def double(items: list) -> list:
+        release.wait(timeout=5)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, window_ms=1, max_batch=2)
+    futures = [batcher.submit(i) for i in range(5)]
+    release.set()
+    batcher.close(timeout=5)
+    assert [future.result(timeout=0) for future in futures] == [0, 2, 4, 6, 8]
+    assert not batcher._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        batcher.submit(5)
+
+
+def test_server_query_and_diagram_sessions(rag_server):
+    service, port = rag_server
+
+    status, body = _post(port, "/query", {"session": "a", "query": "What is CSMS?"})
+    assert status == 200
+    assert body["answer"] == "".join(ANSWER_TOKENS) and len(body["sources"]) == 3
+    assert service.session("a").history.history[-1]["query"] == "What is CSMS?"
+    assert _post(port, "/query", {"session": "a"})[0] == 400
+
+    status, body = _post(port, "/diagram", {"session": "b", "query": "@diagram mobile app"})
+    assert status == 200 and body["index"] == 0
+    for _ in range(body["total"] - 1):
+        status, body = _post(port, "/diagram", {"session": "b", "answer": ""})  # varsayılan cevap
+        assert "question" in body
+    status, body = _post(port, "/diagram", {"session": "b", "answer": ""})
+    assert status == 200 and "explanation" in body["diagram"]  # sahte LLM JSON dönmüyor
+
+    status, _ = _post(port, "/diagram", {"session": "c", "query": "@diagram data lake"})
+    assert status == 200 and service.session("c").diagram_speculator is not None  # close() kapatmalı
+
+
+# ===============================
+# DIAGRAM SPECULATION
+# ===============================
+class EchoDiagramLLM:
+    """Gecikmeli sahte diyagram LLM'i: explanation olarak prompt'taki isteği döndürür."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.prompts = []
+
+    def _reply(self, prompt: str) -> str:
+        time.sleep(self.delay)
+        self.prompts.append(prompt)
+        payload = {"technologies": [{"name": "ECS", "category": "Compute", "description": "VMs",
+                                     "node_id": 1, "node_label": "ECS"}],
+                   "relationships": [], "explanation": prompt.split("USER_REQUEST:")[-1].strip()}
+        return json.dumps(payload)
+
+    def invoke(self, prompt: str):
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(content=self._reply(prompt))
+
+    def stream(self, prompt: str):
+        from langchain_core.messages import AIMessageChunk
+
+        yield AIMessageChunk(content=self._reply(prompt))
+
+
+class ScriptedStreamLLM:
+    """Sırayla verilen cevapları 8 karakterlik parçalar halinde stream eden sahte LLM."""
+
+    def __init__(self, outputs: list):
+        self.outputs = list(outputs)
+        self.prompts = []
+        self.streamed_chars = []  # her stream'de tüketilen karakter sayısı
+
+    def invoke(self, prompt: str):
+        from langchain_core.messages import AIMessage
+
+        self.prompts.append(prompt)
+        return AIMessage(content=self.outputs.pop(0))
+
+    def stream(self, prompt: str):
+        from langchain_core.messages import AIMessageChunk
+
+        self.prompts.append(prompt)
+        text = self.outputs.pop(0)
+        self.streamed_chars.append(0)
+        for i in range(0, len(text), 8):
+            self.streamed_chars[-1] += len(text[i:i + 8])
+            yield AIMessageChunk(content=text[i:i + 8])
+
+
+@pytest.mark.parametrize("answers, llm_calls, reused", [
+    ([""] * 6, 1, True),  # hepsi varsayılan: ilk tahmin tutar
+    (["iot-platform"] + [""] * 5, 2, True),  # ilk cevap farklı: ikinci tahmin tutar
+    ([""] * 5 + ["mission-critical"], 2, False),  # son cevap farklı: tahmin boşa gider
+])
+def test_diagram_speculation_reuses_matching_generation(small_vectorstore, monkeypatch, capsys,
+                                                        answers, llm_calls, reused):
+    import builtins
+    import diagram_handler
+    from diagram_chat import DiagramSpeculator
+
+    speculators = []
+
+    class RecordingSpeculator(DiagramSpeculator):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            speculators.append(self)
+
+    llm = EchoDiagramLLM(delay=0)
+    script = iter(answers)
+    monkeypatch.setattr(builtins, "input", lambda prompt="": next(script))
+    monkeypatch.setattr(diagram_handler, "DiagramSpeculator", RecordingSpeculator)
+    result = diagram_handler.handle_diagram_query("@diagram mobile app", small_vectorstore, llm, top_k=3)
+
+    expected = [a for a in answers if a] or ["basic uptime"]
+    assert all(answer in result["explanation"] for answer in expected)
+    speculator = speculators[0]
+    assert speculator.stats["generation_hits"] == speculator.stats["retrieval_hits"] == int(reused)
+    assert speculator.stats["generations"] == llm_calls - (not reused)
+    # Boşa giden tahmin başlamadan iptal edilmiş olabilir; sadece çalışanlar sayılır
+    futures = list(speculator.generations.values())
+    concurrent.futures.wait(futures)
+    speculative_calls = sum(not future.cancelled() for future in futures)
+    assert len(llm.prompts) == speculative_calls + (not reused)  # tutan tahmin için yeni LLM çağrısı yok
+
+    llm.prompts.clear()
+    script = iter(answers)
+    result = diagram_handler.handle_diagram_query("@diagram mobile app", small_vectorstore, llm, top_k=3,
+                                                  speculative=False)
+    assert len(llm.prompts) == 1 and all(answer in result["explanation"] for answer in expected)
+
+
+def test_stream_llm_json_aborts_off_schema_output_and_retries():
+    from diagram_chat import stream_llm_json, StreamingJSONValidator
+
+    tech = {"name": "ECS", "category": "Compute", "description": "VMs", "node_id": 1, "node_label": "ECS"}
+    valid = json.dumps({"technologies": [tech], "relationships": [], "explanation": "ok"})
+    missing_key = json.dumps({"technologies": [{"name": "ECS"}] + [tech] * 40, "relationships": [],
+                              "explanation": "x"})
+    llm = ScriptedStreamLLM([missing_key, "Sure! Here is the diagram: " + valid, valid + "\nHope this helps."])
+
+    raw, info = stream_llm_json(llm, "PROMPT", max_attempts=4)
+    assert json.loads(raw)["explanation"] == "ok"  # kök nesneden sonraki metin okunmadı
+    assert info["attempts"] == 3
+    assert info["aborted"] == ["technologies[1] missing key: category", "output is not a JSON object"]
+    assert llm.streamed_chars[0] < len(missing_key) / 10  # ilk öğede kesildi
+    assert "REJECTED: technologies[1] missing key" in llm.prompts[1]
+
+    # Son deneme kesilmez: geçersiz çıktı normal parse/validate aşamasına kalır
+    llm = ScriptedStreamLLM([missing_key, missing_key])
+    raw, info = stream_llm_json(llm, "PROMPT", max_attempts=2)
+    assert raw == missing_key and info["attempts"] == 2 and len(info["aborted"]) == 1
+
+    validator = StreamingJSONValidator()
+    assert validator.feed('{"technologies": "ECS"') == "technologies must be a list"
+    assert StreamingJSONValidator().feed('{"relationships": [{"from": "a", "to": "b"}') == \
+        "relationships[1] missing key: type"
+
+
+def test_diagram_cache_hits_canonical_answers_and_persists(small_vectorstore, tmp_path):
+    from diagram_chat import generate_diagram_flow, speculate_answers
+    from diagram_cache import DiagramCache, warm_up_candidates, warm_up
+    from vectorstore import get_retriever
+
+    retriever = get_retriever(small_vectorstore, 3)
+    llm = EchoDiagramLLM(delay=0)
+    path = str(tmp_path / "diagram_cache.json")
+    cache = DiagramCache(max_size=2, persist_path=path, index_version="v1")
+    defaults = speculate_answers({})
+
+    first = generate_diagram_flow("@diagram mobile app", retriever, llm, 3, defaults, 6, cache=cache)
+    same = {key: f"  {value.upper()} " for key, value in defaults.items()}  # yazım farkı: aynı kombinasyon
+    second = generate_diagram_flow("@diagram  Mobile App!", retriever, llm, 3, same, 6, cache=cache)
+    assert second == first and len(llm.prompts) == 1
+    assert cache.stats()["hits"] == 1
+
+    iot = {**defaults, "question_0": "iot-platform"}
+    generate_diagram_flow("@diagram mobile app", retriever, llm, 3, iot, 6, cache=cache)
+    generate_diagram_flow("@diagram data lake", retriever, llm, 3, defaults, 6, cache=cache)
+    assert len(llm.prompts) == 3 and len(cache.entries) == 2  # LRU: en eski kullanılan atıldı
+    assert not cache.contains("mobile app", defaults) and cache.contains("mobile app", iot)
+    cache.save()
+
+    reloaded = DiagramCache(max_size=2, persist_path=path, index_version="v1")
+    assert reloaded.lookup("@diagram mobile app", iot) is not None
+
+    rebuilt = DiagramCache(max_size=8, persist_path=path, index_version="v2")  # indeks değişti
+    assert not rebuilt.entries
+    assert rebuilt.most_common(1)[0][:2] == ("mobile app", tuple(defaults.values()))  # 2 kez istendi
+    candidates = warm_up_candidates(rebuilt, ["mobile app"], top=5)
+    assert candidates[0] == ("mobile app", defaults) and len(candidates) == 5
+    outcomes = warm_up(rebuilt, retriever, llm, candidates, 3, progress=False)
+    assert outcomes == {"cached": 0, "ok": 5} and len(rebuilt.entries) == 5
+
+    llm.prompts.clear()
+    generate_diagram_flow("@diagram mobile app", retriever, llm, 3, defaults, 6, cache=rebuilt)
+    assert not llm.prompts
+
+    # Warm-up canlı istekle aynı prompt'u kullanır: seçenek yazımı ("enterprise-1M+") korunur
+    scale = {**defaults, "question_2": "enterprise-1M+"}
+    assert ("mobile app", scale) in warm_up_candidates(rebuilt, ["mobile app"], top=100)
+    warm_up(DiagramCache(index_version="v2"), retriever, llm, [("mobile app", scale)], 3, progress=False)
+    generate_diagram_flow("@diagram mobile app", retriever, llm, 3, scale, 6, cache=DiagramCache())
+    assert len(llm.prompts) == 2 and llm.prompts[0] == llm.prompts[1] and "enterprise-1M+" in llm.prompts[0]
+
+    # İstek de ilk görüldüğü yazımla üretilir; anahtar normalize kalır
+    spelled = DiagramCache(index_version="v3", persist_path=str(tmp_path / "spelled.json"))
+    generate_diagram_flow("@diagram Mobile App, EU!", retriever, llm, 3, scale, 6, cache=spelled)
+    generate_diagram_flow("@diagram mobile app eu", retriever, llm, 3, scale, 6, cache=spelled)  # hit
+    spelled.save()
+    spelled = DiagramCache(index_version="v4", persist_path=str(tmp_path / "spelled.json"))
+    candidates = warm_up_candidates(spelled, ["@diagram Data Lake (EU)"], top=2)
+    assert candidates == [("Mobile App, EU!", scale), ("Data Lake (EU)", defaults)]
+    warm_up(spelled, retriever, llm, candidates[:1], 3, progress=False)
+    assert len(llm.prompts) == 4 and llm.prompts[2] == llm.prompts[3]
+    assert spelled.contains("mobile app eu", scale)
+
+    bounded = DiagramCache(max_size=1)
+    for i in range(50):
+        bounded.lookup(f"request {i}", defaults)
+    assert len(bounded.popularity) <= 2 * bounded.POPULARITY_FACTOR  # save() beklemeden budanır
+
+
+# ===============================
+# BATCH RUNNER
+# ===============================
+def test_batch_runner_streams_results_and_resumes(fake_llm, fake_llm_server, small_vectorstore, tmp_path):
+    from batch_runner import read_questions, run_batch
+
+    server, _ = fake_llm_server
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text("\n".join(json.dumps({"id": f"Q{i}", "question": f"Does CSMS store secret {i}?"})
+                                   for i in range(6)) + "\n", encoding="utf-8")
+    output = tmp_path / "answers.jsonl"
+    items = read_questions(str(questions))
+
+    # Kesinti: ilk iki soru cevaplanmış, üçüncüsü hatalı, id'siz satırlar var, son satır yarım yazılmış
+    done = [{"id": "Q0", "answer": "a"}, {"id": "Q1", "answer": "b"}, {"id": "Q2", "answer": None, "error": "timeout"},
+            {"answer": "orphan"}, [1, 2]]
+    output.write_text("".join(json.dumps(r) + "\n" for r in done) + '{"id": "Q3", "ans', encoding="utf-8")
+
+    def batcher_threads() -> int:
+        return sum(thread.name == "micro-batcher" for thread in threading.enumerate())
+
+    threads = batcher_threads()
+    summary = asyncio.run(run_batch(items, str(output), small_vectorstore, fake_llm, top_k=3,
+                                    concurrency=4, progress=False))
+    assert batcher_threads() == threads  # run_batch kendi batch thread'ini durdurur
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+
+    assert summary["skipped"] == 2 and summary["answered"] == 4 and summary["failed"] == 0
+    assert len(server.requests) == 4
+    assert sorted(r["id"] for r in records) == [f"Q{i}" for i in range(6)]
+    new = [r for r in records if r["id"] not in ("Q0", "Q1")]
+    assert all(r["answer"] == "".join(ANSWER_TOKENS) and len(r["sources"]) == 3 for r in new)
+    assert all({"rate_limit", "retrieval_wait", "generation", "total"} <= set(r["timings"]) for r in new)
+    # dört soru eşzamanlı cevaplandı
+    single_call = FakeOpenAIHandler.first_token_delay + FakeOpenAIHandler.token_delay * len(ANSWER_TOKENS)
+    assert summary["seconds"] < 2 * single_call
+
+    summary = asyncio.run(run_batch(items, str(output), small_vectorstore, fake_llm, top_k=3, progress=False))
+    assert summary["skipped"] == 6 and len(server.requests) == 4
+
+
+# ===============================
+# BATCH RETRIEVAL
+# ===============================
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_retrieve_batch_matches_retriever(small_vectorstore, hybrid):
+    from bm25_index import BM25Index
+    from rag_engine import retrieve_batch
+    from vectorstore import get_retriever
+
+    small_vectorstore.bm25_index = BM25Index.from_vectorstore(small_vectorstore) if hybrid else None
+    queries = ["service 3 secrets", "What is CSMS?", "service 7"]
+    results = retrieve_batch(small_vectorstore, queries, top_k=4)
+
+    retriever = get_retriever(small_vectorstore, 4)
+    for query, hits in zip(queries, results):
+        assert [doc.page_content for doc, _ in hits] == [doc.page_content for doc in retriever.invoke(query)]
+        scores = [score for _, score in hits]
+        assert scores == sorted(scores, reverse=hybrid)  # RRF: büyük iyi, L2: küçük iyi
+    assert retrieve_batch(small_vectorstore, [], top_k=4) == []
+
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_sharded_index_matches_single_index(tmp_path, hybrid):
+    import chunk_store
+    from bm25_index import BM25Index
+    from rag_engine import retrieve_batch
+    from vectorstore import open_vectorstore, describe_index
+
+    embedding = DeterministicFakeEmbedding(size=64)
+    products = {"csms": "CSMS stores secrets", "iam": "IAM grants permissions", "waf": "WAF blocks attacks"}
+    shards = {}
+    for name, text in products.items():
+        texts = [f"{text} for service {i}." for i in range(12)]
+        metadatas = [{"source": f"./docs/{name}/{name}.pdf", "page": i} for i in range(12)]
+        shards[name] = FAISS.from_texts(texts, embedding, metadatas=metadatas)
+    # Bir shard pickle, diğerleri chunk deposu ile kaydedilir
+    for name, vs in shards.items():
+        folder = str(tmp_path / "shards" / name)
+        vs.save_local(folder)
+        if name != "iam":
+            chunk_store.save_from_vectorstore(vs, folder)
+        BM25Index.from_vectorstore(vs).save(folder)
+    single = FAISS.from_texts([doc.page_content for vs in shards.values() for doc in vs.docstore._dict.values()],
+                              embedding)
+    single.bm25_index = BM25Index.from_vectorstore(single) if hybrid else None
+
+    mode = "hybrid" if hybrid else "dense"
+    sharded = open_vectorstore(str(tmp_path / "shards"), embedding, retrieval_mode=mode, shards="all",
+                               shard_workers=3)
+    assert sharded.index.ntotal == 36 and describe_index(sharded.index).startswith("3 shards")
+
+    queries = ["CSMS secrets service 3", "IAM permissions", "WAF blocks attacks for service 11"]
+    expected = retrieve_batch(single, queries, top_k=8)
+    for found, wanted in zip(retrieve_batch(sharded, queries, top_k=8), expected):
+        assert [doc.page_content for doc, _ in found] == [doc.page_content for doc, _ in wanted]
+        assert [score for _, score in found] == pytest.approx([score for _, score in wanted], rel=1e-5)
+    docs = sharded.similarity_search("IAM permissions", k=2)
+    assert docs[0].metadata["source"].startswith("./docs/")
+
+    subset = open_vectorstore(str(tmp_path / "shards"), embedding, retrieval_mode=mode, shards=["waf"])
+    assert subset.index.ntotal == 12 and subset.index_version != sharded.index_version
+
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw", "sharded"])
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_metadata_filter_searches_only_matching_rows(tmp_path, index_type, hybrid):
+    import faiss
+    import chunk_store
+    import sharded_index
+    from bm25_index import BM25Index
+    from metadata_filter import parse_filter, select_rows
+    from rag_engine import retrieve_batch
+    from vectorstore import get_retriever
+    from diagram_chat import retrieve_context
+
+    embedding = DeterministicFakeEmbedding(size=64)
+    parts = []
+    for name in ("csms", "iam", "waf"):
+        texts = [f"{name.upper()} security guide page {page} service limits" for page in range(40)]
+        metadatas = [{"source": f"./docs/{name}.pdf", "page": page} for page in range(40)]
+        parts.append(FAISS.from_texts(texts, embedding, metadatas=metadatas))
+    if index_type == "sharded":
+        for name, vs in zip(("csms", "iam", "waf"), parts):
+            chunk_store.save_from_vectorstore(vs, str(tmp_path / name))
+            vs.docstore = chunk_store.ChunkStore(str(tmp_path / name))
+        vectorstore = sharded_index.combine(embedding, ["csms", "iam", "waf"], parts)
+    else:
+        vectorstore = parts[0]
+        for vs in parts[1:]:
+            vectorstore.merge_from(vs)
+        if index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(64, 16)
+            index.add(vectorstore.index.reconstruct_n(0, vectorstore.index.ntotal))
+            vectorstore.index = index
+    vectorstore.bm25_index = BM25Index.from_vectorstore(vectorstore) if hybrid else None
+
+    assert parse_filter("source:IAM.pdf page:3-5,30") == (("iam.pdf",), ((3, 5), (30, 30)))
+    assert parse_filter({"source": [], "page": None}) is None
+    with pytest.raises(ValueError):
+        parse_filter("author:me")
+    assert len(select_rows(vectorstore, "source:iam")) == 40
+    assert len(select_rows(vectorstore, {"source": ["csms*", "waf.pdf"], "page": "10-19"})) == 20
+
+    queries = ["CSMS security guide page 7", "service limits"]
+    spec = "source:iam.pdf page:5-30"
+    results = retrieve_batch(vectorstore, queries, top_k=8, filters=spec)
+    retriever = get_retriever(vectorstore, 8, spec)
+    for query, hits in zip(queries, results):
+        assert len(hits) == 8  # filtre aramanın içinde: top-k slotları boşa gitmez
+        assert all(doc.metadata["source"] == "./docs/iam.pdf" and 5 <= doc.metadata["page"] <= 30
+                   for doc, _ in hits)
+        assert [doc.page_content for doc, _ in hits] == [doc.page_content for doc in retriever.invoke(query)]
+        if not hybrid:  # tüm depoda tam aramanın filtreye uyan ilk 8'i
+            everything = vectorstore.similarity_search_with_score(query, k=vectorstore.index.ntotal, fetch_k=120)
+            expected = [doc.page_content for doc, _ in everything
+                        if doc.metadata["source"] == "./docs/iam.pdf" and 5 <= doc.metadata["page"] <= 30][:8]
+            assert [doc.page_content for doc, _ in hits] == expected
+
+    docs, documentation = retrieve_context(get_retriever(vectorstore, 4), "security guide", k=4,
+                                           filters="source:waf page:39")
+    assert [doc.metadata["page"] for doc in docs] == [39] and documentation.startswith("[1] WAF")
+    assert retrieve_batch(vectorstore, queries, top_k=8, filters="source:missing.pdf") == [[], []]
+
+
+def test_metadata_filter_pq_search_decodes_rows_in_blocks(monkeypatch):
+    import faiss
+    import numpy as np
+    import metadata_filter
+    from metadata_filter import search_rows
+
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((600, 32)).astype(np.float32)
+    index = faiss.IndexPQ(32, 8, 4)
+    index.train(data)
+    index.add(data)
+    queries = rng.standard_normal((3, 32)).astype(np.float32)
+    decoded = index.reconstruct_n(0, index.ntotal)
+
+    decoded_rows = []
+    reconstruct_batch = faiss.IndexPQ.reconstruct_batch
+    monkeypatch.setattr(faiss.IndexPQ, "reconstruct_batch",
+                        lambda self, rows: decoded_rows.append(len(rows)) or reconstruct_batch(self, rows))
+    monkeypatch.setattr(metadata_filter, "SUBSET_BLOCK_ROWS", 64)
+
+    for rows in (np.arange(600), np.arange(0, 600, 7), np.arange(5)):
+        decoded_rows.clear()
+        distances, labels = search_rows(index, queries, 10, rows)
+        assert max(decoded_rows) <= 64 and sum(decoded_rows) == len(rows)  # tüm filtre tek seferde açılmaz
+        exact = ((queries[:, None, :] - decoded[rows][None, :, :]) ** 2).sum(axis=2)
+        order = np.argsort(exact, axis=1, kind="stable")[:, :10]
+        k = min(10, len(rows))
+        np.testing.assert_array_equal(labels[:, :k], rows[order])
+        np.testing.assert_allclose(distances[:, :k], np.take_along_axis(exact, order, axis=1), rtol=1e-4, atol=1e-4)
+        assert (labels[:, k:] == -1).all() and np.isinf(distances[:, k:]).all()
+    _, labels = index.search(queries, 10)  # tüm satırlar: PQ'nun kendi (ADC) aramasıyla aynı sonuç
+    np.testing.assert_array_equal(search_rows(index, queries, 10, np.arange(600))[1], labels)
+
+
+# ===============================
+# INDEX BUILD
+# ===============================
+class FakePDFLoader:
+    """PyPDFLoader yerine: metin dosyasının her satırı bir sayfa; "%CORRUPT" ile başlayan dosya okunamaz."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> list:
+        with open(self.path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if text.startswith("%CORRUPT"):
+            raise ValueError("broken xref table")
+        return [Document(page_content=line, metadata={"source": self.path, "page": page})
+                for page, line in enumerate(text.splitlines())]
+
+
+@pytest.mark.parametrize("index_type, compression", [("flat", None), ("hnsw", None), ("flat", "sq8")])
+def test_incremental_update_add_modify_delete_and_failed_load(tmp_path, monkeypatch, capsys, index_type,
+                                                              compression):
+    import numpy as np
+    import faiss
+    import compressed_index
+    import embed_builder
+
+    embedding = DeterministicFakeEmbedding(size=32)
+    monkeypatch.setattr(embed_builder, "PyPDFLoader", FakePDFLoader)
+    monkeypatch.setattr(embed_builder, "create_embedding_model", lambda *args, **kwargs: embedding)
+    docs, index_path = tmp_path / "docs", str(tmp_path / "index")
+    docs.mkdir()
+
+    def write(name: str, text: str):
+        (docs / name).write_text(text, encoding="utf-8")
+
+    def update() -> dict:
+        """Günceller; diskten yeniden açılan indeksin kaynak -> sayfalar tablosunu döndürür."""
+        embed_builder.update_vector_store_incremental(str(docs), index_path=index_path, index_type=index_type,
+                                                      compression=compression)
+        vectorstore = embed_builder.load_vector_store_for_update(index_path, embedding)
+        assert isinstance(faiss.downcast_index(vectorstore.index), faiss.IndexHNSW) == (index_type == "hnsw")
+        full_vectors = compressed_index.open_vectors(index_path)
+        assert (full_vectors is not None) == bool(compression)
+        if compression:  # yeniden sıralama vektörleri FAISS satırlarıyla hizalı
+            texts = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[row]).page_content
+                     for row in range(vectorstore.index.ntotal)]
+            np.testing.assert_allclose(full_vectors, embedding.embed_documents(texts), rtol=1e-6)
+        grouped = embed_builder.ids_by_source(vectorstore)
+        assert vectorstore.index.ntotal == len(vectorstore.index_to_docstore_id) == sum(map(len, grouped.values()))
+        manifest = embed_builder.load_manifest(index_path)["files"]
+        assert {key: entry["ids"] for key, entry in manifest.items()} == grouped
+        for doc_id in vectorstore.index_to_docstore_id.values():  # satırlar docstore ile hizalı
+            text = vectorstore.docstore.search(doc_id).page_content
+            assert vectorstore.similarity_search(text, k=1)[0].page_content == text
+        return {key: sorted(vectorstore.docstore.search(doc_id).page_content for doc_id in ids)
+                for key, ids in grouped.items()}
+
+    write("a.pdf", "CSMS page one\nCSMS page two")
+    write("b.pdf", "IAM page")
+    write("c.pdf", "%CORRUPT")
+    assert update() == {"a.pdf": ["CSMS page one", "CSMS page two"], "b.pdf": ["IAM page"]}
+
+    # Değişen, silinen, ilk denemede okunamayan ve yeni dosya
+    write("a.pdf", "CSMS v2 page")
+    os.remove(docs / "b.pdf")
+    write("c.pdf", "WAF page")
+    write("d.pdf", "OBS page")
+    assert update() == {"a.pdf": ["CSMS v2 page"], "c.pdf": ["WAF page"], "d.pdf": ["OBS page"]}
+    sha = embed_builder.load_manifest(index_path)["files"]["d.pdf"]["sha256"]
+
+    # Okunamayan yeni sürüm: eski chunk'lar ve hash korunur, bir sonraki güncellemede yeniden denenir
+    write("d.pdf", "%CORRUPT")
+    assert update() == {"a.pdf": ["CSMS v2 page"], "c.pdf": ["WAF page"], "d.pdf": ["OBS page"]}
+    assert embed_builder.load_manifest(index_path)["files"]["d.pdf"]["sha256"] == sha
+    write("d.pdf", "OBS v2 page")
+    assert update() == {"a.pdf": ["CSMS v2 page"], "c.pdf": ["WAF page"], "d.pdf": ["OBS v2 page"]}
+
+
+
+def test_parallel_build_requires_factory_for_given_model(tmp_path):
+    import embed_builder
+
+    chunks = [Document(page_content="CSMS page", metadata={"source": "a.pdf", "page": 0})]
+    with pytest.raises(ValueError, match="model_factory"):
+        embed_builder.build_vector_store_with_progress(chunks, index_path=str(tmp_path), workers=2,
+                                                       embedding_model=DeterministicFakeEmbedding(size=32))
+    assert embed_builder.parse_args(["--workers", "4", "--threads-per-worker", "2"]).threads_per_worker == 2
+
+
+def test_single_pass_build_matches_merge_from_build(tmp_path, capsys):
+    import numpy as np
+    import embed_builder
+    from vectorstore import open_vectorstore
+
+    embedding = DeterministicFakeEmbedding(size=32)
+    chunks = [Document(page_content=f"{name} guide section {i}", metadata={"source": f"./docs/{name}.pdf", "page": i})
+              for name in ("csms", "iam", "waf") for i in range(7)]
+
+    # Önceki yol: her batch için ayrı FAISS nesnesi + merge_from
+    merged = None
+    for i in range(0, len(chunks), 4):
+        part = FAISS.from_documents(chunks[i:i + 4], embedding)
+        if merged is None:
+            merged = part
+        else:
+            merged.merge_from(part)
+
+    folder = str(tmp_path / "index")
+    built = embed_builder.build_vector_store_with_progress(chunks, index_path=folder, batch_size=4,
+                                                           embedding_model=embedding, workers=1,
+                                                           docstore_format="both", index_type="flat",
+                                                           compression=None)
+    reopened = open_vectorstore(folder, embedding)
+
+    def rows(vectorstore) -> list:
+        mapping = vectorstore.index_to_docstore_id
+        docs = [vectorstore.docstore.search(mapping[row]) for row in range(len(mapping))]
+        return [(doc.page_content, doc.metadata) for doc in docs]
+
+    for vectorstore in (built, reopened):
+        assert vectorstore.index.ntotal == merged.index.ntotal == len(chunks)
+        assert rows(vectorstore) == rows(merged)  # aynı satır -> chunk sırası
+        np.testing.assert_array_equal(vectorstore.index.reconstruct_n(0, len(chunks)),
+                                      merged.index.reconstruct_n(0, len(chunks)))
+        for query in ("csms guide section 3", "waf", "iam guide"):
+            assert ([(d.page_content, s) for d, s in vectorstore.similarity_search_with_score(query, k=5)] ==
+                    [(d.page_content, s) for d, s in merged.similarity_search_with_score(query, k=5)])
+
+
+class SlowFirstBatchEmbedding(Embeddings):
+    """
+    Spawn worker'larında kurulan (modül düzeyinde, pickle'lanabilir) sahte
+    embedding: "chunk 0" içeren batch, başka bir batch bitene kadar bekler
+    (wait=True); bitiş sırası log dosyasına yazılır.
+    """
+
+    def __init__(self, log_path: str, wait: bool = True):
+        self.embedding = DeterministicFakeEmbedding(size=16)
+        self.log_path = log_path
+        self.wait = wait
+
+    def embed_documents(self, texts: list) -> list:
+        deadline = time.monotonic() + 60
+        while self.wait and "chunk 0" in texts and time.monotonic() < deadline:
+            if os.path.exists(self.log_path):
+                break
+            time.sleep(0.01)
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(texts[0] + "\n")
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list:
+        return self.embedding.embed_query(text)
+
+
+def test_parallel_embedding_batches_keep_chunk_order(tmp_path, capsys):
+    import functools
+    import numpy as np
+    import embed_builder
+
+    log_path = str(tmp_path / "finished.txt")
+    chunks = [Document(page_content=f"chunk {i}") for i in range(12)]
+    factory = functools.partial(SlowFirstBatchEmbedding, log_path)
+    batches = list(embed_builder.iter_embedding_batches_parallel(chunks, factory, batch_size=3, workers=2,
+                                                                 threads_per_worker=1))
+
+    with open(log_path, encoding="utf-8") as f:
+        finished = f.read().splitlines()
+    assert finished[0] != "chunk 0" and sorted(finished) == ["chunk 0", "chunk 3", "chunk 6", "chunk 9"]
+    assert [start for start, _ in batches] == [0, 3, 6, 9]
+    sequential = list(embed_builder.iter_embedding_batches(chunks, SlowFirstBatchEmbedding(log_path, False), 3))
+    for (start, vectors), (expected_start, expected) in zip(batches, sequential):
+        assert start == expected_start and vectors.dtype == np.float32
+        np.testing.assert_array_equal(vectors, expected)
+
+    workers = re.findall(r"Worker \d+ \(pid (\d+)\): (\d+) chunk", capsys.readouterr().out)
+    assert len(workers) == 2 and sum(int(count) for _, count in workers) == len(chunks)
+    assert all(int(pid) != os.getpid() for pid, _ in workers)
+
+# ===============================
+# EMBEDDING CACHE
+# ===============================
+def test_embedding_cache_round_trip_and_torn_record(tmp_path, capsys):
+    import numpy as np
+    import embed_builder
+    from embedding_cache import EmbeddingCache
+
+    embedding = DeterministicFakeEmbedding(size=16)
+    texts = [f"CSMS chunk {i}" for i in range(5)]
+    vectors = np.asarray(embedding.embed_documents(texts), dtype=np.float32)
+    cache_dir = str(tmp_path / "cache")
+
+    cache = EmbeddingCache(cache_dir, "BAAI/bge-m3")
+    assert cache.lookup(texts) == [None] * 5
+    assert cache.add(texts[:3], vectors[:3]) == [0, 1, 2]
+    assert cache.add(texts[2:4], vectors[2:4]) == [2, 3]  # önbellekteki metin yeniden yazılmaz
+    assert cache.lookup(texts) == [0, 1, 2, 3, None]
+    np.testing.assert_array_equal(cache.vectors([3, 0]), vectors[[3, 0]])
+    assert EmbeddingCache(cache_dir, "BAAI/bge-m3", normalize=False).key(texts[0]) != cache.key(texts[0])
+    assert EmbeddingCache(cache_dir, "other/model").lookup(texts) == [None] * 5
+
+    # Yazarken öldürülen süreç: 5. vektörün yarısı ve anahtarın bir kısmı diske ulaşmış
+    with open(cache.vectors_path, "ab") as f:
+        f.write(vectors[4].tobytes()[:30])
+    with open(cache.keys_path, "ab") as f:
+        f.write(cache.key(texts[4])[:5])
+    reopened = EmbeddingCache(cache_dir, "BAAI/bge-m3")
+    assert len(reopened) == 4 and reopened.lookup(texts) == [0, 1, 2, 3, None]
+    assert os.path.getsize(reopened.vectors_path) == 4 * 16 * 4 and os.path.getsize(reopened.keys_path) == 4 * 16
+    np.testing.assert_array_equal(reopened.vectors([0, 1, 2, 3]), vectors[:4])
+
+    # Build yolu: sadece eksik chunk'lar embed edilir, çıktı chunk sırasıyla
+    embedded = []
+
+    class RecordingEmbedding(Embeddings):
+        def embed_documents(self, texts: list) -> list:
+            embedded.extend(texts)
+            return embedding.embed_documents(texts)
+
+        def embed_query(self, text: str) -> list:
+            return embedding.embed_query(text)
+
+    chunks = [Document(page_content=text) for text in texts + ["IAM chunk"]]
+    batches = list(embed_builder.embedding_batches(chunks, RecordingEmbedding(), batch_size=2, cache=reopened))
+    assert embedded == ["CSMS chunk 4", "IAM chunk"]
+    assert [start for start, _ in batches] == [0, 2, 4]
+    np.testing.assert_allclose(np.vstack([v for _, v in batches]),
+                               np.asarray(embedding.embed_documents([c.page_content for c in chunks])))
+    assert EmbeddingCache(cache_dir, "BAAI/bge-m3").lookup([c.page_content for c in chunks]) == list(range(6))
+
+
+def test_query_embedding_cache_lru_counters_and_persistence(tmp_path):
+    from embedding_cache import QueryEmbeddingCache
+
+    calls = []
+
+    class CountingEmbedding(Embeddings):
+        def __init__(self):
+            self.embedding = DeterministicFakeEmbedding(size=8)
+
+        def embed_documents(self, texts: list) -> list:
+            calls.append(("documents", list(texts)))
+            return self.embedding.embed_documents(texts)
+
+        def embed_query(self, text: str) -> list:
+            calls.append(("query", text))
+            return self.embedding.embed_query(text)
+
+    path = str(tmp_path / "query_cache.npz")
+    cache = QueryEmbeddingCache(CountingEmbedding(), max_size=2, persist_path=path, model_name="BAAI/bge-m3")
+    first = cache.embed_query("What is CSMS?")
+    assert cache.embed_query("  what   is CSMS? ") == first  # boşluk ve büyük harf farkı: hit
+    assert calls == [("query", "What is CSMS?")]
+    assert cache.stats() == {"size": 1, "max_size": 2, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+    cache.embed_query("What is IAM?")
+    cache.embed_query("what is csms?")  # CSMS en son kullanılan olur
+    cache.embed_query("What is OBS?")  # max_size aşıldı: en eski kullanılan (IAM) atılır
+    assert list(cache.cache) == ["what is csms?", "what is obs?"]
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 3
+
+    # embed_queries: önbellekte olmayan farklı sorgular tek çağrıda, her biri bir kez
+    calls.clear()
+    obs = cache.cache["what is obs?"]
+    vectors = cache.embed_queries(["What is ECS?", "what is ecs?", "What is OBS?", "What is VPC?"])
+    assert calls == [("documents", ["What is ECS?", "What is VPC?"])]
+    assert vectors[0] == vectors[1] and vectors[2] == obs
+    assert list(cache.cache) == ["what is ecs?", "what is vpc?"]  # batch eklemesi de max_size'a uyar
+
+    cache.save()
+    reloaded = QueryEmbeddingCache(CountingEmbedding(), max_size=2, persist_path=path, model_name="BAAI/bge-m3")
+    assert list(reloaded.cache) == list(cache.cache)
+    calls.clear()
+    assert reloaded.embed_query("WHAT IS VPC?") == pytest.approx(vectors[3]) and not calls
+    other = QueryEmbeddingCache(CountingEmbedding(), max_size=2, persist_path=path, model_name="other/model")
+    assert not other.cache  # farklı modelin vektörleri kullanılmaz
+
+
+# ===============================
+# CHUNK STORE
+# ===============================
+def test_chunk_store_matches_pickle_docstore(tmp_path, monkeypatch, capsys):
+    import chunk_store
+    import embed_builder
+    from vectorstore import open_vectorstore
+
+    embedding = DeterministicFakeEmbedding(size=32)
+    texts = [f"CSMS stores secrets for service {i}." for i in range(8)] + ["Güvenlik grubu kuralları 🔐", ""]
+    metadatas = [{"source": f"./docs/{'csms' if i < 5 else 'iam'}.pdf", "page": i, "start_index": 100 * i,
+                  "page_label": str(i + 1), "author": "Huawei"} for i in range(9)]
+    metadatas.append({"source": "./docs/notes.pdf"})  # sayfa numarası yok
+    # Chunk'a özgü alanlar: kaynağın ilk chunk'ından farklı değerler de aynen geri gelmeli
+    for i in range(8):
+        metadatas[i]["section"] = f"§{i % 3}"
+    metadatas[3]["author"] = "CSMS team"
+    del metadatas[6]["author"]
+    metadatas[7].update(page="vii", page_label="")  # kolona yazılamayan değerler
+    metadatas[8] = {"page": 8, "start_index": 0, "tags": ["iam", "acl"]}  # kaynak yok
+    vectorstore = FAISS.from_texts(texts, embedding, metadatas=metadatas)
+
+    def assert_same(folder: str):
+        """Chunk deposu ile açılan indeks, aynı klasörün index.pkl'i ile aynı sonuçları verir."""
+        pickled = FAISS.load_local(folder, embedding, allow_dangerous_deserialization=True)
+        store = chunk_store.ChunkStore(folder)
+        mapping = store.index_to_docstore_id()
+        assert dict(mapping) == pickled.index_to_docstore_id and len(store) == len(mapping)
+        for doc_id in pickled.index_to_docstore_id.values():
+            expected, found = pickled.docstore.search(doc_id), store.search(doc_id)
+            assert found.page_content == expected.page_content and found.id == doc_id
+            assert found.metadata == expected.metadata == original[doc_id]
+        assert store.search("missing-id") == pickled.docstore.search("missing-id")
+        opened = open_vectorstore(folder, embedding, retrieval_mode="dense")
+        assert isinstance(opened.docstore, chunk_store.ChunkStore)
+        for query in ("CSMS service 3", "Güvenlik grubu"):
+            assert ([(d.page_content, s) for d, s in opened.similarity_search_with_score(query, k=5)] ==
+                    [(d.page_content, s) for d, s in pickled.similarity_search_with_score(query, k=5)])
+
+    original = {doc_id: vectorstore.docstore.search(doc_id).metadata
+                for doc_id in vectorstore.index_to_docstore_id.values()}
+    folder = str(tmp_path / "index")
+    embed_builder.save_vector_store(vectorstore, folder, "both")
+    assert_same(folder)
+    docstore, mapping = chunk_store.ChunkStore(folder).to_in_memory()
+    assert {doc_id: docstore.search(doc_id).metadata for doc_id in mapping.values()} == original
+
+    # Silme: güncellenen depo yeniden yazıldığında satırlar ve id tablosu hizalı kalır
+    updated = embed_builder.load_vector_store_for_update(folder, embedding)
+    removed = [vectorstore.index_to_docstore_id[row] for row in (0, 4, 9)]
+    embed_builder.delete_from_vector_store(updated, removed)
+    embed_builder.save_vector_store(updated, folder, "both")
+    assert_same(folder)
+    store = chunk_store.ChunkStore(folder)
+    assert len(store) == 7 and all(store.row_of(doc_id) == -1 for doc_id in removed)
+
+    # --convert-docstore: sadece index.pkl olan indeksten embedding yapmadan chunk deposu
+    embed_builder.save_vector_store(vectorstore, folder, "pickle")
+    assert not chunk_store.exists(folder)
+    monkeypatch.setattr(embed_builder, "INDEX_PATH", folder)
+    embed_builder.main(["--convert-docstore", "--no-cache"])
+    assert chunk_store.exists(folder)
+    assert_same(folder)
+
+
+# ===============================
+# ANSWER CACHE
+# ===============================
+def test_answer_cache_threshold_chunk_set_ttl_version_and_persistence(tmp_path):
+    from answer_cache import AnswerCache
+
+    path = str(tmp_path / "answer_cache.json")
+    cache = AnswerCache(threshold=0.95, ttl=60, max_size=3, persist_path=path, index_version="v1")
+    chunks = ["csms.pdf#p1@0", "csms.pdf#p2@0"]
+    cache.add("What is CSMS?", [1.0, 0.0], chunks, "CSMS manages secrets.")
+
+    assert cache.lookup([2.0, 0.0], list(reversed(chunks))) == "CSMS manages secrets."  # ölçek ve sıra önemsiz
+    assert cache.lookup([0.96, 0.28], chunks) == "CSMS manages secrets."  # cos 0.96 >= eşik
+    assert cache.lookup([0.9, 0.4359], chunks) is None  # cos 0.90 < eşik
+    assert cache.lookup([1.0, 0.0], chunks[:1]) is None  # farklı chunk seti: bağlam değişmiş
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+    # Süresi dolan kayıt kullanılmaz ve düşürülür
+    cache.add("Old question", [0.0, 1.0], chunks, "stale", created=time.time() - 61)
+    assert cache.lookup([0.0, 1.0], chunks) is None and len(cache.entries) == 1
+
+    # Kalıcılık: aynı indeks versiyonuyla yeniden açılır, farklı versiyonda yok sayılır
+    cache.save()
+    assert AnswerCache(persist_path=path, index_version="v1").lookup([1.0, 0.0], chunks) == "CSMS manages secrets."
+    assert len(AnswerCache(persist_path=path, index_version="v2").entries) == 0
+    cache.set_index_version("v2")
+    assert cache.lookup([1.0, 0.0], chunks) is None and cache.index_version == "v2"
+
+    # LRU: kullanılan kayıt tutulur, en eski kullanılan düşer
+    for i in range(3):
+        cache.add(f"q{i}", [1.0, float(i)], [f"c{i}"], f"a{i}")
+    assert cache.lookup([1.0, 0.0], ["c0"]) == "a0"
+    cache.add("q3", [0.0, 1.0], ["c3"], "a3")
+    assert [entry["answer"] for entry in cache.entries.values()] == ["a2", "a0", "a3"]
+
+
+def test_query_rag_system_serves_cached_answer_only_for_same_context(fake_llm, fake_llm_server,
+                                                                     small_vectorstore, capsys):
+    from answer_cache import AnswerCache
+    from rag_engine import query_rag_system
+
+    server, _ = fake_llm_server
+    cache = AnswerCache(index_version="v1")
+    answer = query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=3, answer_cache=cache)
+    assert len(server.requests) == 1
+
+    assert query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=3, answer_cache=cache) == answer
+    assert len(server.requests) == 1 and "ANSWER (cached)" in capsys.readouterr().out
+    query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=2, answer_cache=cache)
+    assert len(server.requests) == 2  # aynı soru, farklı chunk seti
+    cache.set_index_version("v2")
+    query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=3, answer_cache=cache)
+    assert len(server.requests) == 3  # indeks değişti
+
+
+# ===============================
+# COMPRESSED INDEX
+# ===============================
+@pytest.mark.parametrize("compression", ["fp16", "sq8", "pq"])
+def test_rerank_index_recall_matches_flat(tmp_path, monkeypatch, capsys, compression):
+    import numpy as np
+    import faiss
+    import compressed_index
+    import embed_builder
+
+    monkeypatch.setattr(embed_builder, "PQ_M", 8)  # 32 boyut: 4 boyutluk alt vektörler, hızlı eğitim
+    monkeypatch.setattr(embed_builder, "PQ_NBITS", 6)
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((10, 32)).astype(np.float32)
+    data = centers[rng.integers(0, 10, 500)] + 0.3 * rng.standard_normal((500, 32)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    queries = data[:50] + 0.05 * rng.standard_normal((50, 32)).astype(np.float32)
+    flat = faiss.IndexFlatL2(32)
+    flat.add(data)
+    expected_distances, expected = flat.search(queries, 10)
+
+    def recall(labels) -> float:
+        return np.mean([len(set(found) & set(wanted)) / 10 for found, wanted in zip(labels, expected)])
+
+    index = embed_builder.build_index([(0, data[:250]), (250, data[250:])], len(data), "flat", compression,
+                                      compressed_index.vectors_path(str(tmp_path)))
+    reranked = compressed_index.wrap(index, str(tmp_path), factor=4)
+    assert isinstance(reranked, compressed_index.RerankIndex) and reranked.ntotal == 500
+    distances, labels = reranked.search(queries, 10)
+    assert recall(labels) >= 0.98 and recall(labels) >= recall(index.search(queries, 10)[1])
+    np.testing.assert_allclose(distances, ((data[labels] - queries[:, None]) ** 2).sum(-1), rtol=1e-5, atol=1e-6)
+    if recall(labels) == 1.0:
+        np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-5)
+
+
+# ===============================
+# BM25 / HYBRID RETRIEVAL
+# ===============================
+BM25_TEXTS = [
+    "CSMS stores secrets and rotates credentials.",
+    "IAM grants permissions to users; IAM policies are JSON.",
+    "The WAF blocks SQL injection attacks.",
+    "Secrets, secrets everywhere: CSMS CSMS.",
+    "Object storage keeps backups.",
+]
+
+
+def _okapi_bm25(texts: list, query: str, k1: float = 1.5, b: float = 0.75) -> list:
+    """Referans Okapi BM25 (idf = ln(1 + (N - df + 0.5) / (df + 0.5)))."""
+    import math
+    from bm25_index import tokenize
+
+    docs = [tokenize(text) for text in texts]
+    avgdl = sum(map(len, docs)) / len(docs)
+    scores = []
+    for doc in docs:
+        score = 0.0
+        for term in set(tokenize(query)):
+            df = sum(term in other for other in docs)
+            tf = doc.count(term)
+            if df and tf:
+                idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avgdl))
+        scores.append(score)
+    return scores
+
+
+def test_bm25_scores_search_persistence_and_merge(tmp_path):
+    import numpy as np
+    import bm25_index
+    from bm25_index import BM25Index
+
+    index = BM25Index.from_texts(BM25_TEXTS)
+    for query in ("csms secrets", "IAM", "waf attacks backups", "unknown words"):
+        np.testing.assert_allclose(index.scores(query), _okapi_bm25(BM25_TEXTS, query), rtol=1e-5)
+
+    rows, scores = index.search("CSMS secrets", k=10)
+    assert rows.tolist() == [3, 0] and scores[0] > scores[1] > 0  # skoru 0 olan satırlar dönmez
+    assert index.search("iam", k=1)[0].tolist() == [1]  # büyük/küçük harf farksız
+    assert index.search("unknown", k=3)[0].tolist() == []
+    assert index.search("CSMS secrets", k=10, rows=np.asarray([0, 2, 4]))[0].tolist() == [0]
+
+    # Kayıt: posting dizileri mmap ile açılır, skorlar aynıdır
+    folder = str(tmp_path / "index")
+    index.save(folder)
+    assert bm25_index.exists(folder)
+    loaded = BM25Index.load(folder)
+    assert isinstance(loaded.rows, np.memmap) and isinstance(loaded.offsets, np.memmap)
+    for query in ("csms secrets", "IAM policies", "json"):
+        np.testing.assert_allclose(loaded.scores(query), index.scores(query), rtol=1e-6)
+    bm25_index.remove(folder)
+    assert not bm25_index.exists(folder) and not os.listdir(folder)
+
+    # Shard birleştirme: tek indeksle aynı idf / ortalama uzunluk
+    merged = BM25Index.merge([BM25Index.from_texts(BM25_TEXTS[:2]), BM25Index.from_texts(BM25_TEXTS[2:])])
+    assert len(merged) == len(BM25_TEXTS)
+    for query in ("csms secrets", "IAM", "waf attacks backups"):
+        np.testing.assert_allclose(merged.scores(query), index.scores(query), rtol=1e-5)
+
+
+def test_reciprocal_rank_fusion_ordering():
+    from hybrid_retriever import reciprocal_rank_fusion, reciprocal_rank_scores
+
+    scores = dict(reciprocal_rank_scores([[1, 2, 3], [3, 1, 4]], k=10, rrf_k=60))
+    assert scores[1] == pytest.approx(1 / 61 + 1 / 62) and scores[4] == pytest.approx(1 / 63)
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 1, 4]], k=10) == [1, 3, 2, 4]
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 1, 4]], k=2) == [1, 3]
+    assert reciprocal_rank_fusion([[5, 6], [6, 5]], k=2) == [5, 6]  # eşitlikte ilk listenin sırası
+    assert reciprocal_rank_fusion([[7], []], k=3) == [7]
+    assert reciprocal_rank_fusion([[1, 2], [2]], k=2, rrf_k=0) == [2, 1]  # 1/2 + 1/1 > 1/1
+
+
+def test_hybrid_retriever_fuses_dense_and_bm25_rankings():
+    from bm25_index import BM25Index
+    from hybrid_retriever import HybridRetriever, reciprocal_rank_fusion
+    from vectorstore import get_retriever
+
+    vectorstore = FAISS.from_texts(BM25_TEXTS, DeterministicFakeEmbedding(size=32),
+                                   metadatas=[{"source": "./docs/cloud.pdf", "page": i} for i in range(5)])
+    assert not isinstance(get_retriever(vectorstore, 3), HybridRetriever)
+    vectorstore.bm25_index = BM25Index.from_vectorstore(vectorstore)
+    retriever = get_retriever(vectorstore, 3)
+    assert isinstance(retriever, HybridRetriever) and retriever.k == 3
+
+    for query in ("IAM policies", "WAF", "CSMS secrets rotation"):
+        dense, keyword = retriever.dense_rows(query), retriever.bm25_rows(query)
+        assert sorted(dense) == list(range(5))  # fetch_k > satır sayısı: tüm satırlar
+        assert keyword == BM25Index.from_texts(BM25_TEXTS).search(query, 40)[0].tolist()
+        docs = retriever.invoke(query)
+        assert [BM25_TEXTS.index(doc.page_content) for doc in docs] == reciprocal_rank_fusion([dense, keyword], 3)
+    # Kelimeyi içeren tek chunk: dense sırası ne olursa olsun iki listede de yer aldığı için ilk sırada
+    assert retriever.invoke("WAF")[0].page_content == "The WAF blocks SQL injection attacks."
+
+
+# ===============================
+# CONTEXT PACKING
+# ===============================
+def _chunk(text: str, start: int = None, source: str = "./docs/csms.pdf", page: int = 1) -> Document:
+    metadata = {"source": source, "page": page}
+    if start is not None:
+        metadata["start_index"] = start
+    return Document(page_content=text, metadata=metadata)
+
+
+def test_merge_adjacent_joins_overlaps_without_dropping_text():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from context_packer import merge_adjacent
+
+    # Splitter çıktısı (CHUNK_OVERLAP): birleşen metin sayfanın kendisi olmalı
+    page = " ".join(f"Step {i}: rotate the CSMS secret and audit access." for i in range(12))
+    splitter = RecursiveCharacterTextSplitter(chunk_size=120, chunk_overlap=40, add_start_index=True)
+    chunks = splitter.split_documents([_chunk(page)])
+    assert len(chunks) > 4
+    spans, ranks = merge_adjacent(list(reversed(chunks)), list(range(len(chunks))))
+    assert [span.page_content for span in spans] == [page] and ranks == [0]
+    assert spans[0].metadata["merged_chunks"] == len(chunks)
+
+    # Sadece bitişik chunk'lar: tesadüfi kısa son ek / ön ek eşleşmesi metni kırpmamalı
+    for left, right in [("Enable the firewall", "all rules apply."),
+                        ("Keys are stored in CSMS.", ".NET clients read them.")]:
+        spans, _ = merge_adjacent([_chunk(left, 0), _chunk(right, len(left))], [0, 1])
+        assert spans[0].page_content == f"{left} {right}"
+        spans, _ = merge_adjacent([_chunk(left, 0), _chunk(right, len(left) + 1)], [0, 1])
+        assert spans[0].page_content == f"{left} {right}"
+
+    # Offset birkaç karakter kaymış gerçek örtüşme yine bir kez yazılır
+    left = "Secrets are encrypted with a KMS data key before storage."
+    right = "with a KMS data key before storage. Access is audited."
+    shifted = left.index("with a KMS") + 3
+    spans, _ = merge_adjacent([_chunk(left, 0), _chunk(right, shifted)], [0, 1])
+    assert spans[0].page_content == "Secrets are encrypted with a KMS data key before storage. Access is audited."
+
+    # Farklı sayfa / uzak offset birleşmez, içerideki chunk tekrar sayılır, start_index'siz dokunulmaz
+    docs = [_chunk("CSMS overview text", 0), _chunk("overview", 5), _chunk("IAM text", 0, page=2),
+            _chunk("Far away text", 500), _chunk("No offset")]
+    spans, ranks = merge_adjacent(docs, [3, 0, 1, 2, 4])
+    assert [(span.page_content, rank) for span, rank in zip(spans, ranks)] == [
+        ("CSMS overview text", 0), ("IAM text", 1), ("Far away text", 2), ("No offset", 4)]
+
+
+def test_drop_duplicates_keeps_best_ranked_copy():
+    from context_packer import drop_duplicates
+
+    answer = "To rotate a secret open the CSMS console select the secret and choose rotate now"
+    spans = [
+        _chunk(answer, source="./docs/faq.pdf"),
+        _chunk("  " + answer.replace(" ", "\n", 3), source="./docs/guide.pdf"),  # sadece boşluk farkı
+        _chunk(answer.replace("now", "immediately"), source="./docs/old.pdf"),  # yakın tekrar
+        _chunk("open the CSMS console select the secret", source="./docs/short.pdf"),  # içeride kalıyor
+        _chunk("IAM policies grant permissions to user groups in every region"),
+    ]
+    kept, dropped = drop_duplicates(spans, threshold=0.8)
+    assert [span.metadata["source"] for span in kept] == ["./docs/faq.pdf", "./docs/csms.pdf"] and dropped == 3
+    kept, dropped = drop_duplicates(spans, threshold=1.0)
+    assert [span.metadata["source"] for span in kept] == ["./docs/faq.pdf", "./docs/old.pdf",
+                                                          "./docs/csms.pdf"] and dropped == 2
+
+
+def test_pack_context_respects_token_budget():
+    from context_packer import SEPARATOR, format_block, pack_context
+
+    def words(text: str) -> int:
+        return len(text.split())
+
+    docs = [_chunk(" ".join(f"long{i}" for i in range(40)), source="./docs/a.pdf"),
+            _chunk(" ".join(f"mid{i}" for i in range(25)), source="./docs/b.pdf"),
+            _chunk(" ".join(f"short{i}" for i in range(8)), source="./docs/c.pdf")]
+    context, packed, stats = pack_context(docs, token_budget=60, counter=words)
+    assert [doc.metadata["source"] for doc in packed] == ["./docs/a.pdf", "./docs/c.pdf"]  # b sığmaz, c sığar
+    assert context == SEPARATOR.join(format_block(i, doc) for i, doc in enumerate(packed, 1))
+    assert stats["tokens"] == words(context) <= 60 and stats["skipped"] == 1 and stats["spans"] == 2
+
+    context, packed, stats = pack_context(docs, token_budget=0, counter=words)
+    assert len(packed) == 3 and stats["skipped"] == 0  # 0: sınırsız
+
+    # En iyi parça tek başına bütçeyi aşıyor: kısaltılıp tek başına verilir
+    context, packed, stats = pack_context(docs[:1], token_budget=20, counter=words)
+    assert len(packed) == 1 and stats["tokens"] <= 20 and packed[0].page_content.startswith("long0 long1")
+    assert pack_context([], token_budget=20, counter=words) == ("", [], {
+        "chunks": 0, "merged": 0, "duplicates": 0, "skipped": 0, "spans": 0, "tokens": 0})
+
+
+def test_count_tokens_warns_once_when_tiktoken_is_missing(monkeypatch):
+    import warnings
+    import llm_utils
+
+    monkeypatch.setitem(sys.modules, "tiktoken", None)  # import tiktoken -> ImportError
+    llm_utils._token_encoder.cache_clear()
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            assert llm_utils.count_tokens("x" * 10) == 3 and llm_utils.count_tokens("y" * 8) == 2
+        assert len(caught) == 1 and issubclass(caught[0].category, RuntimeWarning)
+        assert "tiktoken" in str(caught[0].message)
+    finally:
+        llm_utils._token_encoder.cache_clear()
+
+
+# ===============================
+# TELEMETRY
+# ===============================
+@pytest.fixture
+def tracing(tmp_path):
+    """Telemetriyi geçici dosyalarla açar, test sonunda kapatır."""
+    import telemetry
+
+    tracer = telemetry.configure(True, str(tmp_path / "trace.jsonl"), str(tmp_path / "metrics.prom"))
+    tracer.reset()
+    yield tracer
+    telemetry.configure(False)
+    tracer.reset()
+
+
+def _span_names(span: dict) -> list:
+    return [span["name"]] + [name for child in span.get("children", []) for name in _span_names(child)]
+
+
+def test_query_trace_records_stages_tokens_and_chunks(fake_llm, small_vectorstore, tracing, capsys):
+    from chat_history import ChatHistory
+    from rag_engine import query_rag_system
+
+    history = ChatHistory(fake_llm)
+    history.add_exchange("What is IAM?", "IAM manages identities.")
+    query_rag_system(small_vectorstore, fake_llm, "What is CSMS?", top_k=3, chat_history=history)
+
+    with open(tracing.trace_path, encoding="utf-8") as f:
+        traces = [json.loads(line) for line in f]
+    assert len(traces) == 1 and traces[0]["name"] == "rag_query"
+    names = _span_names(traces[0])
+    for stage in ("relatedness", "relatedness.llm", "retrieval", "embedding", "faiss_search",
+                  "context_packing", "prompt", "llm"):
+        assert stage in names
+
+    llm_span = next(c for c in traces[0]["children"] if c["name"] == "llm")
+    assert llm_span["completion_tokens"] == len(ANSWER_TOKENS)  # sunucunun usage bilgisi
+    assert llm_span["prompt_tokens"] > 0
+    retrieval = next(c for c in traces[0]["children"] if c["name"] == "retrieval")
+    assert retrieval["chunks"] == 3
+
+    with open(tracing.metrics_path, encoding="utf-8") as f:
+        metrics = f.read()
+    assert 'rag_stage_duration_seconds_count{stage="rag_query"} 1' in metrics
+    assert f'rag_tokens_total{{stage="llm",kind="completion"}} {len(ANSWER_TOKENS)}' in metrics
+    assert 'rag_chunks_total{stage="retrieval"} 3' in metrics
+
+
+def test_telemetry_disabled_records_nothing(tmp_path):
+    import telemetry
+
+    telemetry.configure(False, str(tmp_path / "trace.jsonl"), str(tmp_path / "metrics.prom"))
+    with telemetry.span("rag_query") as span:
+        span.set(chunks=3)
+    assert span is telemetry.NOOP_SPAN and not span.recording
+    assert not (tmp_path / "trace.jsonl").exists() and not (tmp_path / "metrics.prom").exists()
+
+
+# ===============================
+# STARTUP
+# ===============================
+@pytest.fixture
+def gated_startup(small_vectorstore, monkeypatch, tmp_path):
+    """Ağır yükleyicileri sahteleriyle değiştirir; indeks yüklemesi gate açılana kadar bekler."""
+    import main
+    import llm_utils
+    import vectorstore
+
+    gate = threading.Event()
+    state = {"error": None}
+
+    def fake_load_vectorstore(*args, timings=None, **kwargs):
+        gate.wait(10)
+        if state["error"] is not None:
+            raise state["error"]
+        timings["model_load"], timings["index_load"] = 0.01, 0.02
+        small_vectorstore.index_version = "v1"
+        return small_vectorstore
+
+    monkeypatch.setattr(vectorstore, "load_vectorstore", fake_load_vectorstore)
+    monkeypatch.setattr(llm_utils, "initialize_llm", lambda *args, **kwargs: object())
+    monkeypatch.setattr(main, "ANSWER_CACHE_PATH", str(tmp_path / "answer_cache.json"))
+    monkeypatch.setattr(main, "DIAGRAM_CACHE_PATH", str(tmp_path / "diagram_cache.json"))
+    return gate, state
+
+
+def test_repl_runs_before_background_load_finishes(gated_startup, monkeypatch, capsys):
+    import main
+    import rag_engine
+    from metadata_filter import parse_filter
+
+    gate, _ = gated_startup
+    loaders, queries, prompts = [], [], []
+
+    class RecordingLoader(main.BackgroundLoader):
+        def start(self):
+            loaders.append(self)
+            super().start()
+
+    monkeypatch.setattr(main, "BackgroundLoader", RecordingLoader)
+    monkeypatch.setattr(rag_engine, "query_rag_system",
+                        lambda vectorstore, llm, query, *args, **kwargs: queries.append((query, kwargs["filters"])))
+
+    answers = iter(["", "@filter source:csms.pdf", "What is CSMS?", "quit"])
+
+    def fake_input(prompt: str) -> str:
+        prompts.append((prompt, loaders[0].ready.is_set()))
+        answer = next(answers)
+        if answer == "What is CSMS?":
+            threading.Timer(0.1, gate.set).start()  # kullanıcı yazarken yükleme biter
+        return answer
+
+    monkeypatch.setattr("builtins.input", fake_input)
+    main.main()
+    out = capsys.readouterr().out
+
+    assert [ready for _, ready in prompts[:3]] == [False, False, False]  # ilk üç girdi yükleme sürerken
+    assert "Please enter a question!" in out and "Filter: source:csms.pdf" in out
+    assert "Loading models, please wait..." in out and out.count("STARTUP TIME:") == 1
+    assert queries == [("What is CSMS?", parse_filter("source:csms.pdf"))]
+    timings = loaders[0].timings
+    assert {"imports", "model_load", "index_load", "llm_init", "total", "repl_ready"} <= set(timings)
+    assert timings["repl_ready"] < timings["total"]
+    assert all(f"{timings[key]:6.2f}s" in out for key in ("imports", "model_load", "index_load", "llm_init"))
+
+
+def test_background_load_failure_is_reported_on_wait(gated_startup, capsys):
+    from main import BackgroundLoader
+
+    gate, state = gated_startup
+    state["error"] = SystemExit(1)  # load_vectorstore indeks yoksa exit(1) çağırır
+    loader = BackgroundLoader()
+    loader.start()
+    assert not loader.is_loaded()
+    gate.set()
+    with pytest.raises(SystemExit):
+        loader.wait()
+    assert isinstance(loader.error, SystemExit) and not loader.is_loaded()
+    assert "Startup failed" in capsys.readouterr().out and "total" in loader.timings
+
+    state["error"] = RuntimeError("index is corrupt")
+    loader = BackgroundLoader()
+    loader.start()
+    with pytest.raises(SystemExit):
+        loader.wait()
+    assert "Startup failed: index is corrupt" in capsys.readouterr().out
+
+
+# ===============================
+# MICRO-BENCHMARKS
+# ===============================
+BENCH_DIM = 1024  # bge-m3 boyutu
+BENCH_SIZES = (100, 1000)  # korpus boyutu (PDF sayfası)
+BENCH_PAYLOAD_SIZES = (10, 100, 1000)  # diyagramdaki servis sayısı
+BENCH_WORDS = ("huawei cloud security iam waf csms obs gaussdb zero trust identity access network "
+               "encryption key audit compliance privacy tenant region service data policy firewall "
+               "gateway storage backup monitor threat detection").split()
+
+
+def synthetic_pages(n: int, page_chars: int = 2500, seed: int = 42) -> list:
+    """PyPDFLoader çıktısına benzeyen n sentetik sayfa (aynı seed: aynı korpus)."""
+    from langchain_core.documents import Document
+
+    rng = random.Random(seed)
+    pages = []
+    for i in range(n):
+        sentences, length = [], 0
+        while length < page_chars:
+            sentence = " ".join(rng.choice(BENCH_WORDS) for _ in range(rng.randint(6, 18))).capitalize() + "."
+            sentences.append(sentence)
+            length += len(sentence) + 1
+            if rng.random() < 0.15:
+                sentences.append("\n\n")
+        pages.append(Document(page_content=" ".join(sentences),
+                              metadata={"source": f"./docs/synthetic_{i // 50}.pdf", "page": i % 50}))
+    return pages
+
+
+def synthetic_payload(n: int, seed: int = 7) -> dict:
+    """n servisli, n ilişkili diyagram JSON'u; bazı alanlar normalize edilecek şekilde bozuk."""
+    rng = random.Random(seed)
+    techs = [{"name": f" Service {i} ", "category": "Compute ", "description": " generated ",
+              "node_id": rng.choice([i, str(i), 0]), "node_label": "" if i % 3 == 0 else f"S{i}"}
+             for i in range(n)]
+    rels = [{"from": f"Service {rng.randrange(n)}", "to": f"Service {rng.randrange(n)}" if i % 10 else "Client App",
+             "type": " data "} for i in range(n)]
+    return {"technologies": techs, "relationships": rels, "explanation": "synthetic"}
+
+
+@contextlib.contextmanager
+def _quiet():
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def _measure(func, repeat: int, setup=None) -> dict:
+    """func'ı repeat kez çalıştırır (setup süresi hariç); milisaniye istatistikleri."""
+    samples = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        began = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - began) * 1000)
+    samples.sort()
+    return {"median_ms": samples[len(samples) // 2], "min_ms": samples[0],
+            "mean_ms": sum(samples) / len(samples), "repeat": repeat}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=BENCH_SIZES, payload_sizes=BENCH_PAYLOAD_SIZES, repeat: int = 20,
+                   build_repeat: int = 3) -> dict:
+    """
+    Chunking, indeks build, retrieval, prompt ve diyagram JSON doğrulama
+    adımlarını ölçer. Sonuç JSON'a yazılabilir bir dict'tir.
+    """
+    import faiss
+    import numpy as np
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from embed_builder import create_chunks, build_vector_store_with_progress
+    from bm25_index import BM25Index
+    from vectorstore import get_retriever
+    from rag_engine import query_rag_system, retrieve_batch
+    from llm_utils import create_rag_prompt
+    from context_packer import pack_context
+    from diagram_chat import validate_payload, normalize_payload
+
+    embeddings = DeterministicFakeEmbedding(size=BENCH_DIM)
+    llm = FakeListChatModel(responses=["stub answer"])
+    queries = [" ".join(random.Random(i).sample(BENCH_WORDS, 5)) for i in range(64)]
+    results = []
+
+    def record(case: str, size: int, stats: dict, items: int = 1):
+        results.append({"case": case, "size": size, "items": items, **stats})
+
+    for size in sizes:
+        pages = synthetic_pages(size)
+        with _quiet():
+            chunks = create_chunks(pages)
+            record("create_chunks", size, _measure(lambda: create_chunks(pages), max(1, repeat // 4)), len(pages))
+
+            with tempfile.TemporaryDirectory() as folder:
+                def build():
+                    return build_vector_store_with_progress(chunks, index_path=folder, embedding_model=embeddings,
+                                                            workers=1, docstore_format="chunks",
+                                                            index_type="flat", compression=None)
+                record("build_vector_store", size, _measure(build, build_repeat), len(chunks))
+                vectorstore = build()
+
+        vectorstore.bm25_index = None
+        record("retrieval_dense", size,
+               _measure(lambda: get_retriever(vectorstore, 20).invoke(queries[0]), repeat))
+        record("retrieve_batch_64", size,
+               _measure(lambda: retrieve_batch(vectorstore, queries, 20), max(1, repeat // 4)), len(queries))
+        vectorstore.bm25_index = BM25Index.from_vectorstore(vectorstore)
+        record("retrieval_hybrid", size,
+               _measure(lambda: get_retriever(vectorstore, 8).invoke(queries[0]), repeat))
+
+        docs = get_retriever(vectorstore, 20).invoke(queries[0])
+        context, _, _ = pack_context(docs, 0)
+        record("create_rag_prompt", size, _measure(lambda: create_rag_prompt(context, queries[0]), repeat * 10))
+        with _quiet():
+            record("rag_query_stub_llm", size,
+                   _measure(lambda: query_rag_system(vectorstore, llm, queries[0], 8), repeat))
+
+    for n in payload_sizes:
+        payload = synthetic_payload(n)
+        record("validate_payload", n, _measure(lambda: validate_payload(payload), repeat * 5))
+        record("normalize_payload", n, _measure(normalize_payload, repeat * 5,
+                                                setup=lambda: (copy.deepcopy(payload),)))
+
+    meta = {"commit": _git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "numpy": np.__version__, "faiss": faiss.__version__, "dim": BENCH_DIM}
+    return {"meta": meta, "results": results}
+
+
+def compare_benchmarks(current: dict, baseline: dict, threshold: float = 0.2) -> list:
+    """
+    Ortak (case, size) çiftlerinin en iyi sürelerini (min_ms; zamanlayıcı
+    gürültüsünden en az etkilenen değer) karşılaştırır. Baseline'dan
+    threshold oranından fazla yavaş olanlar regression sayılır.
+    """
+    base = {(r["case"], r["size"]): r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        old = base.get((r["case"], r["size"]))
+        if old is None:
+            continue
+        change = r["min_ms"] / old["min_ms"] - 1 if old["min_ms"] else 0.0
+        rows.append({"case": r["case"], "size": r["size"], "baseline_ms": old["min_ms"],
+                     "current_ms": r["min_ms"], "change": change, "regression": change > threshold})
+    return rows
+
+
+def print_benchmarks(report: dict, comparison: list = None):
+    meta = report["meta"]
+    print(f"commit {meta['commit']}  python {meta['python']}  faiss {meta['faiss']}  dim {meta['dim']}\n")
+    print(f"{'case':<22}{'size':>7}{'median ms':>12}{'min ms':>10}{'per item us':>13}")
+    for r in report["results"]:
+        print(f"{r['case']:<22}{r['size']:>7}{r['median_ms']:>12.3f}{r['min_ms']:>10.3f}"
+              f"{r['median_ms'] * 1000 / r['items']:>13.1f}")
+    if comparison:
+        print(f"\n{'case':<22}{'size':>7}{'base min ms':>13}{'min ms':>12}{'change':>9}")
+        for row in comparison:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['case']:<22}{row['size']:>7}{row['baseline_ms']:>13.3f}{row['current_ms']:>12.3f}"
+                  f"{row['change']:>+9.0%}{flag}")
+
+
+def test_benchmark_suite_is_machine_readable():
+    report = run_benchmarks(sizes=(20,), payload_sizes=(10,), repeat=1, build_repeat=1)
+    report = json.loads(json.dumps(report))  # JSON'a yazılabilir
+
+    cases = {r["case"] for r in report["results"]}
+    assert {"create_chunks", "build_vector_store", "retrieval_dense", "retrieval_hybrid", "retrieve_batch_64",
+            "create_rag_prompt", "rag_query_stub_llm", "validate_payload", "normalize_payload"} <= cases
+    assert all(r["median_ms"] >= r["min_ms"] >= 0 for r in report["results"])
+    assert report["meta"]["dim"] == BENCH_DIM
+
+    slower = copy.deepcopy(report)
+    for r in slower["results"]:
+        r["min_ms"] = r["min_ms"] * 2 + 1
+    rows = compare_benchmarks(slower, report)
+    assert len(rows) == len(report["results"]) and all(row["regression"] for row in rows)
+    assert not any(row["regression"] for row in compare_benchmarks(report, report))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks (fake embedder and LLM).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("bench", help="Run micro-benchmarks and write JSON results")
+    p.add_argument("--sizes", type=int, nargs="+", default=list(BENCH_SIZES), help="Corpus sizes (pages)")
+    p.add_argument("--payload-sizes", type=int, nargs="+", default=list(BENCH_PAYLOAD_SIZES))
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--output", help="Write results as JSON")
+    p.add_argument("--compare", help="Baseline JSON from a previous run")
+    p.add_argument("--threshold", type=float, default=0.2, help="Slowdown (of min time) flagged as regression")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sizes, args.payload_sizes, args.repeat)
+    comparison = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            comparison = compare_benchmarks(report, json.load(f), args.threshold)
+    print_benchmarks(report, comparison)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults: {args.output}")
+    if comparison and any(row["regression"] for row in comparison):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
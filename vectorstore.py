@@ -4,37 +4,79 @@ FAISS vector store operations and management.
 """
 
 import os
+import time
+import hashlib
+import faiss
 from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
+from embedding_cache import QueryEmbeddingCache
+import chunk_store
+import compressed_index
+import bm25_index
+import sharded_index
+import metadata_filter
+from hybrid_retriever import HybridRetriever
 
 
-def load_vectorstore(index_path: str, embedding_model_name: str) -> FAISS:
-    """FAISS vektör deposunu yükler."""
-    print("\n" + "="*60)
-    print("LOADING FAISS INDEX...")
-    print("="*60)
+def load_vectorstore(index_path: str, embedding_model_name: str,
+                     query_cache_size: int = 1024, query_cache_path: str = None,
+                     verbose: bool = True, timings: dict = None,
+                     ef_search: int = None, nprobe: int = None,
+                     rerank_factor: int = 4, retrieval_mode: str = "dense",
+                     shards=None, shard_workers: int = None) -> FAISS:
+    """
+    FAISS vektör deposunu yükler; sorgu embedding'leri LRU önbellekten geçer.
+    
+    İndeks klasöründe chunk deposu varsa pickle açılmaz: metinler ve metadata
+    memory-mapped dosyalardan sadece bulunan sonuçlar için okunur.
+    timings verilirse model ve indeks yükleme süreleri (saniye) içine yazılır.
+    ef_search / nprobe sadece HNSW / IVF indekslerinde uygulanır. İndeks
+    sıkıştırılmışsa (vectors.npy varsa) k * rerank_factor aday tam
+    vektörlerle yeniden sıralanır. retrieval_mode="hybrid" ise BM25 indeksi
+    de yüklenir (eski indekslerde bellekte oluşturulur). shards verilirse
+    ("all" veya isim listesi) index_path shard klasörlerini içeren klasördür
+    ve shard'lar tek depo olarak paralel aranır (bkz. sharded_index.py).
+    """
+    timings = timings if timings is not None else {}
+    if verbose:
+        print("\n" + "="*60)
+        print("LOADING FAISS INDEX...")
+        print("="*60)
     
     try:
         # Embedding modelini yükle
-        print(f"Embedding model: {embedding_model_name}")
+        if verbose:
+            print(f"Embedding model: {embedding_model_name}")
+        began = time.perf_counter()
         emb_model = HuggingFaceEmbeddings(
             model_name=embedding_model_name,
             model_kwargs={'device': 'cpu'},
             encode_kwargs={'normalize_embeddings': True} # cosine similarity için / vector buyuklugunden dolayi yanliligi yok eder, daha kararli sonuclar verir.
         )
+        if query_cache_size > 0:
+            emb_model = QueryEmbeddingCache(
+                emb_model,
+                max_size=query_cache_size,
+                persist_path=query_cache_path,
+                model_name=embedding_model_name
+            )
+        timings["model_load"] = time.perf_counter() - began
         
         # FAISS indeksini yükle
-        print(f"Index path: {index_path}")
-        vectorstore = FAISS.load_local(
-            index_path, 
-            emb_model, 
-            allow_dangerous_deserialization=True # pkl dosyası icin guvenlik engelini kapatiyor.
-        )
+        if verbose:
+            print(f"Index path: {index_path}")
+        began = time.perf_counter()
+        vectorstore = open_vectorstore(index_path, emb_model, ef_search, nprobe, rerank_factor,
+                                       retrieval_mode, shards, shard_workers, verbose)
+        timings["index_load"] = time.perf_counter() - began
         
-        print(f"FAISS index loaded successfully!") 
-        print(f"   Total vectors: {vectorstore.index.ntotal}")
-        print(f"   Vector dimension: {vectorstore.index.d}")
-        print("="*60 + "\n")
+        if verbose:
+            print(f"FAISS index loaded successfully!") 
+            print(f"   Total vectors: {vectorstore.index.ntotal}")
+            print(f"   Vector dimension: {vectorstore.index.d}")
+            print(f"   Index type: {describe_index(vectorstore.index)}")
+            print(f"   Retrieval: {'hybrid (BM25 + dense, RRF)' if vectorstore.bm25_index else 'dense'}")
+            print("="*60 + "\n")
         
         return vectorstore
         
@@ -45,6 +87,116 @@ def load_vectorstore(index_path: str, embedding_model_name: str) -> FAISS:
         exit(1)
 
 
+def open_vectorstore(index_path: str, emb_model, ef_search: int = None, nprobe: int = None,
+                     rerank_factor: int = 4, retrieval_mode: str = "dense",
+                     shards=None, shard_workers: int = None, verbose: bool = False) -> FAISS:
+    """Hazır embedding modeliyle tek indeksi veya shard'ları açar (load_vectorstore'un indeks kısmı)."""
+    if shards is None:
+        vectorstore = _open_index(index_path, emb_model, ef_search, nprobe, rerank_factor)
+        vectorstore.bm25_index = _open_bm25(vectorstore, index_path, verbose) if retrieval_mode == "hybrid" else None
+        vectorstore.index_version = get_index_version(index_path)
+        return vectorstore
+
+    names = sharded_index.list_shards(index_path) if shards == "all" else list(shards)
+    if not names:
+        raise FileNotFoundError(f"No index shards found in {index_path}")
+    folders = [os.path.join(index_path, name) for name in names]
+    parts = [_open_index(folder, emb_model, ef_search, nprobe, rerank_factor) for folder in folders]
+    vectorstore = sharded_index.combine(emb_model, names, parts, shard_workers)
+    vectorstore.bm25_index = None
+    if retrieval_mode == "hybrid":
+        vectorstore.bm25_index = bm25_index.BM25Index.merge(
+            [_open_bm25(part, folder, verbose) for part, folder in zip(parts, folders)])
+    digest = hashlib.sha1()
+    for name, folder in zip(names, folders):
+        digest.update(f"{name}:{get_index_version(folder)}".encode())
+    vectorstore.index_version = digest.hexdigest()[:16]
+    return vectorstore
+
+
+def _open_index(index_path: str, emb_model, ef_search: int = None, nprobe: int = None,
+                rerank_factor: int = 4) -> FAISS:
+    if chunk_store.exists(index_path):
+        store = chunk_store.ChunkStore(index_path)
+        index = faiss.read_index(os.path.join(index_path, "index.faiss"))
+        vectorstore = FAISS(emb_model, index, store, store.index_to_docstore_id())
+    else:
+        vectorstore = FAISS.load_local(
+            index_path, 
+            emb_model, 
+            allow_dangerous_deserialization=True # pkl dosyası icin guvenlik engelini kapatiyor.
+        )
+    
+    apply_search_params(vectorstore.index, ef_search, nprobe)
+    vectorstore.index = compressed_index.wrap(vectorstore.index, index_path, rerank_factor)
+    return vectorstore
+
+
+def _open_bm25(vectorstore: FAISS, index_path: str, verbose: bool = False) -> bm25_index.BM25Index:
+    if bm25_index.exists(index_path):
+        return bm25_index.BM25Index.load(index_path)
+    if verbose:
+        print(f"BM25 index not found in {index_path}, building in memory (run 'embed_builder.py' to persist it)")
+    return bm25_index.BM25Index.from_vectorstore(vectorstore)
+
+
+def get_retriever(vectorstore: FAISS, top_k: int, filters=None):
+    """
+    BM25 indeksi yüklüyse hybrid, değilse dense similarity retriever döndürür.
+    filters (bkz. metadata_filter.parse_filter) verilirse arama sadece
+    filtreye uyan satırlarda yapılır.
+    """
+    rows = metadata_filter.select_rows(vectorstore, filters)
+    bm25 = getattr(vectorstore, "bm25_index", None)
+    if bm25 is not None:
+        return HybridRetriever(vectorstore=vectorstore, bm25=bm25, k=top_k,
+                               fetch_k=max(40, 4 * top_k), rows=rows)
+    if rows is not None:
+        return metadata_filter.FilteredRetriever(vectorstore=vectorstore, rows=rows, k=top_k)
+    return vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": top_k})
+
+
+def apply_search_params(index, ef_search: int = None, nprobe: int = None):
+    """HNSW efSearch ve IVF nprobe arama parametrelerini ayarlar (flat indekste etkisiz)."""
+    index = faiss.downcast_index(index)
+    if ef_search and isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    ivf = faiss.try_extract_index_ivf(index)
+    if nprobe and ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+
+
+def describe_index(index) -> str:
+    """İndeks tipini ve arama parametrelerini kısa metin olarak döndürür."""
+    if isinstance(index, compressed_index.RerankIndex):
+        return f"{describe_index(index.index)} + rerank x{index.factor}"
+    if isinstance(index, sharded_index.ShardedIndex):
+        return f"{len(index.shards)} shards, {describe_index(index.shards[0])}"
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return f"HNSW (efSearch={index.hnsw.efSearch})"
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return f"{type(index).__name__} (nlist={ivf.nlist}, nprobe={ivf.nprobe})"
+    return type(index).__name__
+
+
+def get_index_version(index_path: str) -> str:
+    """İndeks dosyalarının boyut/zamanından kısa bir versiyon özeti üretir."""
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(index_path)):
+        if name.startswith(("index.", chunk_store.PREFIX + ".", compressed_index.VECTORS_FILE, bm25_index.PREFIX + ".")):
+            stat = os.stat(os.path.join(index_path, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+def chunk_id(doc) -> str:
+    """Chunk'ı kaynak, sayfa ve başlangıç konumuyla tanımlar."""
+    meta = doc.metadata
+    return f"{meta.get('source', 'Unknown')}#p{meta.get('page', 'N/A')}@{meta.get('start_index', 0)}"
+
+
 def display_sources(docs: list, show_content: bool = False):
     """Kaynak dokümanları formatlanmış şekilde gösterir."""
     print("\n" + "="*60)